@@ -1,6 +1,11 @@
 from . import about  # noqa
+from .arrays import *  # noqa
+from .cache import *  # noqa
+from .canonical import *  # noqa
 from .expressions import *  # noqa
+from .hashing import *  # noqa
 from .layout import *  # noqa
+from .parallel import *  # noqa
 from .parser import *  # noqa
 from .rule import *  # noqa
 from .tokenizer import *  # noqa
@@ -0,0 +1,342 @@
+import math
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Type
+
+import numpy as np
+
+from .expressions import (
+    AddExpression,
+    BinaryExpression,
+    ConstantExpression,
+    EqualExpression,
+    MathExpression,
+    MultiplyExpression,
+    SubtractExpression,
+    UnaryExpression,
+    VariableExpression,
+    _array_operations,
+)
+from .types import NumberType
+
+ArrayOperation = Callable[..., np.ndarray]
+
+
+def _operation(node_type: Type[MathExpression]) -> Optional[ArrayOperation]:
+    """Return the array operation for a node type, or None for leaf types. The
+    built-in types use the same operations as `MathExpression.evaluate_batch`,
+    and other unary and binary types apply their `operate` method to each value."""
+    if node_type is EqualExpression:
+        return None
+    operation = _array_operations.get(node_type)
+    if operation is not None:
+        return operation
+    if issubclass(node_type, (UnaryExpression, BinaryExpression)):
+        return np.vectorize(node_type().operate, otypes=[np.float64])
+    return None
+
+
+class ExpressionArray:
+    """A flat, struct-of-arrays representation of one or more expression trees.
+
+    Each node is a position in a set of parallel NumPy arrays. The nodes of each
+    tree are stored contiguously in inorder, one tree after another, and children
+    and parents are referenced by their position, or -1 when there is none. This
+    takes far less memory than the node objects, and lets many trees be evaluated
+    or featurized together without walking Python objects.
+
+    Constants are stored as float64 values, so integers beyond 2^53 lose
+    precision when converted to an array.
+    """
+
+    # The node class of each node, as an index into `types`
+    kinds: np.ndarray
+    # The `MathExpression.type_id` of each node, or -1 if the type has none
+    type_ids: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    parent: np.ndarray
+    # The value of each constant node, or NaN for other nodes
+    values: np.ndarray
+    # True for the constant nodes whose value is an int
+    integers: np.ndarray
+    # The variable of each variable node as an index into `variable_names`, or -1
+    variables: np.ndarray
+    # The index of the tree that each node belongs to
+    tree_ids: np.ndarray
+    # The index of the root node of each tree
+    roots: np.ndarray
+    types: Tuple[Type[MathExpression], ...]
+    variable_names: Tuple[str, ...]
+    _levels: Optional[List[np.ndarray]]
+
+    def __init__(
+        self,
+        kinds: np.ndarray,
+        type_ids: np.ndarray,
+        left: np.ndarray,
+        right: np.ndarray,
+        parent: np.ndarray,
+        values: np.ndarray,
+        integers: np.ndarray,
+        variables: np.ndarray,
+        tree_ids: np.ndarray,
+        roots: np.ndarray,
+        types: Tuple[Type[MathExpression], ...],
+        variable_names: Tuple[str, ...],
+    ):
+        self.kinds = kinds
+        self.type_ids = type_ids
+        self.left = left
+        self.right = right
+        self.parent = parent
+        self.values = values
+        self.integers = integers
+        self.variables = variables
+        self.tree_ids = tree_ids
+        self.roots = roots
+        self.types = types
+        self.variable_names = variable_names
+        self._levels = None
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    @property
+    def num_trees(self) -> int:
+        return len(self.roots)
+
+    @classmethod
+    def from_expression(cls, expression: MathExpression) -> "ExpressionArray":
+        """Convert one expression tree into an array with a single tree"""
+        return cls.from_expressions([expression])
+
+    @classmethod
+    def from_expressions(
+        cls, expressions: Sequence[MathExpression]
+    ) -> "ExpressionArray":
+        """Convert a sequence of expression trees into one array that holds all of
+        them, in the same order."""
+        nodes: List[MathExpression] = []
+        roots: List[int] = []
+        tree_sizes: List[int] = []
+        for expression in expressions:
+            start = len(nodes)
+            # Iterative inorder walk, so that deep trees do not hit the recursion
+            # limit
+            stack: List[MathExpression] = []
+            node: Optional[MathExpression] = expression
+            while stack or node is not None:
+                while node is not None:
+                    stack.append(node)
+                    node = node.left
+                node = stack.pop()
+                if node is expression:
+                    roots.append(len(nodes))
+                nodes.append(node)
+                node = node.right
+            tree_sizes.append(len(nodes) - start)
+
+        index_of: Dict[int, int] = {id(node): i for i, node in enumerate(nodes)}
+        type_codes: Dict[Type[MathExpression], int] = {}
+        type_id_cache: Dict[Any, int] = {}
+        variable_codes: Dict[str, int] = {}
+        kinds: List[int] = []
+        type_ids: List[int] = []
+        left: List[int] = []
+        right: List[int] = []
+        values: List[float] = []
+        integers: List[bool] = []
+        variables: List[int] = []
+        nan = math.nan
+        for node in nodes:
+            node_type = type(node)
+            kind = type_codes.get(node_type)
+            if kind is None:
+                kind = type_codes[node_type] = len(type_codes)
+            kinds.append(kind)
+            value: Any = nan
+            code = -1
+            if node_type is VariableExpression:
+                identifier = node.identifier  # type:ignore
+                assert identifier is not None, "variables must have a name"
+                code = variable_codes.setdefault(identifier, len(variable_codes))
+                cache_key: Any = identifier
+            elif node_type is ConstantExpression:
+                value = node.value  # type:ignore
+                assert value is not None, "constants must have a value"
+                cache_key = node_type
+            else:
+                cache_key = node_type
+            type_id = type_id_cache.get(cache_key)
+            if type_id is None:
+                try:
+                    type_id = node.type_id
+                except NotImplementedError:
+                    type_id = -1
+                type_id_cache[cache_key] = type_id
+            type_ids.append(type_id)
+            values.append(value)
+            integers.append(isinstance(value, int))
+            variables.append(code)
+            child = node.left
+            left.append(-1 if child is None else index_of[id(child)])
+            child = node.right
+            right.append(-1 if child is None else index_of[id(child)])
+        left_array = np.asarray(left, dtype=np.int32)
+        right_array = np.asarray(right, dtype=np.int32)
+        # The parent of each node follows from the child links, which leaves the
+        # roots of the trees without one even when they are subtrees.
+        parent = np.full(len(nodes), -1, dtype=np.int32)
+        for children in (left_array, right_array):
+            has_child = children != -1
+            parent[children[has_child]] = np.flatnonzero(has_child)
+        return cls(
+            kinds=np.asarray(kinds, dtype=np.int16),
+            type_ids=np.asarray(type_ids, dtype=np.int16),
+            left=left_array,
+            right=right_array,
+            parent=parent,
+            values=np.asarray(values, dtype=np.float64),
+            integers=np.asarray(integers, dtype=bool),
+            variables=np.asarray(variables, dtype=np.int16),
+            tree_ids=np.repeat(np.arange(len(tree_sizes), dtype=np.int32), tree_sizes),
+            roots=np.asarray(roots, dtype=np.int32),
+            types=tuple(type_codes),
+            variable_names=tuple(variable_codes),
+        )
+
+    def to_expressions(self) -> List[MathExpression]:
+        """Rebuild the expression trees that this array holds"""
+        nodes: List[MathExpression] = []
+        names = self.variable_names
+        for kind, value, integer, variable in zip(
+            self.kinds.tolist(),
+            self.values.tolist(),
+            self.integers.tolist(),
+            self.variables.tolist(),
+        ):
+            node_type = self.types[kind]
+            node: MathExpression
+            if node_type is ConstantExpression:
+                node = ConstantExpression(int(value) if integer else value)
+            elif node_type is VariableExpression:
+                node = VariableExpression(names[variable])
+            else:
+                node = node_type()
+            nodes.append(node)
+        for node, left, right in zip(nodes, self.left.tolist(), self.right.tolist()):
+            if isinstance(node, UnaryExpression):
+                node.child_on_left = left != -1
+            if left != -1:
+                node.set_left(nodes[left])
+            if right != -1:
+                node.set_right(nodes[right])
+        return [nodes[root] for root in self.roots.tolist()]
+
+    def to_expression(self, tree: int = 0) -> MathExpression:
+        """Rebuild one of the expression trees that this array holds"""
+        return self.to_expressions()[tree]
+
+    def levels(self) -> List[np.ndarray]:
+        """Return the indices of the nodes at each depth, starting with the roots.
+        This takes one set of array operations per level rather than per node."""
+        if self._levels is None:
+            levels: List[np.ndarray] = []
+            level = self.roots
+            while len(level) > 0:
+                levels.append(level)
+                children = np.concatenate([self.left[level], self.right[level]])
+                level = np.sort(children[children != -1])
+            self._levels = levels
+        return self._levels
+
+    def depths(self) -> np.ndarray:
+        """Return the depth of each node, where the roots have a depth of 0"""
+        depths = np.zeros(len(self), dtype=np.int32)
+        for depth, level in enumerate(self.levels()):
+            depths[level] = depth
+        return depths
+
+    def evaluate(self, context: Optional[Dict[str, NumberType]] = None) -> np.ndarray:
+        """Evaluate every tree in the array, resolving variables to the values in
+        `context`, and return an array with the value of each tree.
+
+        The trees are evaluated together, one depth level at a time from the
+        deepest up, so the number of array operations grows with the depth of the
+        deepest tree rather than with the number of nodes.
+
+        Raises ValueError if a variable has no value in the context, or if the
+        sides of an equation do not evaluate to the same value.
+        """
+        results = self.values.copy()
+        for code, name in enumerate(self.variable_names):
+            mask = self.variables == code
+            if context is None or context.get(name, None) is None:
+                if mask.any():
+                    raise ValueError(
+                        f"cannot evaluate statement with None variable: {name}"
+                    )
+                continue
+            results[mask] = context[name]
+        operations = [_operation(node_type) for node_type in self.types]
+        equal_kind = (
+            self.types.index(EqualExpression) if EqualExpression in self.types else -1
+        )
+        # NaN and inf results are expected, e.g. from division by zero
+        with np.errstate(all="ignore"):
+            for level in reversed(self.levels()):
+                level_kinds = self.kinds[level]
+                for kind in np.unique(level_kinds).tolist():
+                    operation = operations[kind]
+                    if operation is None and kind != equal_kind:
+                        continue
+                    nodes = level[level_kinds == kind]
+                    left, right = self.left[nodes], self.right[nodes]
+                    if kind == equal_kind:
+                        one, two = results[left], results[right]
+                        if (one != two).any():
+                            i = int(np.argmax(one != two))
+                            raise ValueError(
+                                "Equation did not hold when evaluated: "
+                                f"left({one[i]}) != right({two[i]})"
+                            )
+                        results[nodes] = one
+                    elif issubclass(self.types[kind], UnaryExpression):
+                        assert operation is not None
+                        results[nodes] = operation(results[np.maximum(left, right)])
+                    else:
+                        assert operation is not None
+                        results[nodes] = operation(results[left], results[right])
+        return results[self.roots]
+
+    def get_terms(self) -> np.ndarray:
+        """Return the indices of the term nodes of each tree, in the same order that
+        `get_terms` returns them for each tree, one tree after another."""
+        term_parents = np.isin(
+            self.kinds, [i for i, t in enumerate(self.types) if _is_add_or_sub(t)]
+        )
+        parent = self.parent
+        has_parent = parent != -1
+        candidates = np.flatnonzero(
+            has_parent & ~term_parents & term_parents[np.where(has_parent, parent, 0)]
+        )
+        # Terms are ordered by the inorder position of their parent, left before
+        # right, with a root multiplication first in its tree.
+        is_right = self.right[parent[candidates]] == candidates
+        keys = parent[candidates] * 4 + 2 + is_right
+        tree_starts = np.flatnonzero(np.diff(self.tree_ids, prepend=-1))
+        multiply_kind = [i for i, t in enumerate(self.types) if t is MultiplyExpression]
+        is_multiply = np.isin(self.kinds[self.roots], multiply_kind)
+        terms = np.concatenate([candidates, self.roots[is_multiply]])
+        keys = np.concatenate([keys, tree_starts[is_multiply] * 4])
+        # Trees without any terms are their own term
+        found = np.bincount(self.tree_ids[terms], minlength=self.num_trees)
+        terms = np.concatenate([terms, self.roots[found == 0]])
+        keys = np.concatenate([keys, tree_starts[found == 0] * 4])
+        return terms[np.argsort(keys, kind="stable")]
+
+
+def _is_add_or_sub(node_type: Type[Any]) -> bool:
+    return issubclass(node_type, (AddExpression, SubtractExpression))
+
+
+__all__ = ("ExpressionArray",)
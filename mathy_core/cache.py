@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from typing import Generic, NamedTuple, Optional, Tuple, TypeVar
+
+KeyType = TypeVar("KeyType")
+ValueType = TypeVar("ValueType")
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    weight: int
+
+
+# fmt: off
+CacheStats.hits.__doc__ = "The number of lookups that found a cached value" # noqa
+CacheStats.misses.__doc__ = "The number of lookups that did not find a cached value" # noqa
+CacheStats.evictions.__doc__ = "The number of values dropped to respect the bounds" # noqa
+CacheStats.entries.__doc__ = "The number of values currently cached" # noqa
+CacheStats.weight.__doc__ = "The total weight of the values currently cached" # noqa
+# fmt: on
+
+
+class LRUCache(Generic[KeyType, ValueType]):
+    """A least-recently-used cache that is bounded by its number of entries and/or
+    the total weight of its entries. When adding a value would exceed either bound,
+    the least recently used values are evicted until it fits.
+
+    # Arguments
+    max_entries (Optional[int]): The maximum number of values to keep, or None
+        for no limit. A value of 0 disables the cache.
+    max_weight (Optional[int]): The maximum total weight of the values to keep, or
+        None for no limit. Values that weigh more than this are not cached.
+    """
+
+    max_entries: Optional[int]
+    max_weight: Optional[int]
+    hits: int
+    misses: int
+    evictions: int
+    weight: int
+    _items: "OrderedDict[KeyType, Tuple[ValueType, int]]"
+
+    def __init__(
+        self, max_entries: Optional[int] = None, max_weight: Optional[int] = None
+    ):
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.weight = 0
+        self._items = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        """False if the cache bounds do not allow storing any values"""
+        return self.max_entries != 0 and self.max_weight != 0
+
+    @property
+    def stats(self) -> CacheStats:
+        """A snapshot of the cache hit/miss/eviction counters and its size"""
+        return CacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self._items),
+            weight=self.weight,
+        )
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: KeyType) -> bool:
+        return key in self._items
+
+    def get(
+        self, key: KeyType, default: Optional[ValueType] = None
+    ) -> Optional[ValueType]:
+        """Return the value for the given key and mark it as the most recently
+        used, or return `default` if the key is not cached."""
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def peek(
+        self, key: KeyType, default: Optional[ValueType] = None
+    ) -> Optional[ValueType]:
+        """Return the value for the given key, or `default` if the key is not
+        cached, without marking it as used or counting a hit or miss."""
+        item = self._items.get(key)
+        return default if item is None else item[0]
+
+    def put(self, key: KeyType, value: ValueType, weight: int = 1) -> None:
+        """Cache a value, evicting the least recently used values as needed to
+        stay within the bounds."""
+        if not self.enabled:
+            return
+        if self.max_weight is not None and weight > self.max_weight:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.weight -= old[1]
+        self._items[key] = (value, weight)
+        self.weight += weight
+        while (
+            self.max_entries is not None and len(self._items) > self.max_entries
+        ) or (self.max_weight is not None and self.weight > self.max_weight):
+            _, (_, evicted_weight) = self._items.popitem(last=False)
+            self.weight -= evicted_weight
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Remove all values from the cache. The hit/miss/eviction counters are
+        kept, use `reset_stats` to clear them."""
+        self._items.clear()
+        self.weight = 0
+
+    def reset_stats(self) -> None:
+        """Reset the hit/miss/eviction counters to zero."""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+__all__ = ("CacheStats", "LRUCache")
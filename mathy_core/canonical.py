@@ -0,0 +1,179 @@
+from fractions import Fraction
+from typing import Dict, List, Optional, Tuple, Type
+
+from .expressions import (
+    AddExpression,
+    ConstantExpression,
+    EqualExpression,
+    MathExpression,
+    MultiplyExpression,
+    UnaryExpression,
+    VariableExpression,
+)
+from .types import NumberType
+
+# Chains of these are flattened and their operands sorted, because the
+# commutative and associative swap rules can put them in any order and grouping.
+_ASSOCIATIVE_TYPES: Tuple[Type[MathExpression], ...] = (
+    AddExpression,
+    MultiplyExpression,
+)
+# The sides of these are sorted, but not flattened
+_COMMUTATIVE_TYPES: Tuple[Type[MathExpression], ...] = (EqualExpression,)
+
+# Nodes without a type_id are written as this code followed by their class name
+_CUSTOM_TYPE_CODE = 255
+# Ends the text of constant values, variable names, and custom class names
+_TEXT_END = b"\x00"
+
+_type_codes: Dict[type, bytes] = {}
+
+
+def _type_code(node: MathExpression) -> bytes:
+    node_type = type(node)
+    code = _type_codes.get(node_type)
+    if code is None:
+        try:
+            code = bytes([node.type_id])
+        except NotImplementedError:
+            name = f"{node_type.__module__}.{node_type.__qualname__}"
+            code = bytes([_CUSTOM_TYPE_CODE]) + name.encode("utf8") + _TEXT_END
+        if isinstance(node, VariableExpression):
+            # Variable type ids depend on the name, which is written anyway
+            return code
+        _type_codes[node_type] = code
+    return code
+
+
+def _number_text(value: Optional[NumberType]) -> bytes:
+    # Whole floats and fractions print the same as ints, so they get the same key
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, Fraction) and value.denominator == 1:
+        value = value.numerator
+    return repr(value).encode("utf8") + _TEXT_END
+
+
+def _leaf_key(node: MathExpression) -> bytes:
+    code = _type_code(node)
+    if isinstance(node, ConstantExpression):
+        return code + _number_text(node.value)
+    if isinstance(node, VariableExpression):
+        return code + str(node.identifier).encode("utf8") + _TEXT_END
+    return code
+
+
+def _chain_operands(node: MathExpression) -> List[MathExpression]:
+    """Return the operands of the chain of same-typed nodes rooted at `node`"""
+    node_type = type(node)
+    operands: List[MathExpression] = []
+    stack: List[MathExpression] = [node]
+    while stack:
+        current = stack.pop()
+        if type(current) is node_type:
+            if current.right is not None:
+                stack.append(current.right)
+            if current.left is not None:
+                stack.append(current.left)
+        else:
+            operands.append(current)
+    return operands
+
+
+def _canonical(
+    expression: MathExpression, build: bool
+) -> Tuple[bytes, Optional[MathExpression]]:
+    """Compute the canonical key of a tree, and when `build` is True, a new tree
+    in canonical form."""
+    keys: Dict[int, bytes] = {}
+    trees: Dict[int, MathExpression] = {}
+    # Visit every node after its children, skipping the inner nodes of chains,
+    # which are handled by the node at the top of their chain.
+    order: List[MathExpression] = []
+    stack: List[MathExpression] = [expression]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if type(node) in _ASSOCIATIVE_TYPES:
+            stack.extend(_chain_operands(node))
+        else:
+            if node.left is not None:
+                stack.append(node.left)
+            if node.right is not None:
+                stack.append(node.right)
+    for node in reversed(order):
+        node_type = type(node)
+        if node_type in _ASSOCIATIVE_TYPES or node_type in _COMMUTATIVE_TYPES:
+            if node_type in _ASSOCIATIVE_TYPES:
+                operands = _chain_operands(node)
+            else:
+                operands = [c for c in (node.left, node.right) if c is not None]
+            operands.sort(key=lambda n: keys[id(n)])
+            count = len(operands).to_bytes(4, "big")
+            key = b"".join([_type_code(node), count] + [keys[id(n)] for n in operands])
+            if build:
+                # Rebuild the chain leaning left, as the parser builds them
+                result = trees[id(operands[0])]
+                for operand in operands[1:]:
+                    result = node_type(result, trees[id(operand)])  # type:ignore
+                trees[id(node)] = result
+        elif node.left is None and node.right is None:
+            key = _leaf_key(node)
+            if build:
+                trees[id(node)] = node._copy_node()
+        else:
+            parts = [_type_code(node)]
+            if not isinstance(node, UnaryExpression):
+                # Binary nodes write both sides, so a missing side is marked
+                sides = (node.left is not None) | (node.right is not None) << 1
+                parts.append(bytes([sides]))
+            parts.extend(keys[id(c)] for c in (node.left, node.right) if c is not None)
+            key = b"".join(parts)
+            if build:
+                copy = node._copy_node()
+                if node.left is not None:
+                    copy.set_left(trees[id(node.left)])
+                if node.right is not None:
+                    copy.set_right(trees[id(node.right)])
+                trees[id(node)] = copy
+        keys[id(node)] = key
+    return keys[id(expression)], trees.get(id(expression))
+
+
+def canonical_key(expression: MathExpression) -> bytes:
+    """Return a compact key that is the same for all trees that only differ by the
+    order and grouping of the operands of additions and multiplications, or by
+    the order of the sides of equations, like `2x + 3y` and `3y + 2x`.
+
+    Chains of additions and multiplications are flattened, and their operands are
+    sorted by their own keys, so the key does not depend on the input order, node
+    ids, or the process, and can be stored across runs. It takes near-linear time
+    for wide trees like sums of thousands of terms.
+
+    # Arguments
+    expression (MathExpression): The tree to compute a key for
+
+    # Returns
+    (bytes): The canonical key of the tree
+    """
+    return _canonical(expression, False)[0]
+
+
+def canonicalize(expression: MathExpression) -> MathExpression:
+    """Return a new tree in canonical form, where the operands of each chain of
+    additions or multiplications are sorted by their canonical keys and grouped
+    from the left, and the sides of equations are sorted. Equivalent trees under
+    `canonical_key` have the same canonical form.
+
+    # Arguments
+    expression (MathExpression): The tree to put in canonical form
+
+    # Returns
+    (MathExpression): A new tree in canonical form
+    """
+    result = _canonical(expression, True)[1]
+    assert result is not None
+    return result
+
+
+__all__ = ("canonical_key", "canonicalize")
@@ -1,13 +1,39 @@
 import json
 import math
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fractions import Fraction
 from io import TextIOWrapper
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Type, Union, cast
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    cast,
+)
 
 import numpy as np
 from colr import color
 
-from .tree import STOP, BinaryTreeNode, NodeType, VisitStop
+from .tree import (
+    _EMPTY_CACHE,
+    LEFT,
+    RIGHT,
+    BinaryTreeNode,
+    NodeId,
+    NodeType,
+    _parse_id,
+)
 from .types import NumberType
 
 OOO_FUNCTION = 4
@@ -27,6 +53,147 @@ MathTypeKeys = META["type_ids"]
 # The maximum value in type keys (for one-hot encoding)
 MathTypeKeysMax = max(MathTypeKeys.values()) + 1
 
+# The number of times `evaluate_batch` walks a tree before compiling it
+_BATCH_WALKS_BEFORE_COMPILING = 8
+
+# A function returned by `MathExpression.compile` that is called with the variable
+# values to evaluate the expression with
+CompiledExpression = Callable[[Optional[Dict[str, NumberType]]], NumberType]
+
+# Keep divisions and powers exact while evaluating, see `use_exact_numbers`. It is
+# a context variable, so that each thread and async task has its own setting.
+_exact_numbers: ContextVar[bool] = ContextVar("exact_numbers", default=False)
+
+
+@contextmanager
+def use_exact_numbers(enabled: bool = True) -> Iterator[None]:
+    """Keep numbers exact instead of rounding them to floats in the evaluations
+    made in a `with` block, e.g. by rules that fold constants:
+
+    `with use_exact_numbers(): rule.apply_to(node)`
+
+    Dividing ints or fractions, or raising them to int powers, gives an int when
+    the result is whole and a `fractions.Fraction` otherwise. Whole numbers are
+    Python ints of any size, so trees of ints only pay for fractions where a
+    division leaves a remainder. Floats still give floats, and division by zero
+    is still NaN.
+
+    The setting only applies to the current thread or async task. To set it for
+    a single call, pass `exact_numbers` to `evaluate`, `evaluate_cached`, or
+    `compile`. Decimal constants are parsed as exact fractions by parsers made
+    with `ExpressionParser(exact_numbers=True)`. Exact numbers print as decimals
+    when they have one, e.g. "0.375", and as a parenthesized division otherwise,
+    e.g. "(1/3)", so the text of a tree parses back to the same values."""
+    token = _exact_numbers.set(enabled)
+    try:
+        yield
+    finally:
+        _exact_numbers.reset(token)
+
+
+def exact_numbers_enabled() -> bool:
+    """Return True if evaluations in the current thread or task keep numbers
+    exact, see `use_exact_numbers`"""
+    return _exact_numbers.get()
+
+
+def _whole_fraction(value: Fraction) -> NumberType:
+    # Whole fractions are returned as ints, so that later math stays on ints
+    return value.numerator if value.denominator == 1 else value  # type:ignore
+
+
+def _exact_divide(one: NumberType, two: NumberType) -> NumberType:
+    """Divide two non-zero numbers, exactly if both are ints or fractions"""
+    if type(one) is int and type(two) is int:
+        quotient, remainder = divmod(one, two)
+        if remainder == 0:
+            return quotient
+        return Fraction(one, two)  # type:ignore
+    if isinstance(one, (int, Fraction)) and isinstance(two, (int, Fraction)):
+        return _whole_fraction(Fraction(one, two))
+    return one / two
+
+
+class _SubtreeMetrics(NamedTuple):
+    size: int
+    height: int
+    types: FrozenSet[type]
+    variables: FrozenSet[str]
+
+
+# Leaves with the same type and variable share their metrics
+_leaf_metrics: Dict[Tuple[type, Optional[str]], _SubtreeMetrics] = {}
+_no_variables: FrozenSet[str] = frozenset()
+# Whether a set of subtree node types includes a subclass of a queried type
+_contains_type: Dict[Tuple[FrozenSet[type], type], bool] = {}
+
+
+def _types_include(types: FrozenSet[type], instanceType: type) -> bool:
+    """Return True if a set of node types includes a subclass of `instanceType`"""
+    key = (types, instanceType)
+    result = _contains_type.get(key)
+    if result is None:
+        result = any(issubclass(t, instanceType) for t in types)
+        _contains_type[key] = result
+    return result
+
+
+# The order of operations priority of each binary node type
+_priorities: Dict[type, int] = {}
+
+
+def _union(one: FrozenSet[Any], two: FrozenSet[Any]) -> FrozenSet[Any]:
+    """Join two sets, reusing one of them when it holds all the items"""
+    if two <= one:
+        return one
+    if one <= two:
+        return two
+    return one | two
+
+
+class _TypeIndex:
+    """The nodes of a tree in inorder, with the positions of the nodes of each type
+    that has been queried. The nodes of any subtree are a contiguous range of the
+    inorder positions, so a type query on a subtree is two binary searches."""
+
+    __slots__ = ("nodes", "positions", "types")
+
+    nodes: List["MathExpression"]
+    positions: Dict[int, int]
+    types: Dict[type, List[int]]
+
+    def __init__(self, root: "MathExpression"):
+        self.nodes = list(root.iter_inorder())
+        self.positions = {id(node): i for i, node in enumerate(self.nodes)}
+        self.types = {}
+
+    def find(self, node: "MathExpression", instanceType: type) -> Optional[List[Any]]:
+        """Return the nodes of the given type in the subtree of `node`, or None if
+        the subtree is not in the indexed tree. Nodes replaced with `set_left` or
+        `set_right` keep their parent, so they can reach the root without being in
+        the tree."""
+        first = last = node
+        while first.left is not None:
+            first = first.left
+        while last.right is not None:
+            last = last.right
+        nodes = self.nodes
+        start = self.positions.get(id(first))
+        end = self.positions.get(id(last))
+        if start is None or end is None:
+            return None
+        if nodes[start] is not first or nodes[end] is not last:
+            return None
+        positions = self.types.get(instanceType)
+        if positions is None:
+            positions = [
+                i for i, n in enumerate(self.nodes) if isinstance(n, instanceType)
+            ]
+            self.types[instanceType] = positions
+        start = bisect_left(positions, start)
+        end = bisect_right(positions, end, start)
+        return [nodes[i] for i in positions[start:end]]
+
 
 class MathExpression(BinaryTreeNode["MathExpression"]):
     """Math tree node with helpers for manipulating expressions.
@@ -34,30 +201,66 @@ class MathExpression(BinaryTreeNode["MathExpression"]):
     `mathy:x+y=z`
     """
 
+    __slots__ = ("r_index", "_changed", "_span_start", "_span_end")
+
     left: Optional["MathExpression"]
     right: Optional["MathExpression"]
     parent: Optional["MathExpression"]
     r_index: Optional[int]
 
-    _rendering_change: bool
     _changed: bool
-    classes: List[str]
-    cloned_node: Optional["MathExpression"]
-    cloned_target: Optional[str]
+    _span_start: int
+    _span_end: int
 
     def __init__(
         self,
-        id: Optional[str] = None,
+        id: Optional[NodeId] = None,
         left: Optional["MathExpression"] = None,
         right: Optional["MathExpression"] = None,
         parent: Optional["MathExpression"] = None,
     ):
         super().__init__(left, right, parent, id)
-        self._rendering_change = False
         self._changed = False
-        self.classes = [self.id]
-        self.cloned_node = None
-        self.cloned_target = ""
+        self._span_start = self._span_end = -1
+
+    @property
+    def span(self) -> Tuple[int, int]:
+        """The (start, end) offsets of the source text that the parser read this
+        node from, or (-1, -1) for nodes that were not parsed from text."""
+        return (self._span_start, self._span_end)
+
+    @span.setter
+    def span(self, value: Tuple[int, int]) -> None:
+        self._span_start, self._span_end = value
+
+    # The classes, clone tracking, and rendering state of a node are rarely set, so
+    # they live in the `_meta` side table rather than in slots.
+
+    @property
+    def classes(self) -> List[str]:
+        """The class names attached to this node when it is rendered as MathML.
+        Defaults to a list with the node's id. The list is only stored on the node
+        once it is assigned, e.g. by `add_class`, so mutating the default list has
+        no effect."""
+        classes: Optional[List[str]] = self._get_meta("classes")
+        if classes is None:
+            return [self.id]
+        return classes
+
+    @classes.setter
+    def classes(self, value: List[str]) -> None:
+        self._set_meta("classes", value)
+
+    @property
+    def _rendering_change(self) -> bool:
+        return self._get_meta("rendering_change", False)
+
+    @_rendering_change.setter
+    def _rendering_change(self, value: bool) -> None:
+        if not value:
+            self._del_meta("rendering_change")
+        else:
+            self._set_meta("rendering_change", value)
 
     @property
     def name(self) -> str:
@@ -77,16 +280,12 @@ class MathExpression(BinaryTreeNode["MathExpression"]):
         """Text output of this node that includes terminal color codes that
         highlight which nodes have been changed in this tree as a result of
         a transformation."""
-
-        def visit_fn(
-            node: MathExpression, depth: int, data: Any
-        ) -> Optional[VisitStop]:
-            node._rendering_change = data
-            return None
-
-        self.visit_inorder(visit_fn, data=True)
+        nodes = list(self.iter_inorder())
+        for node in nodes:
+            node._rendering_change = True
         result = str(self)
-        self.visit_inorder(visit_fn, data=False)
+        for node in nodes:
+            node._rendering_change = False
         return result
 
     @property
@@ -95,24 +294,133 @@ class MathExpression(BinaryTreeNode["MathExpression"]):
         `.terminal_text`"""
         return "green"
 
-    def evaluate(self, context: Optional[Dict[str, NumberType]] = None) -> NumberType:
-        """Evaluate the expression, resolving all variables to constant values"""
+    def evaluate(
+        self,
+        context: Optional[Dict[str, NumberType]] = None,
+        exact_numbers: Optional[bool] = None,
+    ) -> NumberType:
+        """Evaluate the expression, resolving all variables to constant values.
+
+        Pass `exact_numbers` to keep numbers exact or not for this call, instead
+        of following `use_exact_numbers`."""
         raise NotImplementedError("must be implemented in subclass")
 
+    def evaluate_cached(
+        self,
+        context: Optional[Dict[str, NumberType]] = None,
+        exact_numbers: Optional[bool] = None,
+    ) -> NumberType:
+        """Evaluate the expression like `evaluate`, and cache the value of each
+        node with the variable values it was computed for.
+
+        Changing the tree with `set_left` or `set_right`, which rules use through
+        `ExpressionChangeRule.done`, or by setting the value of a constant drops
+        the values cached on the changed node and its ancestors, so evaluating it
+        again with the same variable values only computes the nodes between the
+        change and the root. This makes re-evaluating a tree after each rule
+        change cost about the depth of the change rather than the size of the
+        tree. Each node keeps the value for the most recent variable values only.
+        Pass `exact_numbers` to keep numbers exact or not, like with `evaluate`.
+
+        Caching trades memory for speed: each inner node keeps its value, and
+        the first call on a tree is a few times slower than `evaluate`. For small
+        trees, following the cached values costs about as much as computing them,
+        so trees with fewer than 64 nodes are evaluated with `evaluate` instead,
+        and only cache that they are small. Their nodes are counted again after
+        each change, which can make re-evaluating a changed small tree up to twice
+        as slow as `evaluate`. Larger trees are re-evaluated several times faster
+        than with `evaluate` after a change.
+        """
+        if exact_numbers is not None and exact_numbers is not _exact_numbers.get():
+            with use_exact_numbers(exact_numbers):
+                return self.evaluate_cached(context)
+        cached = self._get_cache("value")
+        if cached is None:
+            # Small trees are counted again after each change, which drops this
+            if self._get_cache("small_tree") or _cache_small_tree(self):
+                return self.evaluate(context)
+        key = _bindings_key(context)
+        if cached is not None and (cached[0] is key or cached[0] == key):
+            return cached[1]  # type:ignore
+        return _evaluate_cached(self, context, key)  # type:ignore
+
+    def compile(self, exact_numbers: Optional[bool] = None) -> CompiledExpression:
+        """Return a function that evaluates this expression in a single call, for
+        evaluating the same tree with many different variable values. It returns
+        the same values and raises the same errors as `evaluate`, e.g.
+
+        `fn = expression.compile(); fn({"x": 2}) == expression.evaluate({"x": 2})`
+
+        The function is generated from Python source with one line per node, and
+        is cached on the tree until it changes. It keeps numbers exact if
+        `exact_numbers` is True, or when it is None, if `use_exact_numbers` is in
+        effect when compiling, wherever the function is called later."""
+        if exact_numbers is None:
+            exact_numbers = _exact_numbers.get()
+        # Divisions compile differently with exact numbers, so each mode has its own
+        key = "compiled_exact" if exact_numbers else "compiled"
+        compiled: Optional[CompiledExpression] = self._get_cache(key)
+        if compiled is None:
+            compiled = _compile_expression(self, exact_numbers=exact_numbers)
+            self._set_cache(key, compiled)
+        return compiled
+
+    def evaluate_batch(self, bindings: Dict[str, Any]) -> np.ndarray:
+        """Evaluate the expression for many sets of variable values at once, where
+        `bindings` maps each variable to an array of its values, e.g.
+
+        `expression.evaluate_batch({"x": np.arange(1000), "y": 2.5})`
+
+        The arrays are broadcast together, and the tree is evaluated once with
+        array operations. Trees that are evaluated many times are compiled like
+        with `compile`, and the compiled function is cached on the tree. The values
+        are floats, and the operations follow the scalar ones where they can:
+        division by zero is NaN, fractional powers of negative numbers are NaN and
+        overflows are inf, and factorials use the whole part of each value, with
+        NaN for negative values. Types that override `operate` are applied to each
+        value in turn.
+
+        Raises ValueError if a variable has no values, or if the sides of an
+        equation are not equal at every point.
+
+        # Arguments
+        bindings (Dict[str, Any]): The values of each variable, as arrays or numbers
+
+        # Returns
+        (np.ndarray): The value of the expression for each set of variable values
+        """
+        context = {
+            name: np.asarray(value, dtype=np.float64)
+            for name, value in bindings.items()
+            if value is not None
+        }
+        shape = np.broadcast_shapes(*(value.shape for value in context.values()))
+        result = np.empty(shape, dtype=np.float64)
+        compiled: Optional[CompiledExpression] = self._get_cache("compiled_batch")
+        if compiled is None:
+            # Walk trees that are only evaluated a few times, since compiling one
+            # takes about as long as walking it ten times
+            walks = self._get_cache("batch_walks", 0)
+            if walks >= _BATCH_WALKS_BEFORE_COMPILING:
+                compiled = _compile_expression(self, arrays=True)
+                self._set_cache("compiled_batch", compiled)
+        with np.errstate(all="ignore"):
+            if compiled is not None:
+                result[...] = compiled(context)  # type:ignore
+            else:
+                result[...] = _evaluate_arrays(self, context)
+                # The walk marked the nodes, so this does not walk them again
+                self._set_cache("batch_walks", walks + 1)
+        return result
+
     def set_changed(self) -> None:
         """Mark this node as having been changed by the application of a Rule"""
         self._changed = True
 
     def all_changed(self) -> None:
         """Mark this node and all of its children as changed"""
-
-        def visit_fn(
-            node: MathExpression, depth: int, data: Any
-        ) -> Optional[VisitStop]:
+        for node in self.iter_inorder():
             node.set_changed()
-            return None
-
-        self.visit_inorder(visit_fn)
 
     def with_color(self, text: str, style: str = "bright") -> str:
         """Render a string that is colored if something has changed"""
@@ -136,34 +444,172 @@ class MathExpression(BinaryTreeNode["MathExpression"]):
 
     def clear_classes(self) -> None:
         """Clear all the classes currently set on the nodes in this expression."""
-
-        def visit_fn(
-            node: MathExpression, depth: int, data: Any
-        ) -> Optional[VisitStop]:
+        for node in self.iter_inorder():
             node.classes = []
-            return None
-
-        self.visit_inorder(visit_fn)
 
     def to_list(self, visit: str = "preorder") -> List["MathExpression"]:
         """Convert this node hierarchy into a list."""
-        results: List[MathExpression] = []
-
-        def visit_fn(
-            node: MathExpression, depth: int, data: Any
-        ) -> Optional[VisitStop]:
-            results.append(node)
-            return None
-
         if visit == "inorder":
-            self.visit_inorder(visit_fn)
+            return list(self.iter_inorder())
         elif visit == "preorder":
-            self.visit_preorder(visit_fn)
+            return list(self.iter_preorder())
         elif visit == "postorder":
-            self.visit_postorder(visit_fn)
-        else:
-            raise ValueError(f"invalid visit order: {visit}")
-        return results
+            return list(self.iter_postorder())
+        raise ValueError(f"invalid visit order: {visit}")
+
+    @property
+    def size(self) -> int:
+        """The number of nodes in this subtree"""
+        return self._metrics().size
+
+    @property
+    def height(self) -> int:
+        """The number of edges on the longest path from this node down to a leaf,
+        which is 0 for a leaf"""
+        return self._metrics().height
+
+    @property
+    def variables(self) -> FrozenSet[str]:
+        """The names of the variables in this subtree. Unless the subtree metrics
+        are cached, they are collected with a walk that caches nothing, which is
+        cheaper than computing the metrics for trees that are only checked once."""
+        metrics: Optional[_SubtreeMetrics] = self._get_cache("metrics")
+        if metrics is not None:
+            return metrics.variables
+        names: Set[str] = set()
+        stack: List[MathExpression] = [self]
+        while stack:
+            node = stack.pop()
+            left, right = node.left, node.right
+            if left is None and right is None:
+                if isinstance(node, VariableExpression):
+                    if node._identifier is not None:
+                        names.add(node._identifier)
+                continue
+            if left is not None:
+                stack.append(left)
+            if right is not None:
+                stack.append(right)
+        return frozenset(names)
+
+    def contains(self, instanceType: Type["MathExpression"]) -> bool:
+        """Return True if this subtree has a node of the given type. This is the
+        same as `len(node.find_type(instanceType)) > 0`, without building a list.
+
+        The walk stops at the first match, and uses the node types of subtrees
+        whose metrics are already cached instead of visiting their nodes."""
+        stack: List[MathExpression] = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, instanceType):
+                return True
+            cache = node._cache
+            if cache is not None and "metrics" in cache:
+                if _types_include(cache["metrics"].types, instanceType):
+                    return True
+                continue
+            if node.left is not None:
+                stack.append(node.left)
+            if node.right is not None:
+                stack.append(node.right)
+        return False
+
+    def _metrics(self) -> _SubtreeMetrics:
+        """Return the size, height, node types, and variables of this subtree.
+
+        They are cached on this node until its subtree changes, but not on the
+        nodes below it, which would make every node several times larger. The
+        metrics cached on descendants by earlier queries are reused."""
+        metrics: Optional[_SubtreeMetrics] = self._get_cache("metrics")
+        if metrics is not None:
+            return metrics
+        computed: Dict[int, _SubtreeMetrics] = {}
+        for node in self._uncached_nodes("metrics"):
+            left, right = node.left, node.right
+            if left is None and right is None:
+                identifier: Optional[str] = None
+                if isinstance(node, VariableExpression):
+                    identifier = node.identifier
+                key = (type(node), identifier)
+                metrics = _leaf_metrics.get(key)
+                if metrics is None:
+                    variables = _no_variables
+                    if identifier is not None:
+                        variables = frozenset([identifier])
+                    metrics = _SubtreeMetrics(1, 0, frozenset([type(node)]), variables)
+                    _leaf_metrics[key] = metrics
+            else:
+                children = [
+                    computed.get(id(child)) or child._cache["metrics"]  # type:ignore
+                    for child in (left, right)
+                    if child is not None
+                ]
+                first = children[0]
+                last = children[-1]
+                types = _union(first.types, last.types)
+                if type(node) not in types:
+                    types = types | {type(node)}
+                metrics = _SubtreeMetrics(
+                    sum(c.size for c in children) + 1,
+                    max(first.height, last.height) + 1,
+                    types,
+                    _union(first.variables, last.variables),
+                )
+            computed[id(node)] = metrics
+        assert metrics is not None
+        self._set_cache("metrics", metrics)
+        return metrics
+
+    def structural_hash(self) -> int:
+        """Return a hash of the structure and values of this subtree, which is the
+        same for all trees with the same node types and values, whatever their
+        node ids.
+
+        The hash is cached on each node of the subtree until it changes. Like
+        other Python hashes, it is only stable within a process."""
+        cached: Optional[int] = self._get_cache("hash")
+        if cached is not None:
+            return cached
+        for node in self._uncached_nodes("hash"):
+            left, right = node.left, node.right
+            key = (
+                type(node),
+                node._hash_payload(),
+                None if left is None else left._cache["hash"],  # type:ignore
+                None if right is None else right._cache["hash"],  # type:ignore
+            )
+            node._set_cache_above("hash", hash(key))
+        return self._get_cache("hash")
+
+    def structurally_equal(self, other: "MathExpression") -> bool:
+        """Return True if this subtree and `other` have the same structure and
+        values, ignoring node ids. Trees with different structural hashes are
+        rejected without walking them."""
+        if self is other:
+            return True
+        if self.structural_hash() != other.structural_hash():
+            return False
+        stack: List[Tuple[MathExpression, MathExpression]] = [(self, other)]
+        while stack:
+            one, two = stack.pop()
+            if one is two:
+                continue
+            if type(one) is not type(two):
+                return False
+            if one._hash_payload() != two._hash_payload():
+                return False
+            for a, b in ((one.left, two.left), (one.right, two.right)):
+                if a is None or b is None:
+                    if a is not b:
+                        return False
+                else:
+                    stack.append((a, b))
+        return True
+
+    def _hash_payload(self) -> Any:
+        """The value of this node, besides its type and children, that its
+        structural hash depends on."""
+        return None
 
     def find_type(self, instanceType: Type[NodeType]) -> List[NodeType]:
         """Find an expression in this tree by type.
@@ -171,37 +617,43 @@ class MathExpression(BinaryTreeNode["MathExpression"]):
         - instanceType: The type to check for instances of
 
         Returns the found #MathExpression objects of the given type.
-        """
-        results: List[NodeType] = []
-
-        def visit_fn(
-            node: MathExpression, depth: int, data: Any
-        ) -> Optional[VisitStop]:
-            if isinstance(node, instanceType):
-                results.append(node)  # type:ignore
-            return None
 
-        self.visit_inorder(visit_fn)
-        return results
+        The first query on a tree walks the subtree. Later queries build an index
+        of the whole tree on its root, so that repeated queries on any of its
+        subtrees become lookups until the tree is changed.
+        """
+        root = self.get_root()
+        index: Optional[_TypeIndex] = root._get_cache("type_index")
+        if index is None:
+            if not root._get_cache("type_queried", False):
+                root._set_cache("type_queried", True)
+                return [
+                    node  # type:ignore
+                    for node in self.iter_inorder()
+                    if isinstance(node, instanceType)
+                ]
+            index = _TypeIndex(root)
+            root._set_cache("type_index", index)
+        found = index.find(self, instanceType)
+        if found is None:
+            return [
+                node  # type:ignore
+                for node in self.iter_inorder()
+                if isinstance(node, instanceType)
+            ]
+        return found
 
-    def find_id(self, id: str) -> Optional["MathExpression"]:
-        """Find an expression by its unique ID.
+    def find_id(self, id: NodeId) -> Optional["MathExpression"]:
+        """Find an expression by its unique ID, either the "mn-N" string or the
+        number N.
 
         Returns: The found #MathExpression or `None`
         """
-        result: Optional[MathExpression] = None
-
-        def visit_fn(
-            node: MathExpression, depth: int, data: Any
-        ) -> Optional[VisitStop]:
-            nonlocal result
-            if node.id == id:
-                result = node
-                return STOP
-            return None
-
-        self.visit_inorder(visit_fn)
-        return result
+        key = _parse_id(id)
+        for node in self.iter_inorder():
+            if node._id == key:
+                return node
+        return None
 
     def to_math_ml_fragment(self) -> str:
         """Convert this single node into MathML."""
@@ -263,45 +715,54 @@ class MathExpression(BinaryTreeNode["MathExpression"]):
         (MathExpression): The cloned node.
         """
         node = node if node is not None else self
-        self.cloned_node = None
-        self.cloned_target = node.path_to_root()
-        result = node.get_root().clone()
-        if not self.cloned_node:  # pragma: nocover
-            print("While cloning root of: {}".format(node))
-            print(" Which is this       : {}".format(node.get_root()))
-            print("Did not set the clone: {}".format(self.cloned_node))
-            raise Exception("cloning root hierarchy did not clone this node")
-
-        result = self.cloned_node
-        self.cloned_node = None
-        self.cloned_target = None
+        # Follow the sides from the root down to the node in the cloned tree
+        sides: List[str] = []
+        current = node
+        while current.parent is not None:
+            sides.append(LEFT if current.parent.left is current else RIGHT)
+            current = current.parent
+        result = current.clone()
+        for side in reversed(sides):
+            child = result.left if side == LEFT else result.right
+            assert child is not None, "cloned tree does not match the original"
+            result = child
         return result
 
-    def clone(self) -> "MathExpression":  # type:ignore[override]
-        """A specialization of the clone method that can track and report a cloned
-        subtree node.
-
-        See #MathExpression.clone_from_root for more details."""
-        result = cast(MathExpression, super().clone())
-        if self.cloned_target is not None and self.path_to_root() == self.cloned_target:
-            self.cloned_node = result
-
+    def _copy_node(self) -> "MathExpression":
+        result = super()._copy_node()
+        result._changed = False
+        result._span_start = self._span_start
+        result._span_end = self._span_end
         return result
 
 
 class UnaryExpression(MathExpression):
     """An expression that operates on one sub-expression"""
 
+    __slots__ = ("child_on_left",)
+
     child_on_left: bool
 
     def __init__(
         self, child: Optional[MathExpression] = None, child_on_left: bool = False
     ):
         super().__init__()
-        self.child = child
         self.child_on_left = child_on_left
         self.set_child(child)
 
+    @property
+    def child(self) -> Optional[MathExpression]:
+        return self.get_child()
+
+    @child.setter
+    def child(self, child: Optional[MathExpression]) -> None:
+        self.set_child(child)
+
+    def _copy_node(self) -> "UnaryExpression":
+        result = cast(UnaryExpression, super()._copy_node())
+        result.child_on_left = self.child_on_left
+        return result
+
     def set_child(self, child: Optional[MathExpression] = None) -> MathExpression:
         if self.child_on_left:
             return self.set_left(child)  # type:ignore
@@ -314,7 +775,14 @@ class UnaryExpression(MathExpression):
         else:
             return self.right
 
-    def evaluate(self, context: Optional[Dict[str, NumberType]] = None) -> float:
+    def evaluate(
+        self,
+        context: Optional[Dict[str, NumberType]] = None,
+        exact_numbers: Optional[bool] = None,
+    ) -> NumberType:
+        if exact_numbers is not None and exact_numbers is not _exact_numbers.get():
+            with use_exact_numbers(exact_numbers):
+                return self.evaluate(context)
         child = self.get_child()
         if child is None:
             raise ValueError("cannot evaluate unary expression without a valid child")
@@ -330,6 +798,8 @@ class UnaryExpression(MathExpression):
 class NegateExpression(UnaryExpression):
     """Negate an expression, e.g. `4` becomes `-4`"""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["negate"]
@@ -359,6 +829,8 @@ class NegateExpression(UnaryExpression):
 class FactorialExpression(UnaryExpression):
     """Factorial of a constant, e.g. `5` evaluates to `120`"""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["factorial"]
@@ -385,6 +857,8 @@ class FunctionExpression(UnaryExpression):
     text (used by the parser and tokenizer) is derived from the name() method on the
     class."""
 
+    __slots__ = ()
+
     @property
     def name(self) -> str:
         raise NotImplementedError(
@@ -405,6 +879,8 @@ class FunctionExpression(UnaryExpression):
 class BinaryExpression(MathExpression):
     """An expression that operates on two sub-expressions"""
 
+    __slots__ = ()
+
     def __init__(
         self,
         left: Optional[MathExpression] = None,
@@ -412,7 +888,14 @@ class BinaryExpression(MathExpression):
     ):
         super().__init__(left=left, right=right)
 
-    def evaluate(self, context: Optional[Dict[str, NumberType]] = None) -> NumberType:
+    def evaluate(
+        self,
+        context: Optional[Dict[str, NumberType]] = None,
+        exact_numbers: Optional[bool] = None,
+    ) -> NumberType:
+        if exact_numbers is not None and exact_numbers is not _exact_numbers.get():
+            with use_exact_numbers(exact_numbers):
+                return self.evaluate(context)
         left, right = self._check()
         return self.operate(left.evaluate(context), right.evaluate(context))
 
@@ -441,6 +924,13 @@ class BinaryExpression(MathExpression):
         with respect to another node, i.e. the other node must be resolved
         first during evaluation because of it's priority.
         """
+        node_type = type(self)
+        priority = _priorities.get(node_type)
+        if priority is None:
+            priority = _priorities[node_type] = self._type_priority()
+        return priority
+
+    def _type_priority(self) -> int:
         priority = OOO_INVALID
         if isinstance(self, EqualExpression):
             priority = OOO_INVALID
@@ -464,37 +954,60 @@ class BinaryExpression(MathExpression):
         """Return a boolean indicating whether this node should render itself with
         a set of enclosing parnetheses or not. This is used when serializing an
         expression, to ensure the tree maintains the proper order of operations. """
-        binary_parent = cast(BinaryExpression, self.parent)
-        parent_is_binary = isinstance(binary_parent, BinaryExpression)
-        if not parent_is_binary or not binary_parent:
+        parent = self.parent
+        if not isinstance(parent, BinaryExpression):
             return False
+        return self._parens_in(parent, parent.get_side(self))
 
+    def _parens_in(self, parent: "BinaryExpression", side: str) -> bool:
+        """Return True if this node needs parentheses as the `side` child of
+        `parent`. Parents render their children with this instead of reading the
+        child's `parent` link, because interned subtrees are shared between trees
+        and have no parent."""
         self_pri = self.get_priority()
-        parent_pri = binary_parent.get_priority()
+        parent_pri = parent.get_priority()
         if parent_pri > self_pri:
             return True
-
-        parent_side = binary_parent.get_side(self)
-        # If we're a left child of a parent
+        # Keep a - (b + c) from rendering as a - b + c
         if parent_pri == self_pri:
             self_addsub = isinstance(self, (AddExpression, SubtractExpression))
-            parent_addsub = isinstance(self.parent, (AddExpression, SubtractExpression))
-            if parent_side == "right" and self_addsub and parent_addsub:
+            parent_addsub = isinstance(parent, (AddExpression, SubtractExpression))
+            if side == "right" and self_addsub and parent_addsub:
                 return True
         return False
 
-    def __str__(self) -> str:
+    def _child_text(self, child: MathExpression, side: str) -> str:
+        """Render a child of this node, in parentheses where it needs them"""
+        if isinstance(child, BinaryExpression):
+            text = child._text()
+            return f"({text})" if child._parens_in(self, side) else text
+        return str(child)
+
+    def _text(self) -> str:
+        """Render this node without its own enclosing parentheses"""
         left, right = self._check()
-        out = f"{left} {self.with_color(self.name)} {right}"
+        left_text = self._child_text(left, "left")
+        right_text = self._child_text(right, "right")
+        return f"{left_text} {self.with_color(self.name)} {right_text}"
+
+    def __str__(self) -> str:
+        out = self._text()
         return f"({out})" if self.self_parens() else out
 
-    def to_math_ml_fragment(self) -> str:
-        """Render this node as a MathML element fragment"""
+    def _child_math_ml(self, child: MathExpression, side: str) -> str:
+        """Render a child of this node as MathML, in parentheses where it needs
+        them"""
+        if isinstance(child, BinaryExpression):
+            return child._math_ml(child._parens_in(self, side))
+        return child.to_math_ml_fragment()
+
+    def _math_ml(self, parens: bool) -> str:
+        """Render this node as MathML, with enclosing parentheses if `parens`"""
         right, left = self._check()
-        right_ml = right.to_math_ml_fragment()
-        left_ml = left.to_math_ml_fragment()
+        right_ml = self._child_math_ml(right, "left")
+        left_ml = self._child_math_ml(left, "right")
         op_ml = self.make_ml_tag("mo", self.get_ml_name())
-        if self.self_parens():
+        if parens:
             return self.make_ml_tag(
                 "mrow",
                 "<mo>(</mo>{}{}{}<mo>)</mo>".format(left_ml, op_ml, right_ml),
@@ -504,10 +1017,17 @@ class BinaryExpression(MathExpression):
             "mrow", "{}{}{}".format(left_ml, op_ml, right_ml), self.classes
         )
 
+    def to_math_ml_fragment(self) -> str:
+        """Render this node as a MathML element fragment"""
+        self._check()
+        return self._math_ml(self.self_parens())
+
 
 class EqualExpression(BinaryExpression):
     """Evaluate equality of two expressions"""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["equal"]
@@ -531,6 +1051,8 @@ class EqualExpression(BinaryExpression):
 class AddExpression(BinaryExpression):
     """Add one and two"""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["add"]
@@ -546,6 +1068,8 @@ class AddExpression(BinaryExpression):
 class SubtractExpression(BinaryExpression):
     """Subtract one from two"""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["subtract"]
@@ -561,6 +1085,8 @@ class SubtractExpression(BinaryExpression):
 class MultiplyExpression(BinaryExpression):
     """Multiply one and two"""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["multiply"]
@@ -575,7 +1101,7 @@ class MultiplyExpression(BinaryExpression):
     def operate(self, one: NumberType, two: NumberType) -> NumberType:
         return one * two
 
-    def __str__(self) -> str:
+    def _text(self) -> str:
         """Multiplication special cases constant*variable to output `4x` instead of
         `4 * x`"""
         left, right = self._check()
@@ -587,22 +1113,25 @@ class MultiplyExpression(BinaryExpression):
                 right.left, VariableExpression
             )
             if one or two:
-                return self.with_color(f"{left}{right}")
-        return super().__str__()
+                right_text = self._child_text(right, "right")
+                return self.with_color(f"{left}{right_text}")
+        return super()._text()
 
-    def to_math_ml_fragment(self) -> str:
+    def _math_ml(self, parens: bool) -> str:
         left, right = self._check()
-        right_ml = right.to_math_ml_fragment()
-        left_ml = left.to_math_ml_fragment()
         if isinstance(left, ConstantExpression):
             if isinstance(right, (VariableExpression, PowerExpression)):
+                left_ml = left.to_math_ml_fragment()
+                right_ml = self._child_math_ml(right, "right")
                 return f"{left_ml}{right_ml}"
-        return super().to_math_ml_fragment()
+        return super()._math_ml(parens)
 
 
 class DivideExpression(BinaryExpression):
     """Divide one by two"""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["divide"]
@@ -614,22 +1143,85 @@ class DivideExpression(BinaryExpression):
     def get_ml_name(self) -> str:
         return "&#247;"
 
-    def to_math_ml_fragment(self) -> str:
+    def _math_ml(self, parens: bool) -> str:
         left, right = self._check()
-        left_ml = left.to_math_ml_fragment()
-        right_ml = right.to_math_ml_fragment()
+        left_ml = self._child_math_ml(left, "left")
+        right_ml = self._child_math_ml(right, "right")
         return f"<mfrac><mi>{left_ml}</mi><mi>{right_ml}</mi></mfrac>"
 
     def operate(self, one: NumberType, two: NumberType) -> NumberType:
         if two == 0:
             return float("nan")
+        elif _exact_numbers.get():
+            return _exact_divide(one, two)
         else:
             return one / two
 
 
+# Powers of ints and fractions that would have more bits than this are computed
+# with floats, so that huge exponents do not build enormous ints
+_MAX_POWER_BITS = 1024
+# Exact powers are never rounded, but ones this large would take too long
+_MAX_EXACT_POWER_BITS = 1 << 20
+
+
+def _infinite_power(one: NumberType, two: NumberType) -> float:
+    # Odd powers keep the sign of the base, e.g. (-10.0)^401 and (-0.0)^-1
+    if two % 2 != 1:
+        return math.inf
+    if isinstance(one, float):
+        return math.copysign(math.inf, one)
+    # Ints and fractions may be too large to convert to a float
+    return -math.inf if one < 0 else math.inf
+
+
+def _scalar_power(one: NumberType, two: NumberType, exact: bool = False) -> NumberType:
+    """Raise one to the power of two with Python numbers. Results too large for a
+    float are inf, as is zero to a negative power, and fractional powers of
+    negative numbers, which would be complex, are NaN. When `exact`, ints and
+    fractions to int powers are not rounded, and raise OverflowError if they are
+    too large to compute instead of becoming inf."""
+    # A lower bound on the bits of the result, which is cheap to compute
+    bits = 0
+    if type(two) is int and two != 0:
+        if type(one) is int:
+            bits = abs(two) * (one.bit_length() - 1)
+        elif type(one) is Fraction:
+            size = max(one.numerator.bit_length(), one.denominator.bit_length())
+            bits = abs(two) * (size - 1)
+        if exact and bits > _MAX_EXACT_POWER_BITS:
+            raise OverflowError(f"exact power has too many bits to compute: {bits}")
+    try:
+        if bits > _MAX_POWER_BITS and not exact:
+            one = float(one)
+        elif exact and two < 0 and type(one) is int and one != 0:
+            return _whole_fraction(Fraction(1, one ** -two))  # type:ignore
+        result = one ** two
+    except (OverflowError, ZeroDivisionError):
+        return _infinite_power(one, two)
+    if bits * 2 > _MAX_POWER_BITS and not exact:
+        # The estimate is a lower bound, and results can have up to twice as many
+        # bits, which may be too large to convert to a float later
+        try:
+            float(result)
+        except OverflowError:
+            return _infinite_power(one, two)
+    if type(result) is Fraction:
+        return _whole_fraction(result)
+    if isinstance(result, complex):
+        return math.nan
+    return result
+
+
+def _exact_power(one: NumberType, two: NumberType) -> NumberType:
+    return _scalar_power(one, two, True)
+
+
 class PowerExpression(BinaryExpression):
     """Raise one to the power of two"""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["power"]
@@ -638,10 +1230,10 @@ class PowerExpression(BinaryExpression):
     def name(self) -> str:
         return "^"
 
-    def to_math_ml_fragment(self) -> str:
+    def _math_ml(self, parens: bool) -> str:
         left, right = self._check()
-        right_ml = right.to_math_ml_fragment()
-        left_ml = left.to_math_ml_fragment()
+        right_ml = self._child_math_ml(right, "right")
+        left_ml = self._child_math_ml(left, "left")
         # if left is mult, enclose only right in msup
         if isinstance(self.left, MultiplyExpression):
             left_ml = self.make_ml_tag("mrow", left_ml, self.classes)
@@ -649,20 +1241,59 @@ class PowerExpression(BinaryExpression):
         return self.make_ml_tag("msup", "{}{}".format(left_ml, right_ml), self.classes)
 
     def operate(self, one: NumberType, two: NumberType) -> NumberType:
-        return np.power(one, two)
+        return _scalar_power(one, two, _exact_numbers.get())
+
+    def _text(self) -> str:
+        left, right = self._check()
+        left_text = self._child_text(left, "left")
+        right_text = self._child_text(right, "right")
+        return "{}{}{}".format(left_text, self.with_color(self.name), right_text)
 
     def __str__(self) -> str:
-        return "{}{}{}".format(self.left, self.with_color(self.name), self.right)
+        return self._text()
+
+
+def _fraction_text(value: Fraction) -> str:
+    """Return the exact decimal text of a fraction, e.g. "0.375", or when it has
+    no decimal, its text as a division in parentheses, e.g. "(1/3)" """
+    # Fractions have a decimal when their denominator only has factors of 2 and 5
+    rest = value.denominator
+    twos = fives = 0
+    while rest % 2 == 0:
+        rest //= 2
+        twos += 1
+    while rest % 5 == 0:
+        rest //= 5
+        fives += 1
+    if rest != 1:
+        return f"({value.numerator}/{value.denominator})"
+    places = max(twos, fives)
+    digits = str(abs(value.numerator) * 10 ** places // value.denominator)
+    digits = digits.rjust(places + 1, "0")
+    sign = "-" if value < 0 else ""
+    return f"{sign}{digits[:-places]}.{digits[-places:]}"
 
 
 class ConstantExpression(MathExpression):
     """A Constant value node, where the value is accessible as `node.value`"""
 
-    value: Optional[NumberType]
+    __slots__ = ("_value",)
+
+    _value: Optional[NumberType]
 
     def __init__(self, value: Optional[NumberType] = None):
         super().__init__()
-        self.value = value
+        self._value = value
+
+    @property
+    def value(self) -> Optional[NumberType]:
+        return self._value
+
+    @value.setter
+    def value(self, value: Optional[NumberType]) -> None:
+        self._value = value
+        # Cached data like the structural hash depends on the value
+        self.invalidate()
 
     @property
     def type_id(self) -> int:
@@ -672,16 +1303,25 @@ class ConstantExpression(MathExpression):
     def name(self) -> str:
         if self.value is not None and self.value % 1 == 0:
             return f"{int(self.value)}"
+        if isinstance(self.value, Fraction):
+            return _fraction_text(self.value)
         # TODO: floating point values here should have some consistency
         #       across languages. HOW?
         return np.format_float_positional(self.value or 0, trim="-")
 
-    def clone(self) -> "ConstantExpression":  # type:ignore[override]
-        result = cast(ConstantExpression, super().clone())
-        result.value = self.value
-        return result  # type:ignore
+    def _copy_node(self) -> "ConstantExpression":
+        result = cast(ConstantExpression, super()._copy_node())
+        result._value = self._value
+        return result
+
+    def _hash_payload(self) -> Any:
+        return self._value
 
-    def evaluate(self, context: Optional[Dict[str, NumberType]] = None) -> NumberType:
+    def evaluate(
+        self,
+        context: Optional[Dict[str, NumberType]] = None,
+        exact_numbers: Optional[bool] = None,
+    ) -> NumberType:
         assert self.value is not None
         return self.value
 
@@ -693,7 +1333,19 @@ class ConstantExpression(MathExpression):
 
 
 class VariableExpression(MathExpression):
-    identifier: Optional[str]
+    __slots__ = ("_identifier",)
+
+    _identifier: Optional[str]
+
+    @property
+    def identifier(self) -> Optional[str]:
+        return self._identifier
+
+    @identifier.setter
+    def identifier(self, identifier: Optional[str]) -> None:
+        self._identifier = identifier
+        # Cached data like the variable set depends on the identifier
+        self.invalidate()
 
     @property
     def name(self) -> str:
@@ -706,13 +1358,16 @@ class VariableExpression(MathExpression):
 
     def __init__(self, identifier: Optional[str] = None, **kwargs: Any):
         super().__init__(**kwargs)
-        self.identifier = identifier
+        self._identifier = identifier
 
-    def clone(self) -> "VariableExpression":  # type:ignore[override]
-        result = cast(VariableExpression, super().clone())
-        result.identifier = self.identifier
+    def _copy_node(self) -> "VariableExpression":
+        result = cast(VariableExpression, super()._copy_node())
+        result._identifier = self._identifier
         return result
 
+    def _hash_payload(self) -> Any:
+        return self._identifier
+
     def _check(self) -> None:
         if self.identifier is None:
             raise ValueError("identifier must be a letter")
@@ -725,7 +1380,11 @@ class VariableExpression(MathExpression):
         self._check()
         return self.make_ml_tag("mi", str(self.identifier), self.classes)
 
-    def evaluate(self, context: Optional[Dict[str, NumberType]] = None) -> NumberType:
+    def evaluate(
+        self,
+        context: Optional[Dict[str, NumberType]] = None,
+        exact_numbers: Optional[bool] = None,
+    ) -> NumberType:
         self._check()
         id = cast(str, self.identifier)
         if context and context.get(id, None) is not None:
@@ -739,6 +1398,8 @@ class VariableExpression(MathExpression):
 class AbsExpression(FunctionExpression):
     """Evaluates the absolute value of an expression."""
 
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["abs"]
@@ -748,10 +1409,12 @@ class AbsExpression(FunctionExpression):
         return "abs"
 
     def operate(self, value: NumberType) -> NumberType:
-        return np.absolute(value)
+        return abs(value)
 
 
 class SgnExpression(FunctionExpression):
+    __slots__ = ()
+
     @property
     def type_id(self) -> int:
         return MathTypeKeys["sgn"]
@@ -774,7 +1437,432 @@ class SgnExpression(FunctionExpression):
         return 0
 
 
+# ## Compiling
+
+
+def _equal_arrays(one: np.ndarray, two: np.ndarray) -> np.ndarray:
+    # Match EqualExpression, reporting the first point where the sides differ
+    if np.any(one != two):
+        one, two = np.broadcast_arrays(one, two)
+        i = int(np.argmax(one != two))
+        raise ValueError(
+            "Equation did not hold when evaluated: "
+            f"left({one.flat[i]}) != right({two.flat[i]})"
+        )
+    return one
+
+
+# The array operations are called with NumPy's floating point warnings turned off,
+# since NaN and inf values are expected results, e.g. of division by zero.
+
+
+def _divide_arrays(one: np.ndarray, two: np.ndarray) -> np.ndarray:
+    # Match DivideExpression, which evaluates division by zero to NaN
+    zero = two == 0
+    return np.where(zero, np.nan, one / np.where(zero, 1, two))
+
+
+def _power_arrays(one: np.ndarray, two: np.ndarray) -> np.ndarray:
+    # Powers of floats, so that negative exponents work, fractional powers of
+    # negative numbers are NaN, and overflows are inf
+    return np.power(np.asarray(one, dtype=np.float64), two)
+
+
+_factorials = np.array([math.factorial(i) for i in range(171)], dtype=np.float64)
+
+
+def _factorial_arrays(value: np.ndarray) -> np.ndarray:
+    # The factorial of the whole part, like FactorialExpression. Negative and NaN
+    # values are NaN rather than errors, and values too large for floats are inf.
+    whole = np.trunc(value)
+    valid = (whole >= 0) & (whole < len(_factorials))
+    result = _factorials[np.where(valid, whole, 0).astype(np.intp)]
+    return np.where(valid, result, np.where(whole > 0, np.inf, np.nan))
+
+
+# The array versions of the operations of the built-in types, by their exact type,
+# for evaluating an expression with arrays of variable values. Subclasses may
+# override `operate`, so they are not included.
+_array_operations: Dict[type, Callable[..., Any]] = {
+    NegateExpression: np.negative,
+    FactorialExpression: _factorial_arrays,
+    AbsExpression: np.absolute,
+    SgnExpression: np.sign,
+    EqualExpression: _equal_arrays,
+    AddExpression: np.add,
+    SubtractExpression: np.subtract,
+    MultiplyExpression: np.multiply,
+    DivideExpression: _divide_arrays,
+    PowerExpression: _power_arrays,
+}
+
+
+def _node_operation(
+    node: MathExpression, arrays: bool
+) -> Optional[Callable[..., Any]]:
+    """Return the function that computes the value of a unary or binary node from
+    the values of its children, or None if the node has to evaluate itself, e.g.
+    because it is a leaf, is missing a child, or overrides `evaluate`."""
+    node_type = type(node)
+    if isinstance(node, UnaryExpression):
+        if node.get_child() is None:
+            return None
+        base: Callable[..., Any] = UnaryExpression.evaluate
+    elif isinstance(node, BinaryExpression):
+        if node.left is None or node.right is None:
+            return None
+        base = BinaryExpression.evaluate
+    else:
+        return None
+    if arrays and node_type in _array_operations:
+        return _array_operations[node_type]
+    if node_type.evaluate is not base:
+        return None
+    if arrays:
+        return np.vectorize(node.operate, otypes=[np.float64])
+    return node.operate
+
+
+def _is_value_leaf(node: MathExpression) -> bool:
+    """Return True for constants and variables that evaluate the usual way"""
+    if isinstance(node, ConstantExpression):
+        return type(node).evaluate is ConstantExpression.evaluate
+    if isinstance(node, VariableExpression):
+        return type(node).evaluate is VariableExpression.evaluate
+    return False
+
+
+def _evaluate_points(node: MathExpression, context: Dict[str, np.ndarray]) -> Any:
+    """Evaluate a node that has no array version one point at a time"""
+    names = list(context)
+    arrays = np.broadcast_arrays(*context.values()) if names else []
+    shape = arrays[0].shape if names else ()
+    result = np.empty(shape, dtype=np.float64)
+    for index in np.ndindex(shape):
+        result[index] = node.evaluate(
+            {name: float(array[index]) for name, array in zip(names, arrays)}
+        )
+    return result
+
+
+def _evaluate_arrays(expression: MathExpression, context: Dict[str, np.ndarray]) -> Any:
+    """Evaluate an expression with arrays of variable values by walking the tree,
+    which is faster than compiling it when it is only evaluated a few times.
+
+    The nodes without a cache are marked like `_set_cache` marks them, so that
+    caching the walk count on the expression afterwards is cheap."""
+    values: Dict[int, Any] = {}
+    # The nodes to visit, with their operation once their children are pushed
+    stack: List[Tuple[MathExpression, Optional[Callable[..., Any]]]] = [
+        (expression, None)
+    ]
+    while stack:
+        node, operation = stack.pop()
+        left, right = node.left, node.right
+        if operation is not None:
+            if left is None:
+                values[id(node)] = operation(values[id(right)])
+            elif right is None:
+                values[id(node)] = operation(values[id(left)])
+            else:
+                values[id(node)] = operation(values[id(left)], values[id(right)])
+            # Mark the node once its whole subtree is marked, so that the marks
+            # stay valid if a later node raises an error
+            if node._cache is None:
+                if (left is None or left._cache is not None) and (
+                    right is None or right._cache is not None
+                ):
+                    node._cache = _EMPTY_CACHE
+            continue
+        node_type = type(node)
+        if node_type is VariableExpression:
+            value = context.get(node._identifier)  # type:ignore
+            # Let the node raise the usual errors for missing values
+            if value is None:
+                node.evaluate(context)  # type:ignore
+            values[id(node)] = value
+            if node._cache is None:
+                node._cache = _EMPTY_CACHE
+            continue
+        if node_type is ConstantExpression and node._value is not None:  # type:ignore
+            # Constants are floats, so that integer math cannot overflow
+            values[id(node)] = np.float64(node._value)  # type:ignore
+            if node._cache is None:
+                node._cache = _EMPTY_CACHE
+            continue
+        operation = _node_operation(node, True)
+        if operation is not None:
+            stack.append((node, operation))
+            if right is not None:
+                stack.append((right, None))
+            if left is not None:
+                stack.append((left, None))
+        elif _is_value_leaf(node):
+            # Constants are floats, so that integer math cannot overflow
+            values[id(node)] = np.float64(node.evaluate(context))  # type:ignore
+        else:
+            values[id(node)] = _evaluate_points(node, context)
+    return values[id(expression)]
+
+
+# Trees with fewer nodes than this are evaluated by `evaluate_cached` without
+# caching, because walking the cached values costs more than evaluating them
+_MIN_CACHED_EVALUATE_NODES = 64
+
+
+def _cache_small_tree(expression: MathExpression) -> bool:
+    """Return True if a tree has fewer than `_MIN_CACHED_EVALUATE_NODES` nodes and
+    no values cached by `evaluate_cached`, and cache that it is small on its root.
+    The walk stops at the threshold or at the first cached value, so it is short
+    for trees with cached values, which only miss them between a change and the
+    root. The nodes of a small tree are marked while they are at hand, instead
+    of walking them again in `_set_cache`."""
+    nodes: List[MathExpression] = []
+    stack: List[MathExpression] = [expression]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node = pop()
+        cache = node._cache
+        if cache is not None and "value" in cache:
+            return False
+        nodes.append(node)
+        if len(nodes) >= _MIN_CACHED_EVALUATE_NODES:
+            return False
+        right = node.right
+        if right is not None:
+            push(right)
+        left = node.left
+        if left is not None:
+            push(left)
+    for node in nodes:
+        if node._cache is None:
+            node._cache = _EMPTY_CACHE
+    expression._set_cache_above("small_tree", True)
+    return True
+
+
+# The most recent key from `_bindings_key`
+_last_bindings_key: Tuple[Any, bool] = (frozenset(), False)
+
+
+def _bindings_key(context: Optional[Dict[str, NumberType]]) -> Tuple[Any, bool]:
+    """Return a key for the values that `evaluate_cached` computes with. Equal
+    keys in a row are the same object, so that most keys compare by identity."""
+    global _last_bindings_key
+    # The types are included because equal values of different types, like 1 and
+    # 1.0, can give results of different types
+    bindings = frozenset(
+        (name, type(value), value) for name, value in (context or {}).items()
+    )
+    key = (bindings, _exact_numbers.get())
+    if key == _last_bindings_key:
+        return _last_bindings_key
+    _last_bindings_key = key
+    return key
+
+
+def _evaluate_cached(
+    expression: MathExpression,
+    context: Optional[Dict[str, NumberType]],
+    key: Tuple[Any, bool],
+) -> Any:
+    """Evaluate an expression by walking the nodes that do not have a value
+    cached for `key`, and cache the values of the inner nodes that are computed"""
+    values: Dict[int, Any] = {}
+    # The nodes to visit, with their operation once their children are pushed.
+    # Children with a cached value are not pushed, so only the nodes between the
+    # changes and the root, and their children, are visited.
+    stack: List[Tuple[MathExpression, Optional[Callable[..., Any]]]] = [
+        (expression, None)
+    ]
+    while stack:
+        node, operation = stack.pop()
+        left, right = node.left, node.right
+        if operation is not None:
+            if left is None:
+                value = operation(values[id(right)])
+            elif right is None:
+                value = operation(values[id(left)])
+            else:
+                value = operation(values[id(left)], values[id(right)])
+            node._set_cache_above("value", (key, value))
+            values[id(node)] = value
+            continue
+        operation = _node_operation(node, False)
+        if operation is not None:
+            stack.append((node, operation))
+            for child in (right, left):
+                if child is None:
+                    continue
+                cache = child._cache
+                child_type = type(child)
+                if child_type is ConstantExpression:
+                    value = child._value  # type:ignore
+                elif child_type is VariableExpression and context:
+                    value = context.get(child._identifier)  # type:ignore
+                else:
+                    value = None
+                if value is not None:
+                    values[id(child)] = value
+                    # Leaves are cheap to evaluate, so their values are not cached,
+                    # but they are marked like cached nodes so that changing them
+                    # invalidates their ancestors
+                    if cache is None:
+                        child._cache = _EMPTY_CACHE
+                    continue
+                if cache is not None:
+                    cached = cache.get("value")
+                    if cached is not None and (cached[0] is key or cached[0] == key):
+                        values[id(child)] = cached[1]
+                        continue
+                stack.append((child, None))
+        elif left is None and right is None:
+            # Other leaves, which are marked like the ones above
+            values[id(node)] = node.evaluate(context)
+            if node._cache is None:
+                node._cache = _EMPTY_CACHE
+        else:
+            values[id(node)] = node.evaluate(context)
+            node._set_cache("value", (key, values[id(node)]))
+    return values[id(expression)]
+
+
+# The source of the scalar operations that are written inline in compiled
+# expressions, by their exact type. Subclasses may override `operate`, so they
+# are not. The other operations are called.
+_compiled_operations: Dict[type, str] = {
+    NegateExpression: "(-{0})",
+    FactorialExpression: "_factorial(int({0}))",
+    AbsExpression: "abs({0})",
+    SgnExpression: "(-1 if {0} < 0 else 1 if {0} > 0 else 0)",
+    AddExpression: "({0} + {1})",
+    SubtractExpression: "({0} - {1})",
+    MultiplyExpression: "({0} * {1})",
+    DivideExpression: "(_nan if {1} == 0 else {0} / {1})",
+    PowerExpression: "_power({0}, {1})",
+}
+# Operations that compile differently with exact numbers
+_compiled_exact_operations: Dict[type, str] = {
+    **_compiled_operations,
+    DivideExpression: "(_nan if {1} == 0 else _divide({0}, {1}))",
+    PowerExpression: "_exact_power({0}, {1})",
+}
+
+
+def _compile_expression(
+    expression: MathExpression, arrays: bool = False, exact_numbers: bool = False
+) -> CompiledExpression:
+    """Generate a function that evaluates `expression` like `evaluate` does, or
+    when `arrays` is True, like `evaluate_batch` does. Each node is computed into
+    its own local on a separate line, so deep trees do not hit the nesting limits
+    of the Python compiler."""
+    namespace: Dict[str, Any] = {
+        "_divide": _exact_divide,
+        "_evaluate_points": _evaluate_points,
+        "_exact_power": _exact_power,
+        "_factorial": math.factorial,
+        "_nan": float("nan"),
+        "_power": _scalar_power,
+    }
+    lines: List[str] = ["def compiled(context=None):"]
+    templates = _compiled_exact_operations if exact_numbers else _compiled_operations
+    # Whether the function calls operations or nodes that read `_exact_numbers`
+    calls_out = False
+    # The local, literal, or bound name holding the value of each compiled node,
+    # by the node's id(). Operations only ever use these as operands.
+    values: Dict[int, str] = {}
+    # The locals holding the value of each variable, which is read on first use
+    variables: Dict[str, str] = {}
+
+    def bind(value: Any) -> str:
+        name = f"_k{len(namespace)}"
+        namespace[name] = value
+        return name
+
+    def assign(node: MathExpression, source: str) -> None:
+        name = f"_t{len(values)}"
+        lines.append(f"    {name} = {source}")
+        values[id(node)] = name
+
+    # The nodes to visit, with their operation once their children are pushed
+    stack: List[Tuple[MathExpression, Optional[Callable[..., Any]]]] = [
+        (expression, None)
+    ]
+    while stack:
+        node, operation = stack.pop()
+        if operation is not None:
+            children = [c for c in (node.left, node.right) if c is not None]
+            operands = [values[id(c)] for c in children]
+            template = None if arrays else templates.get(type(node))
+            if template is not None:
+                assign(node, template.format(*operands))
+            else:
+                assign(node, f"{bind(operation)}({', '.join(operands)})")
+                calls_out = True
+            continue
+        operation = _node_operation(node, arrays)
+        if operation is not None:
+            stack.append((node, operation))
+            stack.extend((c, None) for c in (node.right, node.left) if c is not None)
+        elif (
+            _is_value_leaf(node)
+            and isinstance(node, ConstantExpression)
+            and node.value is not None
+        ):
+            number = node.value
+            if arrays:
+                # Constants are floats, so that integer math cannot overflow
+                values[id(node)] = bind(np.float64(number))
+            elif type(number) in (int, float) and math.isfinite(number):
+                values[id(node)] = repr(number)
+            else:
+                values[id(node)] = bind(number)
+        elif (
+            _is_value_leaf(node)
+            and isinstance(node, VariableExpression)
+            and node.identifier is not None
+        ):
+            identifier = node.identifier
+            if identifier not in variables:
+                name = variables[identifier] = f"_v{len(variables)}"
+                message = f"cannot evaluate statement with None variable: {identifier}"
+                read = f"context.get({identifier!r}) if context else None"
+                lines.append(f"    {name} = {read}")
+                lines.append(f"    if {name} is None: raise ValueError({message!r})")
+            values[id(node)] = variables[identifier]
+        elif arrays:
+            # Other nodes, including invalid ones, evaluate themselves when called
+            assign(node, f"_evaluate_points({bind(node)}, context)")
+        else:
+            assign(node, f"{bind(node)}.evaluate(context)")
+            calls_out = True
+    lines.append(f"    return {values[id(expression)]}")
+    exec(compile("\n".join(lines), "<compiled expression>", "exec"), namespace)
+    compiled: CompiledExpression = namespace["compiled"]
+    if calls_out and not arrays:
+        # Evaluate the called nodes the same way, wherever the function is called
+        compiled = _with_exact_numbers(compiled, exact_numbers)
+    return compiled
+
+
+def _with_exact_numbers(
+    function: CompiledExpression, enabled: bool
+) -> CompiledExpression:
+    """Wrap a compiled function to call it with `use_exact_numbers(enabled)`"""
+
+    def compiled(context: Optional[Dict[str, NumberType]] = None) -> NumberType:
+        token = _exact_numbers.set(enabled)
+        try:
+            return function(context)
+        finally:
+            _exact_numbers.reset(token)
+
+    return compiled
+
+
 __all__ = (
+    "CompiledExpression",
     "META",
     "MathTypeKeys",
     "MathTypeKeysMax",
@@ -794,4 +1882,6 @@ __all__ = (
     "VariableExpression",
     "AbsExpression",
     "SgnExpression",
+    "exact_numbers_enabled",
+    "use_exact_numbers",
 )
@@ -0,0 +1,117 @@
+from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar
+
+from .expressions import (
+    BinaryExpression,
+    ConstantExpression,
+    MathExpression,
+    UnaryExpression,
+    VariableExpression,
+)
+from .types import NumberType
+
+ExpressionType = TypeVar("ExpressionType", bound=MathExpression)
+
+
+class ExpressionInterner:
+    """A hash-consing node factory. Structurally equal subtrees that are built or
+    interned by the same interner are the same node object, so two interned trees
+    are equal exactly when they are identical (`one is two`), and the nodes can be
+    used as keys in transposition tables without converting them to strings.
+
+    Interned nodes are shared between every tree that contains them, so they must
+    be treated as immutable, and their `parent` links are always None. They still
+    render with the parentheses they need, which nodes decide for their children.
+    Clone an interned tree to get one that can be changed or used with rules.
+    """
+
+    _nodes: Dict[Tuple[Any, ...], MathExpression]
+
+    def __init__(self) -> None:
+        self._nodes = {}
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def clear(self) -> None:
+        """Forget all interned nodes"""
+        self._nodes.clear()
+
+    def constant(self, value: NumberType) -> ConstantExpression:
+        """Return the shared constant node with the given value"""
+        key = (ConstantExpression, type(value), value, None, None)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = ConstantExpression(value)
+        return node  # type:ignore
+
+    def variable(self, identifier: str) -> VariableExpression:
+        """Return the shared variable node with the given name"""
+        key = (VariableExpression, str, identifier, None, None)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = VariableExpression(identifier)
+        return node  # type:ignore
+
+    def unary(
+        self, node_type: Type[ExpressionType], child: MathExpression
+    ) -> ExpressionType:
+        """Return the shared unary node of the given type over an interned child"""
+        assert issubclass(node_type, UnaryExpression), "expected a unary type"
+        return self._make(node_type, None, child)
+
+    def binary(
+        self,
+        node_type: Type[ExpressionType],
+        left: MathExpression,
+        right: MathExpression,
+    ) -> ExpressionType:
+        """Return the shared binary node of the given type over interned children"""
+        assert issubclass(node_type, BinaryExpression), "expected a binary type"
+        return self._make(node_type, left, right)
+
+    def intern(self, expression: MathExpression) -> MathExpression:
+        """Return the interned tree that is structurally equal to `expression`. The
+        given tree is not changed."""
+        interned: Dict[int, MathExpression] = {}
+        # Intern the nodes bottom-up, so that each node's children are interned first
+        stack: List[Tuple[MathExpression, bool]] = [(expression, False)]
+        while stack:
+            node, expanded = stack.pop()
+            left, right = node.left, node.right
+            if not expanded:
+                stack.append((node, True))
+                for child in (left, right):
+                    if child is not None:
+                        stack.append((child, False))
+                continue
+            left = None if left is None else interned[id(left)]
+            right = None if right is None else interned[id(right)]
+            payload = node._hash_payload()
+            key = (type(node), type(payload), payload, left, right)
+            shared = self._nodes.get(key)
+            if shared is None:
+                shared = node._copy_node()
+                shared.left = left
+                shared.right = right
+                self._nodes[key] = shared
+            interned[id(node)] = shared
+        return interned[id(expression)]
+
+    def _make(
+        self,
+        node_type: Type[ExpressionType],
+        left: Optional[MathExpression],
+        right: Optional[MathExpression],
+    ) -> ExpressionType:
+        key = (node_type, type(None), None, left, right)
+        node = self._nodes.get(key)
+        if node is None:
+            node = node_type()
+            # Set the children without claiming them, since they are shared
+            node.left = left
+            node.right = right
+            self._nodes[key] = node
+        return node  # type:ignore
+
+
+__all__ = ("ExpressionInterner",)
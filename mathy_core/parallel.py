@@ -0,0 +1,261 @@
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
+
+from .expressions import (
+    AbsExpression,
+    AddExpression,
+    ConstantExpression,
+    DivideExpression,
+    EqualExpression,
+    FactorialExpression,
+    MathExpression,
+    MultiplyExpression,
+    NegateExpression,
+    PowerExpression,
+    SgnExpression,
+    SubtractExpression,
+    UnaryExpression,
+    VariableExpression,
+)
+from .parser import ExpressionParser, ParseError, ParserException
+from .tokenizer import Tokenizer
+
+# A compact, picklable form of an expression tree. The bytes hold one type code
+# per node in preorder, and the tuple holds the constant values, variable names,
+# and custom function classes in the order that their nodes appear.
+PackedExpression = Tuple[bytes, Tuple[Any, ...]]
+
+_PACK_TYPES: Tuple[Type[MathExpression], ...] = (
+    ConstantExpression,
+    VariableExpression,
+    AddExpression,
+    SubtractExpression,
+    MultiplyExpression,
+    DivideExpression,
+    PowerExpression,
+    EqualExpression,
+    NegateExpression,
+    FactorialExpression,
+    AbsExpression,
+    SgnExpression,
+)
+_PACK_CODES: Dict[Type[MathExpression], int] = {
+    t: i for i, t in enumerate(_PACK_TYPES)
+}
+_PACK_CONSTANT = _PACK_CODES[ConstantExpression]
+_PACK_VARIABLE = _PACK_CODES[VariableExpression]
+# The class of a unary node that is not in _PACK_TYPES is stored with the values.
+_PACK_CUSTOM_UNARY = 255
+
+
+def pack_expression(expression: MathExpression) -> PackedExpression:
+    """Convert an expression tree into a compact tuple of bytes and values that
+    is much cheaper to pickle than the tree itself. Use `unpack_expression` to
+    rebuild the tree."""
+    codes = bytearray()
+    values: List[Any] = []
+    stack: List[MathExpression] = [expression]
+    while stack:
+        node = stack.pop()
+        node_type = type(node)
+        code = _PACK_CODES.get(node_type)
+        if code is None:
+            if not isinstance(node, UnaryExpression):
+                raise ValueError(f"cannot pack expression of type: {node_type}")
+            code = _PACK_CUSTOM_UNARY
+            values.append(node_type)
+        codes.append(code)
+        if code == _PACK_CONSTANT:
+            values.append(node.value)  # type:ignore
+        elif code == _PACK_VARIABLE:
+            values.append(node.identifier)  # type:ignore
+        elif isinstance(node, UnaryExpression):
+            child = node.get_child()
+            if child is None:
+                raise ValueError("cannot pack unary expression without a child")
+            stack.append(child)
+        else:
+            left, right = node.left, node.right
+            if left is None or right is None:
+                raise ValueError("cannot pack binary expression without children")
+            stack.append(right)
+            stack.append(left)
+    return bytes(codes), tuple(values)
+
+
+def unpack_expression(packed: PackedExpression) -> MathExpression:
+    """Rebuild an expression tree from the output of `pack_expression`"""
+    codes, values = packed
+    value_index = len(values)
+    # Walking the preorder codes backwards visits every node after its children,
+    # with the left child on top of the stack.
+    stack: List[MathExpression] = []
+    for code in reversed(codes):
+        node: MathExpression
+        if code == _PACK_CONSTANT:
+            value_index -= 1
+            node = ConstantExpression(values[value_index])
+        elif code == _PACK_VARIABLE:
+            value_index -= 1
+            node = VariableExpression(values[value_index])
+        elif code == _PACK_CUSTOM_UNARY:
+            child = stack.pop()
+            value_index -= 1
+            node = values[value_index](child)
+        else:
+            node_type = _PACK_TYPES[code]
+            if issubclass(node_type, UnaryExpression):
+                node = node_type(stack.pop())
+            else:
+                left = stack.pop()
+                node = node_type(left, stack.pop())  # type:ignore
+        stack.append(node)
+    assert len(stack) == 1, "invalid packed expression"
+    return stack[0]
+
+
+_worker_parser: Optional[ExpressionParser] = None
+
+
+def _init_worker(tokenizer: Tokenizer, exact_numbers: bool) -> None:
+    global _worker_parser
+    _worker_parser = ExpressionParser(max_cache_entries=0, exact_numbers=exact_numbers)
+    _worker_parser.tokenizer = tokenizer
+
+
+def _parse_chunk(inputs: List[str]) -> List[Union[PackedExpression, ParseError]]:
+    assert _worker_parser is not None, "worker was not initialized"
+    results: List[Union[PackedExpression, ParseError]] = []
+    for result in _worker_parser.parse_many(inputs, collect_errors=True):
+        if isinstance(result, (ParserException, ValueError)):
+            results.append(result)
+        else:
+            results.append(pack_expression(result))
+    return results
+
+
+class ParallelExpressionParser:
+    """Parse large batches of input strings across a pool of worker processes.
+
+    Each worker holds its own `ExpressionParser`, and sends trees back in the
+    compact `pack_expression` form, which are then rebuilt in this process.
+    Rebuilding costs a large part of what parsing does, so when the trees are
+    going to be stored or sent elsewhere, pass `unpack=False` to `parse_many`
+    and keep the packed forms instead.
+    The pool is started on first use, and stays up until `close` is called or the
+    `with` block that it was used in exits.
+
+    # Arguments
+    workers (Optional[int]): The number of worker processes. Defaults to the
+        number of CPUs.
+    chunk_size (int): The number of inputs sent to a worker at a time. Larger
+        chunks have less overhead, smaller chunks balance the load better.
+    tokenizer (Optional[Tokenizer]): The tokenizer that workers use, e.g. to use
+        the "regex" backend or custom functions. Defaults to `Tokenizer()`.
+    exact_numbers (bool): Parse decimal constants as exact fractions, like
+        `ExpressionParser(exact_numbers=True)`.
+    """
+
+    workers: Optional[int]
+    chunk_size: int
+    tokenizer: Tokenizer
+    exact_numbers: bool
+    _executor: Optional[ProcessPoolExecutor]
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        chunk_size: int = 256,
+        tokenizer: Optional[Tokenizer] = None,
+        exact_numbers: bool = False,
+    ):
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be at least 1, got: {chunk_size}")
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+        self.exact_numbers = exact_numbers
+        self._executor = None
+
+    def __enter__(self) -> "ParallelExpressionParser":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Shut down the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def parse_many(
+        self, inputs: Iterable[str], collect_errors: bool = False, unpack: bool = True
+    ) -> Iterator[Union[MathExpression, PackedExpression, ParseError]]:
+        """Parse the inputs in the worker processes, yielding one result per input
+        in the same order as the inputs.
+
+        Inputs are read lazily, and only a few chunks per worker are in flight at
+        once, so very large iterables can be streamed through. Errors are handled
+        as in `ExpressionParser.parse_many`. When `unpack` is False the packed form
+        of each tree is yielded instead of the tree.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.tokenizer, self.exact_numbers),
+            )
+        executor = self._executor
+        max_pending = (self.workers or os.cpu_count() or 1) * 2
+        pending: Deque[Future] = deque()
+        for chunk in self._chunks(inputs):
+            pending.append(executor.submit(_parse_chunk, chunk))
+            if len(pending) >= max_pending:
+                yield from self._results(pending.popleft(), collect_errors, unpack)
+        while pending:
+            yield from self._results(pending.popleft(), collect_errors, unpack)
+
+    def _chunks(self, inputs: Iterable[str]) -> Iterator[List[str]]:
+        chunk: List[str] = []
+        for input_text in inputs:
+            chunk.append(input_text)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _results(
+        self, future: Future, collect_errors: bool, unpack: bool
+    ) -> Iterator[Union[MathExpression, PackedExpression, ParseError]]:
+        for result in future.result():
+            if isinstance(result, (ParserException, ValueError)):
+                if not collect_errors:
+                    raise result
+                yield result
+            elif unpack:
+                yield unpack_expression(result)
+            else:
+                yield result
+
+
+__all__ = (
+    "PackedExpression",
+    "pack_expression",
+    "unpack_expression",
+    "ParallelExpressionParser",
+)
@@ -1,5 +1,20 @@
-from typing import Dict, List, Optional
+import json
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
 
+from .cache import CacheStats, LRUCache
 from .expressions import (
     AddExpression,
     ConstantExpression,
@@ -18,10 +33,91 @@ from .types import NumberType
 
 
 class ParserException(Exception):
-    message: str
-
-    def __init__(self, message: str):
-        self.message = message
+    """The base class of the errors that the parser raises.
+
+    Errors raised while parsing carry the tokens of the input and the span of
+    tokens where the problem was found. The message is formatted the first time
+    it is read, so inputs that are expected to fail do not pay for building it.
+
+    # Arguments
+    message (str): The error message, or a `str.format` template for it when
+        `values` are given.
+    values (Any): The values to format into the message template.
+    tokens (Optional[Sequence[Token]]): The tokens of the input being parsed.
+    token_start (int): The index of the first token in the error span.
+    token_end (int): The index after the last token in the error span.
+    include_input (bool): Include the input text and a marker under the error
+        span in the message.
+    """
+
+    tokens: Optional[Sequence[Token]]
+    token_start: int
+    token_end: int
+    include_input: bool
+    _template: str
+    _values: Tuple[Any, ...]
+    _message: Optional[str]
+
+    def __init__(
+        self,
+        message: str,
+        *values: Any,
+        tokens: Optional[Sequence[Token]] = None,
+        token_start: int = 0,
+        token_end: int = 0,
+        include_input: bool = False,
+    ):
+        self._template = message
+        self._values = values
+        self._message = None
+        self.tokens = tokens
+        self.token_start = token_start
+        self.token_end = token_end
+        self.include_input = include_input
+
+    @property
+    def message(self) -> str:
+        if self._message is None:
+            message = self._template
+            if self._values:
+                message = message.format(*self._values)
+            if self.include_input and self.tokens is not None:
+                start = self._text_offset(self.token_start)
+                end = self._text_offset(self.token_end)
+                marker = " " * start + "^" * max(end - start, 1)
+                message += f"\nFull input: {self.input_text}\n            {marker}"
+            self._message = message
+        return self._message
+
+    @property
+    def input_text(self) -> str:
+        """The text of the input, rebuilt from its tokens"""
+        if self.tokens is None:
+            return ""
+        return "".join([str(t.value) for t in self.tokens])
+
+    @property
+    def start(self) -> int:
+        """The offset of the error span in the source text"""
+        if not self.tokens:
+            return -1
+        return self.tokens[min(self.token_start, len(self.tokens) - 1)].start
+
+    @property
+    def end(self) -> int:
+        """The offset after the end of the error span in the source text"""
+        if not self.tokens:
+            return -1
+        if self.token_end <= self.token_start:
+            return self.start
+        return self.tokens[min(self.token_end, len(self.tokens)) - 1].end
+
+    def _text_offset(self, token_index: int) -> int:
+        assert self.tokens is not None
+        return sum(len(str(t.value)) for t in self.tokens[:token_index])
+
+    def __str__(self) -> str:
+        return self.message
 
 
 class InvalidExpression(ParserException):
@@ -44,6 +140,79 @@ class TrailingTokens(ParserException):
     pass
 
 
+# The errors that parsing an invalid input can raise. The tokenizer and number
+# parsing raise ValueError, and the parser raises ParserException subclasses.
+ParseError = Union[ParserException, ValueError]
+
+# The size of the read buffer that `parse_file` streams files through
+_FILE_BUFFER_SIZE = 1 << 20
+
+
+class TextEdit(NamedTuple):
+    start: int
+    end: int
+    text: str
+
+
+# fmt: off
+TextEdit.start.__doc__ = "The offset of the first character to replace" # noqa
+TextEdit.end.__doc__ = "The offset after the last character to replace" # noqa
+TextEdit.text.__doc__ = "The text to insert in place of the replaced characters" # noqa
+# fmt: on
+
+# The types of the parents of the terms that `reparse` can parse on their own
+_TERM_PARENT_TYPES = (AddExpression, SubtractExpression, EqualExpression)
+
+
+def _find_edited_term(
+    tree: MathExpression, start: int, end: int
+) -> Optional[MathExpression]:
+    """Find the deepest node below the root that is a child of an add, subtract,
+    or equal node, and whose span contains the text from `start` to `end`"""
+    term: Optional[MathExpression] = None
+    node: Optional[MathExpression] = tree
+    while node is not None:
+        if isinstance(node.parent, _TERM_PARENT_TYPES):
+            term = node
+        left, right = node.left, node.right
+        if left is not None and left.span[0] <= start and end <= left.span[1]:
+            node = left
+        elif right is not None and right.span[0] <= start and end <= right.span[1]:
+            node = right
+        else:
+            node = None
+    return term
+
+
+def _shift_spans(tree: MathExpression, offset: int, after: int = 0) -> None:
+    """Shift the span offsets at or after `after` in the tree by `offset`"""
+    stack: List[MathExpression] = [tree]
+    while stack:
+        node = stack.pop()
+        start, end = node.span
+        if end < after:
+            # Every node below this one ends before the shift too
+            continue
+        if start >= after:
+            start += offset
+        node.span = (start, end + offset)
+        if node.left is not None:
+            stack.append(node.left)
+        if node.right is not None:
+            stack.append(node.right)
+
+
+def _read_json_key(line: str, key: str) -> str:
+    """Read the expression text at `key` from a line of JSON"""
+    record = json.loads(line)
+    if not isinstance(record, dict) or key not in record:
+        raise ValueError(f"expected a JSON object with key: {key}")
+    text = record[key]
+    if not isinstance(text, str):
+        raise ValueError(f"expected a string at key {key}, got: {type(text)}")
+    return text
+
+
 class TokenSet:
     """TokenSet objects are bitmask combinations for checking to see
     if a token is part of a valid set."""
@@ -120,61 +289,261 @@ class ExpressionParser:
     ```
     """  # noqa
 
-    _parse_cache: Dict[str, MathExpression]
-    _tokens_cache: Dict[str, List[Token]]
-    _all_tokens: Optional[List[Token]]
+    _parse_cache: LRUCache[str, MathExpression]
+    # Whether the cached trees were parsed with exact numbers
+    _parse_cache_exact: bool
+    _tokens_cache: LRUCache[str, Tuple[Token, ...]]
 
     tokenizer: Tokenizer
+    copy_on_read: bool
+    # Include the full input text in syntax error messages
+    detailed_errors: bool
+    # Parse decimal constants as exact fractions
+    exact_numbers: bool
+    tokens: Sequence[Token]
     current_token: Token
-
-    # Initialize the tokenizer.
-    def __init__(self) -> None:
+    # The index of the token that the next call to `next` will consume
+    token_index: int
+
+    def __init__(
+        self,
+        max_cache_entries: Optional[int] = 10000,
+        max_cache_tokens: Optional[int] = None,
+        copy_on_read: bool = False,
+        exact_numbers: bool = False,
+    ) -> None:
+        """Initialize the tokenizer and the parser caches.
+
+        The tokens and parse caches each keep the most recently used inputs, up to
+        `max_cache_entries` inputs and/or `max_cache_tokens` total tokens. Pass None
+        for no limit, or `max_cache_entries=0` to disable caching.
+
+        By default `parse` returns the cached tree itself, so callers that modify
+        the tree must clone it first. With `copy_on_read=True` the cached tree is
+        kept as a template that is never handed out, and every call to `parse`
+        returns an independent copy that is safe to modify.
+
+        With `exact_numbers=True` decimal constants are parsed as exact fractions,
+        e.g. "0.1" is `Fraction(1, 10)`, for evaluating with exact numbers, see
+        `use_exact_numbers`."""
         self.tokenizer = Tokenizer()
-        self.clear_cache()
+        self.copy_on_read = copy_on_read
+        self.detailed_errors = True
+        self.exact_numbers = exact_numbers
+        self._tokens_cache = LRUCache(max_cache_entries, max_cache_tokens)
+        self._parse_cache = LRUCache(max_cache_entries, max_cache_tokens)
+        self._parse_cache_exact = exact_numbers
 
     def clear_cache(self) -> None:
-        self._tokens_cache = {}
-        self._parse_cache = {}
-
-    def tokenize(self, input_text: str) -> List[Token]:
-        if input_text not in self._tokens_cache:
-            self._tokens_cache[input_text] = self.tokenizer.tokenize(input_text)
-        return self._tokens_cache[input_text][:]
-
-    def parse(self, input_text: str) -> MathExpression:
+        self._tokens_cache.clear()
+        self._parse_cache.clear()
+
+    def cache_stats(self) -> Dict[str, CacheStats]:
+        """Return the hit/miss/eviction statistics for the "tokens" and "parse"
+        caches."""
+        return {"tokens": self._tokens_cache.stats, "parse": self._parse_cache.stats}
+
+    def tokenize(self, input_text: str, use_cache: bool = True) -> Tuple[Token, ...]:
+        """Tokenize the input text. The result is an immutable sequence that is
+        shared with the tokens cache, so it is returned without copying."""
+        if not use_cache:
+            return tuple(self.tokenizer.tokenize(input_text))
+        tokens = self._tokens_cache.get(input_text)
+        if tokens is None:
+            tokens = tuple(self.tokenizer.tokenize(input_text))
+            self._tokens_cache.put(input_text, tokens, len(tokens))
+        return tokens
+
+    def parse(self, input_text: str, use_cache: bool = True) -> MathExpression:
         """Parse a string representation of an expression into a tree
         that can be later evaluated.
 
-        Returns : The evaluatable expression tree.
+        Pass `use_cache=False` for one-shot parses that should neither read
+        from nor add to the parser caches.
+
+        Returns : The evaluatable expression tree. When the parser was created
+            with `copy_on_read=True` this is a copy of the cached tree.
         """
-        if input_text in self._parse_cache:
-            return self._parse_cache[input_text]
-        self._parse_cache[input_text] = self._parse(self.tokenize(input_text))
-        return self._parse_cache[input_text]
+        if not use_cache:
+            return self._parse(self.tokenize(input_text, use_cache=False))
+        if self._parse_cache_exact != self.exact_numbers:
+            # Decimal constants parse differently with exact numbers
+            self._parse_cache.clear()
+            self._parse_cache_exact = self.exact_numbers
+        expression = self._parse_cache.get(input_text)
+        if expression is None:
+            tokens = self.tokenize(input_text)
+            expression = self._parse(tokens)
+            self._parse_cache.put(input_text, expression, len(tokens))
+        if self.copy_on_read:
+            return expression.clone()
+        return expression
+
+    def parse_many(
+        self,
+        inputs: Iterable[str],
+        use_cache: bool = True,
+        collect_errors: bool = False,
+    ) -> Iterator[Union[MathExpression, ParseError]]:
+        """Lazily parse many input strings, yielding one result per input in order.
+
+        Pass `use_cache=False` to skip the cache lookups and bookkeeping for
+        inputs that are unlikely to repeat, e.g. unique generated problems.
 
-    def _parse(self, tokens: List[Token]) -> MathExpression:
-        """Parse a given list of tokens into an expression tree"""
+        By default the first input that fails to parse raises its error. With
+        `collect_errors=True` the error is yielded in place of the expression
+        instead, so one bad input does not abort the whole batch.
+        """
+        parse = self.parse
+        parse_uncached = self._parse
+        tokenize = self.tokenizer.tokenize
+        for input_text in inputs:
+            try:
+                if use_cache:
+                    yield parse(input_text)
+                else:
+                    yield parse_uncached(tokenize(input_text))
+            except (ParserException, ValueError) as error:
+                if not collect_errors:
+                    raise
+                yield error
+
+    def parse_file(
+        self,
+        path: Union[str, Path],
+        json_key: Optional[str] = None,
+        detailed_errors: bool = False,
+        use_cache: bool = False,
+    ) -> Iterator[Tuple[int, Union[MathExpression, ParseError]]]:
+        """Stream a newline-delimited file of expressions, yielding a tuple of the
+        1-based line number and the parsed expression (or the error it raised) for
+        each non-blank line. The file is read through a fixed size buffer, so memory
+        use does not grow with the size of the file.
+
+        # Arguments
+        path (Union[str, Path]): The text file to read, with one expression per line.
+        json_key (Optional[str]): When given, each line is a JSON object (JSONL)
+            and the expression is read from this key.
+        detailed_errors (bool): Include the full input text in syntax error
+            messages. This is off by default because formatting the messages of
+            many failed inputs is costly.
+        use_cache (bool): Read from and add to the parser caches. Off by default
+            because large datasets rarely repeat inputs.
+        """
+        with open(path, "r", encoding="utf8", buffering=_FILE_BUFFER_SIZE) as file:
+            for line_no, line in enumerate(file, start=1):
+                if not line or line.isspace():
+                    continue
+                result: Union[MathExpression, ParseError]
+                detailed = self.detailed_errors
+                self.detailed_errors = detailed_errors
+                try:
+                    text = line.strip()
+                    if json_key is not None:
+                        text = _read_json_key(text, json_key)
+                    if use_cache:
+                        result = self.parse(text)
+                    else:
+                        result = self._parse(self.tokenizer.tokenize(text))
+                except (ParserException, ValueError) as error:
+                    result = error
+                finally:
+                    self.detailed_errors = detailed
+                yield line_no, result
+
+    def reparse(
+        self, old_tree: MathExpression, old_text: str, edit: TextEdit
+    ) -> MathExpression:
+        """Parse the text that results from applying `edit` to `old_text`, reusing
+        the parts of `old_tree` that the edit does not touch. `old_tree` must be
+        the unmodified result of parsing `old_text`.
+
+        Only the smallest term that contains the edit (a child of an add, subtract
+        or equal node) is tokenized and parsed again, and the result replaces the
+        old term in `old_tree`. The spans of the nodes after the edit are shifted
+        to match the new text. When the edit is not within a single term, or the new
+        term text does not parse as a term on its own, the new text is parsed in
+        full instead.
+
+        `old_tree` is updated in place, unless it is the tree that the parse cache
+        holds for `old_text`, which is copied first so that later parses of
+        `old_text` are not changed.
+
+        # Returns
+        (MathExpression): The tree for the new text. This is `old_tree` or its copy
+            when it was updated, or a new tree when the text was parsed in full.
+        """
+        start, end, text = edit
+        if not 0 <= start <= end <= len(old_text):
+            raise ValueError(f"edit is outside of the text: {edit}")
+        new_text = f"{old_text[:start]}{text}{old_text[end:]}"
+        if self._parse_cache.peek(old_text) is old_tree:
+            old_tree = old_tree.clone()
+        term = _find_edited_term(old_tree, start, end)
+        if term is None:
+            return self.parse(new_text, use_cache=False)
+        parent = term.parent
+        assert parent is not None
+        term_start, term_end = term.span
+        offset = len(text) - (end - start)
+        term_text = new_text[term_start : term_end + offset]  # noqa
+        try:
+            new_term = self._parse(self.tokenizer.tokenize(term_text))
+        except (ParserException, ValueError):
+            return self.parse(new_text, use_cache=False)
+        # The parser would have combined a new term of these types with the terms
+        # around it, so the tree would have a different shape
+        invalid_types: Tuple[Type[MathExpression], ...] = _TERM_PARENT_TYPES
+        if isinstance(parent, EqualExpression):
+            invalid_types = (EqualExpression,)
+        if isinstance(new_term, invalid_types):
+            return self.parse(new_text, use_cache=False)
+        _shift_spans(new_term, term_start)
+        _shift_spans(old_tree, offset, term_end)
+        # The ancestors that start or end with the old term start or end with the
+        # new term, which may not include whitespace at the ends of its text
+        ancestor: Optional[MathExpression] = parent
+        while ancestor is not None:
+            ancestor_start, ancestor_end = ancestor.span
+            if ancestor_start == term_start:
+                ancestor_start = new_term.span[0]
+            if ancestor_end == term_end + offset:
+                ancestor_end = new_term.span[1]
+            ancestor.span = (ancestor_start, ancestor_end)
+            ancestor = ancestor.parent
+        parent.set_side(new_term, parent.get_side(term))
+        term.parent = None
+        return old_tree
+
+    def _parse(self, tokens: Sequence[Token]) -> MathExpression:
+        """Parse a given sequence of tokens into an expression tree.
+
+        The tokens are read with a cursor and never modified, so the same sequence
+        can be parsed any number of times."""
         self.tokens = tokens
-        self._all_tokens = tokens[:]
+        self.token_index = 0
         self.current_token = Token("", TOKEN_TYPES.Invalid)
         if not self.next():
-            raise InvalidExpression("Cannot parse an empty function")
+            raise self._error(InvalidExpression, "Cannot parse an empty function")
 
         expression: MathExpression = self.parse_equal()
-        leftover = ""
-        while self.current_token.type != TOKEN_TYPES.EOF:
-            leftover = f"{leftover}{self.current_token.value}"
-            self.next()
-
-        if leftover != "":
-            raise TrailingTokens("Trailing characters: {}".format(leftover))
-        self._all_tokens = None
+        if self.current_token.type != TOKEN_TYPES.EOF:
+            start = self.token_index - 1
+            leftover = "".join([str(t.value) for t in tokens[start:-1]])
+            raise self._error(
+                TrailingTokens,
+                "Trailing characters: {}",
+                leftover,
+                token_start=start,
+                token_end=len(tokens) - 1,
+            )
         return expression
 
     def parse_equal(self) -> MathExpression:
         self.check(_FIRST_ADD, True)
 
         exp = self.parse_add()
+        start = exp.span[0]
         while self.check(_IS_EQUAL):
             opType = self.current_token.type
             self.eat(opType)
@@ -184,12 +553,13 @@ class ExpressionParser:
                 right = self.parse_add()
 
             if not expected or not right:
-                raise UnexpectedBehavior(
-                    "Expected an expression after = operator, got: {}".format(
-                        self.current_token.value
-                    )
+                raise self._error(
+                    UnexpectedBehavior,
+                    "Expected an expression after = operator, got: {}",
+                    self.current_token.value,
                 )
             exp = EqualExpression(exp, right)
+            exp.span = (start, right.span[1])
 
         return exp
 
@@ -197,6 +567,7 @@ class ExpressionParser:
         self.check(_FIRST_MULT, True)
 
         exp = self.parse_mult()
+        start = exp.span[0]
         while self.check(_IS_ADD):
             opType = self.current_token.type
             opValue = self.current_token.value
@@ -207,10 +578,10 @@ class ExpressionParser:
                 right = self.parse_mult()
 
             if not expected or not right:
-                raise UnexpectedBehavior(
-                    "Expected an expression after + or - operator, got: {}".format(
-                        self.current_token.value
-                    )
+                raise self._error(
+                    UnexpectedBehavior,
+                    "Expected an expression after + or - operator, got: {}",
+                    self.current_token.value,
                 )
 
             if opType == TOKEN_TYPES.Plus:
@@ -218,18 +589,21 @@ class ExpressionParser:
             elif opType == TOKEN_TYPES.Minus:
                 exp = SubtractExpression(exp, right)
             else:  # pragma: nocover
-                raise UnexpectedBehavior(
-                    "Expected plus or minus, got: {}".format(opValue)
+                raise self._error(
+                    UnexpectedBehavior, "Expected plus or minus, got: {}", opValue
                 )
+            exp.span = (start, right.span[1])
 
         return exp
 
     def parse_mult(self) -> MathExpression:
         self.check(_FIRST_EXP, True)
         exp = self.parse_exponent()
+        start = exp.span[0]
         while self.check(_IS_MULT):
             opType = self.current_token.type
             opValue = self.current_token.value
+            op_index = self.token_index - 1
             self.eat(opType)
             expected = self.check(_FIRST_EXP)
             right = None
@@ -237,11 +611,12 @@ class ExpressionParser:
                 right = self.parse_exponent()
 
             if not expected or right is None:
-                assert self._all_tokens is not None
-                input_str = "".join([str(f.value) for f in self._all_tokens])
-                raise InvalidSyntax(
-                    f"Expected an expression after * or / operator, got: {opValue}"
-                    f"\nFull input: {input_str}"
+                raise self._error(
+                    InvalidSyntax,
+                    "Expected an expression after * or / operator, got: {}",
+                    opValue,
+                    token_start=op_index,
+                    include_input=True,
                 )
 
             if opType == TOKEN_TYPES.Multiply:
@@ -249,9 +624,10 @@ class ExpressionParser:
             elif opType == TOKEN_TYPES.Divide:
                 exp = DivideExpression(exp, right)
             else:  # pragma: nocover
-                raise UnexpectedBehavior(
-                    "Expected mult or divide, got: {}".format(opValue)
+                raise self._error(
+                    UnexpectedBehavior, "Expected mult or divide, got: {}", opValue
                 )
+            exp.span = (start, right.span[1])
         return exp
 
     def parse_exponent(self) -> MathExpression:
@@ -261,18 +637,25 @@ class ExpressionParser:
             opType = self.current_token.type
             self.eat(opType)
             if not self.check(_FIRST_UNARY):
-                raise InvalidSyntax("Expected an expression after ^ operator")
+                raise self._error(
+                    InvalidSyntax, "Expected an expression after ^ operator"
+                )
 
             right = self.parse_unary()
             if opType == TOKEN_TYPES.Exponent:
+                start = exp.span[0]
                 exp = PowerExpression(exp, right)
+                exp.span = (start, right.span[1])
             else:  # pragma: nocover
-                raise UnexpectedBehavior("Expected exponent, got: {}".format(opType))
+                raise self._error(
+                    UnexpectedBehavior, "Expected exponent, got: {}", opType
+                )
         return exp
 
     def parse_unary(self) -> MathExpression:
         value: NumberType = 0
         negate = False
+        start = self.current_token.start
         if self.current_token.type == TOKEN_TYPES.Minus:
             self.eat(TOKEN_TYPES.Minus)
             negate = True
@@ -280,34 +663,41 @@ class ExpressionParser:
         exp: Optional[MathExpression] = None
         if expected:
             if self.current_token.type == TOKEN_TYPES.Constant:
-                value = coerce_to_number(self.current_token.value)
+                value = coerce_to_number(self.current_token.value, self.exact_numbers)
                 # Flip parse as float/int based on whether the value text
                 if negate:
                     value = -value
                     negate = False
 
                 exp = ConstantExpression(value)
+                exp.span = (start, self.current_token.end)
                 self.eat(TOKEN_TYPES.Constant)
 
             if self.check(_FIRST_FACTOR):
                 if exp is None:
                     exp = self.parse_factors()
                 elif self.current_token.type == TOKEN_TYPES.Factorial:
+                    end = self.current_token.end
                     self.eat(TOKEN_TYPES.Factorial)
                     exp = FactorialExpression(exp)
+                    exp.span = (start, end)
                 else:
-                    exp = MultiplyExpression(exp, self.parse_factors())
+                    right = self.parse_factors()
+                    exp = MultiplyExpression(exp, right)
+                    exp.span = (start, right.span[1])
 
         if not expected or exp is None:
-            assert self._all_tokens is not None
-            input_str = "".join([str(f.value) for f in self._all_tokens])
-            raise InvalidSyntax(
+            raise self._error(
+                InvalidSyntax,
                 "Expected a function/variable/parenthesis after - or + \n"
-                f"Received : {self.current_token.value}\n"
-                f"Full Input : {input_str}\n"
+                "Received : {}",
+                self.current_token.value,
+                include_input=True,
             )
         if negate:
-            return NegateExpression(exp)
+            child = exp
+            exp = NegateExpression(child)
+            exp.span = (start, child.span[1])
 
         return exp
 
@@ -319,57 +709,95 @@ class ExpressionParser:
             right = None
             opType = self.current_token.type
             if opType == TOKEN_TYPES.Variable:
-                factors.append(VariableExpression(str(self.current_token.value)))
+                variable = VariableExpression(str(self.current_token.value))
+                variable.span = (self.current_token.start, self.current_token.end)
+                factors.append(variable)
                 self.eat(TOKEN_TYPES.Variable)
             elif opType == TOKEN_TYPES.Function:
                 factors.append(self.parse_function())
             elif opType == TOKEN_TYPES.OpenParen:
+                start = self.current_token.start
                 self.eat(TOKEN_TYPES.OpenParen)
-                factors.append(self.parse_add())
+                group = self.parse_add()
+                # The span of a group includes its parentheses
+                group.span = (start, self.current_token.end)
                 self.eat(TOKEN_TYPES.CloseParen)
+                factors.append(group)
             else:  # pragma: nocover
-                raise UnexpectedBehavior(
-                    "Unexpected token in Factor: {}".format(self.current_token.value)
+                raise self._error(
+                    UnexpectedBehavior,
+                    "Unexpected token in Factor: {}",
+                    self.current_token.value,
                 )
 
             found = self.check(_FIRST_FACTOR)
 
         if len(factors) == 0:
-            raise InvalidExpression("No factors")
+            raise self._error(InvalidExpression, "No factors")
 
         exp: Optional[MathExpression] = None
         if self.check(_IS_EXP):
             opType = self.current_token.type
             self.eat(opType)
             if not self.check(_FIRST_UNARY):
-                raise InvalidSyntax("Expected an expression after ^ operator")
+                raise self._error(
+                    InvalidSyntax, "Expected an expression after ^ operator"
+                )
 
             right = self.parse_unary()
             exp = PowerExpression(factors[-1], right)
+            exp.span = (factors[-1].span[0], right.span[1])
 
         if len(factors) == 1:
             return exp or factors[0]
 
-        while len(factors) > 0:
-            if exp is None:
-                exp = factors.pop(0)
-
-            exp = MultiplyExpression(exp, factors.pop(0))
-
-        assert exp is not None
+        remaining = iter(factors)
+        if exp is None:
+            exp = next(remaining)
+        start = exp.span[0]
+        for factor in remaining:
+            exp = MultiplyExpression(exp, factor)
+            exp.span = (start, factor.span[1])
         return exp
 
     def parse_function(self) -> MathExpression:
         opFn = str(self.current_token.value)
+        start = self.current_token.start
         self.eat(self.current_token.type)
         self.eat(TOKEN_TYPES.OpenParen)
         exp = self.parse_add()
+        end = self.current_token.end
         self.eat(TOKEN_TYPES.CloseParen)
         func = self.tokenizer.functions[opFn]
         if func is None:
-            raise UnexpectedBehavior("Unknown Function type: {}".format(opFn))
+            raise self._error(UnexpectedBehavior, "Unknown Function type: {}", opFn)
+
+        result = func(exp)
+        result.span = (start, end)
+        return result
 
-        return func(exp)
+    def _error(
+        self,
+        error_type: Type[ParserException],
+        message: str,
+        *values: Any,
+        token_start: Optional[int] = None,
+        token_end: Optional[int] = None,
+        include_input: bool = False,
+    ) -> ParserException:
+        """Create an error that spans from `token_start` (default: the current
+        token) to `token_end` (default: after the current token). Pass
+        `include_input=True` to add the input text to the message when
+        `detailed_errors` is on."""
+        current = max(self.token_index - 1, 0)
+        return error_type(
+            message,
+            *values,
+            tokens=self.tokens,
+            token_start=current if token_start is None else token_start,
+            token_end=current + 1 if token_end is None else token_end,
+            include_input=include_input and self.detailed_errors,
+        )
 
     def next(self) -> bool:
         """Assign the next token in the queue to `self.current_token`.
@@ -378,9 +806,10 @@ class ExpressionParser:
         are no more tokens to look at."""
 
         if self.current_token.type == TOKEN_TYPES.EOF:
-            raise OutOfTokens("Parsed beyond the end of the expression")
+            raise self._error(OutOfTokens, "Parsed beyond the end of the expression")
 
-        self.current_token = self.tokens.pop(0)
+        self.current_token = self.tokens[self.token_index]
+        self.token_index += 1
         return self.current_token.type != TOKEN_TYPES.EOF
 
     def eat(self, type: int) -> bool:
@@ -392,7 +821,7 @@ class ExpressionParser:
             - `type` The type that your syntax expects @current_token to be
         """
         if self.current_token.type != type:
-            raise InvalidSyntax("Missing: {}".format(type))
+            raise self._error(InvalidSyntax, "Missing: {}", type)
 
         return self.next()
 
@@ -406,7 +835,7 @@ class ExpressionParser:
 
         result = tokens.contains(self.current_token.type)
         if do_assert is True and result is False:
-            raise InvalidSyntax("Invalid expression")
+            raise self._error(InvalidSyntax, "Invalid expression")
         return result
 
 
@@ -418,6 +847,8 @@ __all__ = (
     "UnexpectedBehavior",
     "UnexpectedBehavior",
     "TrailingTokens",
+    "ParseError",
     "TokenSet",
+    "TextEdit",
     "ExpressionParser",
 )
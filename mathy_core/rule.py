@@ -1,7 +1,6 @@
-from typing import Any, List, Optional
+from typing import List, Optional
 
 from .expressions import MathExpression
-from .tree import STOP, VisitStop
 from .types import Literal
 from .util import is_debug_mode
 
@@ -21,21 +20,10 @@ class BaseRule:
 
     def find_node(self, expression: MathExpression) -> Optional[MathExpression]:
         """Find the first node that can have this rule applied to it."""
-        result = None
-
-        def visit_fn(
-            node: MathExpression, depth: int, data: Any
-        ) -> Optional[VisitStop]:
-            nonlocal result
+        for node in expression.iter_inorder():
             if self.can_apply_to(node):
-                result = node
-
-            if result is not None:
-                return STOP
-            return None
-
-        expression.visit_inorder(visit_fn)
-        return result
+                return node
+        return None
 
     def find_nodes(self, expression: MathExpression) -> List[MathExpression]:
         """Find all nodes in an expression that can have this rule applied to them.
@@ -43,19 +31,10 @@ class BaseRule:
         the visit strategy, and stored as `node.r_index` starting with index 0
         """
         nodes = []
-        index = 0
-
-        def visit_fn(
-            node: MathExpression, depth: int, data: Any
-        ) -> Optional[VisitStop]:
-            nonlocal nodes, index
+        for index, node in enumerate(expression.iter_inorder()):
             node.r_index = index
             if self.can_apply_to(node):
                 nodes.append(node)
-            index += 1
-            return None
-
-        expression.visit_inorder(visit_fn)
         return nodes
 
     def can_apply_to(self, node: MathExpression) -> bool:
@@ -39,9 +39,7 @@ class BalancedMoveRule(BaseRule):
         root_side = node.get_root_side()
         node_subtree = root.left if root_side == LEFT else root.right
         assert node_subtree is not None
-        if len(node_subtree.find_type(AddExpression)) > 0:
-            return True
-        return False
+        return node_subtree.contains(AddExpression)
 
     def get_type(self, node: MathExpression) -> Optional[str]:
         """Determine the configuration of the tree for this transformation.
@@ -63,7 +63,7 @@ def run_rule_tests(
     into the parsing/evaluation of the debug example.
     """
     tests: Dict[str, Any] = get_rule_tests(name)
-    parser = ExpressionParser()
+    parser = ExpressionParser(copy_on_read=True)
     node: Optional[MathExpression]
     ex: Dict[str, Any]
     for ex in tests["valid"]:
@@ -73,7 +73,7 @@ def run_rule_tests(
         rule = init_rule_for_test(ex, rule_class)
         assert rule.name is not None, "Rule must have a name"
         assert rule.code is not None, "Rule must have a code"
-        expression = parser.parse(ex["input"]).clone()
+        expression = parser.parse(ex["input"])
         before = expression.clone().get_root()
         print(ex)
         target: str
@@ -115,7 +115,7 @@ def run_rule_tests(
         if callback is not None:
             callback(ex)
         rule = init_rule_for_test(ex, rule_class)
-        expression = parser.parse(ex["input"]).clone()
+        expression = parser.parse(ex["input"])
         node = None
         if "target" in ex:
             target = ex["target"]
@@ -1,7 +1,9 @@
-from typing import Callable, Dict, List, Optional, Type
+import re
+from fractions import Fraction
+from typing import Callable, Dict, List, Optional, Tuple, Type
 
 from .expressions import FunctionExpression, SgnExpression
-from .types import NumberType
+from .types import Literal, NumberType
 
 
 # Define the known types of tokens for the Tokenizer.
@@ -23,13 +25,65 @@ class TOKEN_TYPES:
     Invalid: int = 1 << 14
 
 
+# Operator characters and the (value, type) of the tokens they produce. Some
+# characters are aliases, e.g. "–" and "[" tokenize the same as "-" and "(".
+_OPERATOR_TOKENS: Dict[str, Tuple[str, int]] = {
+    "+": ("+", TOKEN_TYPES.Plus),
+    "-": ("-", TOKEN_TYPES.Minus),
+    "–": ("-", TOKEN_TYPES.Minus),
+    "*": ("*", TOKEN_TYPES.Multiply),
+    "/": ("/", TOKEN_TYPES.Divide),
+    "^": ("^", TOKEN_TYPES.Exponent),
+    "!": ("!", TOKEN_TYPES.Factorial),
+    "(": ("(", TOKEN_TYPES.OpenParen),
+    "[": ("(", TOKEN_TYPES.OpenParen),
+    ")": (")", TOKEN_TYPES.CloseParen),
+    "]": (")", TOKEN_TYPES.CloseParen),
+    "=": ("=", TOKEN_TYPES.Equal),
+}
+_PADDING_CHARS: str = " \t\r\n"
+
+# The "regex" lexer finds every token with one precompiled pattern, and then picks
+# the token type by looking up the first character of each match in a table. The
+# trailing "." alternative picks up operators, padding, and invalid characters.
+# The matches of both patterns cover the whole input, so the offset of each token
+# is the total length of the matches before it. The pattern that skips padding
+# matches it in a separate group, so that it can still be counted.
+_LEXER_PATTERN = re.compile(r"[0-9.]+|[a-zA-Z]+|.", re.DOTALL)
+_LEXER_PATTERN_NO_PADDING = re.compile(
+    r"([{0}]*)([0-9.]+|[a-zA-Z]+|.)".format(re.escape(_PADDING_CHARS)), re.DOTALL
+)
+_LEXER_CONSTANT = 1
+_LEXER_ALPHA = 2
+_LEXER_PADDING = 3
+_LEXER_CHAR_KINDS: Dict[str, int] = {
+    **{c: _LEXER_CONSTANT for c in "0123456789."},
+    **{chr(c): _LEXER_ALPHA for c in range(ord("a"), ord("z") + 1)},
+    **{chr(c): _LEXER_ALPHA for c in range(ord("A"), ord("Z") + 1)},
+    **{c: _LEXER_PADDING for c in _PADDING_CHARS},
+}
+
+TokenizerBackend = Literal["scan", "regex"]
+
+
 class Token:
+    """A token of the input text, with the offsets of the text that it was read
+    from. The offsets are -1 for tokens that were not read from an input."""
+
+    __slots__ = ("value", "type", "start", "end")
+
     value: str
     type: int
+    # The offset of the first character of the token in the input
+    start: int
+    # The offset after the last character of the token in the input
+    end: int
 
-    def __init__(self, value: str, type: int):
+    def __init__(self, value: str, type: int, start: int = -1, end: int = -1):
         self.value = value
         self.type = type
+        self.start = start
+        self.end = end
 
     def __str__(self) -> str:
         return f'(type={self.type}, value="{self.value}")'
@@ -39,7 +93,6 @@ class TokenContext:
     tokens: List[Token]
     index: int
     buffer: str
-    chunk: str
 
     def __init__(
         self,
@@ -47,23 +100,54 @@ class TokenContext:
         tokens: Optional[List[Token]] = None,
         index: int = 0,
         buffer: str = "",
-        chunk: str = "",
+        chunk: Optional[str] = None,
     ):
         self.tokens = tokens if tokens is not None else []
         self.index = index
         self.buffer = buffer
-        self.chunk = chunk
+        if chunk is not None:
+            self.chunk = chunk
+
+    @property
+    def chunk(self) -> str:
+        """The unconsumed remainder of the buffer. This slices the buffer on each
+        access, so prefer indexing `buffer` at `index` in hot code."""
+        return self.buffer[self.index :]  # noqa
+
+    @chunk.setter
+    def chunk(self, value: str) -> None:
+        # Setting the remainder of the buffer moves the index to where it starts,
+        # and any other text replaces the buffer
+        if self.buffer.endswith(value):
+            self.index = len(self.buffer) - len(value)
+        else:
+            self.buffer = value
+            self.index = 0
 
 
 class Tokenizer:
-    """The Tokenizer produces a list of tokens from an input string."""
+    """The Tokenizer produces a list of tokens from an input string.
+
+    Two lexer backends are available, and both produce identical tokens:
+
+    - "scan" walks the input with the `identify_*` methods below, which
+      subclasses can override to customize tokenization.
+    - "regex" matches the input with one precompiled pattern, which is about
+      twice as fast per token but does not call the `identify_*` methods.
+    """
 
     exclude_padding: bool
     functions: Dict[str, Type[FunctionExpression]]
+    backend: TokenizerBackend
 
-    def __init__(self, exclude_padding: bool = True):
+    def __init__(
+        self, exclude_padding: bool = True, backend: TokenizerBackend = "scan"
+    ):
+        if backend not in ("scan", "regex"):
+            raise ValueError(f"unknown tokenizer backend: {backend}")
         self.exclude_padding = exclude_padding
         self.functions = {"sgn": SgnExpression}
+        self.backend = backend
 
     def is_alpha(self, c: str) -> bool:
         """Is this character a letter"""
@@ -76,87 +160,154 @@ class Tokenizer:
     def eat_token(self, context: TokenContext, typeFn: Callable[[str], bool]) -> str:
         """Eat all of the tokens of a given type from the front of the stream
         until a different type is hit, and return the text."""
-        res = ""
-        for ch in list(context.chunk):
-            if not typeFn(ch):
-                return res
-            res = res + str(ch)
-
-        return res
+        buffer = context.buffer
+        end = context.index
+        length = len(buffer)
+        while end < length and typeFn(buffer[end]):
+            end += 1
+        return buffer[context.index : end]  # noqa
 
     def tokenize(self, buffer: str) -> List[Token]:
         """Return an array of `Token`s from a given string input.
-        This throws an exception if an unknown token type is found in the input."""
-        context = TokenContext(buffer=buffer, chunk=str(buffer))
-        while context.chunk and (
+        This throws an exception if an unknown token type is found in the input.
+
+        The input is scanned once from left to right by moving `context.index`
+        forward, so tokenizing is linear in the length of the input."""
+        if self.backend == "regex":
+            return self.tokenize_regex(buffer)
+        context = TokenContext(buffer=buffer)
+        length = len(buffer)
+        while context.index < length and (
             self.identify_constants(context)
             or self.identify_alphas(context)
             or self.identify_operators(context)
         ):
-            context.chunk = context.buffer[context.index :]  # noqa
+            pass
 
-        context.tokens.append(Token("", TOKEN_TYPES.EOF))
+        context.tokens.append(Token("", TOKEN_TYPES.EOF, length, length))
         return context.tokens
 
+    def tokenize_regex(self, buffer: str) -> List[Token]:
+        """Tokenize the input with a single precompiled regular expression rather
+        than the `identify_*` methods. The output is the same as `tokenize`."""
+        tokens: List[Token] = []
+        append = tokens.append
+        functions = self.functions
+        operators = _OPERATOR_TOKENS
+        char_kinds = _LEXER_CHAR_KINDS
+        exclude_padding = self.exclude_padding is not False
+        if exclude_padding:
+            matches = _LEXER_PATTERN_NO_PADDING.findall(buffer)
+        else:
+            matches = [("", text) for text in _LEXER_PATTERN.findall(buffer)]
+        end = 0
+        for padding, text in matches:
+            start = end + len(padding)
+            end = start + len(text)
+            operator = operators.get(text)
+            if operator is not None:
+                append(Token(operator[0], operator[1], start, end))
+                continue
+            kind = char_kinds.get(text[0])
+            if kind == _LEXER_CONSTANT:
+                append(Token(text, TOKEN_TYPES.Constant, start, end))
+            elif kind == _LEXER_ALPHA:
+                if text in functions:
+                    append(Token(text, TOKEN_TYPES.Function, start, end))
+                else:
+                    # Each letter is its own variable
+                    for i, c in enumerate(text, start):
+                        append(Token(c, TOKEN_TYPES.Variable, i, i + 1))
+            elif kind == _LEXER_PADDING:
+                if not exclude_padding:
+                    append(Token(text, TOKEN_TYPES.Pad, start, end))
+            else:
+                raise ValueError(f'Invalid token "{text}" in expression: {buffer}')
+        length = len(buffer)
+        append(Token("", TOKEN_TYPES.EOF, length, length))
+        return tokens
+
     def identify_operators(self, context: TokenContext) -> bool:
         """Identify and tokenize operators."""
-        ch = context.chunk[0]
+        index = context.index
+        ch = context.buffer[index]
+        token: Optional[Token] = None
         if ch == " " or ch == "\t" or ch == "\r" or ch == "\n":
             # NOTE: originally introduced this to include padding for token prediction
             if self.exclude_padding is False:
-                context.tokens.append(Token(ch, TOKEN_TYPES.Pad))
+                token = Token(ch, TOKEN_TYPES.Pad, index, index + 1)
         elif ch == "+":
-            context.tokens.append(Token("+", TOKEN_TYPES.Plus))
+            token = Token("+", TOKEN_TYPES.Plus, index, index + 1)
         elif ch == "-" or ch == "–":
-            context.tokens.append(Token("-", TOKEN_TYPES.Minus))
+            token = Token("-", TOKEN_TYPES.Minus, index, index + 1)
         elif ch == "*":
-            context.tokens.append(Token("*", TOKEN_TYPES.Multiply))
+            token = Token("*", TOKEN_TYPES.Multiply, index, index + 1)
         elif ch == "/":
-            context.tokens.append(Token("/", TOKEN_TYPES.Divide))
+            token = Token("/", TOKEN_TYPES.Divide, index, index + 1)
         elif ch == "^":
-            context.tokens.append(Token("^", TOKEN_TYPES.Exponent))
+            token = Token("^", TOKEN_TYPES.Exponent, index, index + 1)
         elif ch == "!":
-            context.tokens.append(Token("!", TOKEN_TYPES.Factorial))
+            token = Token("!", TOKEN_TYPES.Factorial, index, index + 1)
         elif ch == "(" or ch == "[":
-            context.tokens.append(Token("(", TOKEN_TYPES.OpenParen))
+            token = Token("(", TOKEN_TYPES.OpenParen, index, index + 1)
         elif ch == ")" or ch == "]":
-            context.tokens.append(Token(")", TOKEN_TYPES.CloseParen))
+            token = Token(")", TOKEN_TYPES.CloseParen, index, index + 1)
         elif ch == "=":
-            context.tokens.append(Token("=", TOKEN_TYPES.Equal))
+            token = Token("=", TOKEN_TYPES.Equal, index, index + 1)
         else:
             raise ValueError(f'Invalid token "{ch}" in expression: {context.buffer}')
-        context.index = context.index + 1
+        if token is not None:
+            context.tokens.append(token)
+        context.index = index + 1
         return True
 
     def identify_alphas(self, context: TokenContext) -> int:
         """Identify and tokenize functions and variables."""
-        if not self.is_alpha(context.chunk[0]):
+        if not self.is_alpha(context.buffer[context.index]):
             return False
 
+        start = context.index
         variable = self.eat_token(context, self.is_alpha)
+        end = start + len(variable)
         if variable in self.functions:
-            context.tokens.append(Token(variable, TOKEN_TYPES.Function))
+            context.tokens.append(Token(variable, TOKEN_TYPES.Function, start, end))
         else:
             # Each letter is its own variable
-            for c in variable:
-                context.tokens.append(Token(c, TOKEN_TYPES.Variable))
+            for i, c in enumerate(variable, start):
+                context.tokens.append(Token(c, TOKEN_TYPES.Variable, i, i + 1))
 
-        context.index += len(variable)
+        context.index = end
         return len(variable)
 
     def identify_constants(self, context: TokenContext) -> int:
         """Identify and tokenize a constant number."""
-        if not self.is_number(context.chunk[0]):
+        if not self.is_number(context.buffer[context.index]):
             return 0
 
+        start = context.index
         val = self.eat_token(context, self.is_number)
-        context.tokens.append(Token(val, TOKEN_TYPES.Constant))
-        context.index += len(val)
+        context.index = start + len(val)
+        context.tokens.append(Token(val, TOKEN_TYPES.Constant, start, context.index))
         return len(val)
 
 
-def coerce_to_number(value: str) -> NumberType:
-    return float(value) if "e" in value or "." in value else int(value)
+def coerce_to_number(value: str, exact_numbers: bool = False) -> NumberType:
+    """Convert the text of a constant to an int, or to a float if it has a decimal
+    point or exponent. With `exact_numbers` those are exact fractions instead, or
+    ints when they are whole."""
+    if "e" not in value and "." not in value:
+        return int(value)
+    if not exact_numbers:
+        return float(value)
+    number = Fraction(value)
+    return number.numerator if number.denominator == 1 else number  # type:ignore
 
 
-__all__ = ("TOKEN_TYPES", "Token", "TokenContext", "Tokenizer", "coerce_to_number")
+__all__ = (
+    "TOKEN_TYPES",
+    "Token",
+    "TokenContext",
+    "Tokenizer",
+    "TokenizerBackend",
+    "coerce_to_number",
+)
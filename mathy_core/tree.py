@@ -1,4 +1,16 @@
-from typing import Any, Callable, Generic, List, Optional, TypeVar, Union
+import itertools
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 from .types import Literal
 
@@ -29,26 +41,83 @@ VisitFunction = Callable[
 ]
 
 
+# Node ids are numbered from this counter, and only formatted as "mn-N" strings
+# when they are read through `BinaryTreeNode.id`.
+_node_ids = itertools.count(1)
+_ID_PREFIX = "mn-"
+
+NodeId = Union[int, str]
+
+# The cache of a node that has nothing cached, but whose ancestors may. It is
+# shared, and never written to.
+_EMPTY_CACHE: Dict[str, Any] = {}
+
+
+def _parse_id(value: NodeId) -> NodeId:
+    """Return the number in an "mn-N" id string, or the value as it is for other
+    ids, so that ids can be compared without formatting them."""
+    if isinstance(value, str) and value.startswith(_ID_PREFIX):
+        number = value[len(_ID_PREFIX) :]  # noqa
+        if number.isdigit() and number == str(int(number)):
+            return int(number)
+    return value
+
+
+def _meta_property(name: str, doc: str) -> Any:
+    """A node attribute that is kept in the node's `_meta` side table. Like a
+    regular attribute, reading it before it has been set raises AttributeError."""
+
+    def fget(node: "BinaryTreeNode") -> Any:
+        meta = node._meta
+        if meta is None or name not in meta:
+            raise AttributeError(name)
+        return meta[name]
+
+    def fset(node: "BinaryTreeNode", value: Any) -> None:
+        node._set_meta(name, value)
+
+    def fdel(node: "BinaryTreeNode") -> None:
+        if node._meta is None or name not in node._meta:
+            raise AttributeError(name)
+        node._del_meta(name)
+
+    return property(fget, fset, fdel, doc)
+
+
 class BinaryTreeNode(Generic[NodeType]):
     """
     The binary tree node is the base node for all of our trees, and provides a
     rich set of methods for constructing, inspecting, and modifying them.
     The node itself defines the structure of the binary tree, having left and right
     children, and a parent.
-    """
 
-    _idCounter = 0
+    Nodes use `__slots__` to keep their memory use low, so subclasses should
+    declare `__slots__` for their own attributes too. Rarely used attributes, like
+    the layout fields below, are kept in a `_meta` side table that is only created
+    when one of them is set.
 
-    # Tree layout mutations. Thanks, 2009 Justin. :( :(
-    x: Optional[float]
-    y: Optional[float]
-    offset: Optional[float]
-    level: Optional[int]
-    thread: Optional[NodeType]
+    Data derived from the structure of a subtree can be cached on its root node
+    with `_set_cache`. `set_left`, `set_right`, and `rotate` drop the caches of the
+    nodes whose subtrees they change, so code that assigns `left`, `right`, or
+    `parent` directly must call `invalidate` itself.
+    """
+
+    __slots__ = ("left", "right", "parent", "_id", "_meta", "_cache")
 
     left: Optional[NodeType]
     right: Optional[NodeType]
     parent: Optional[NodeType]
+    # The number of a generated id, or a custom id string
+    _id: NodeId
+    _meta: Optional[Dict[str, Any]]
+    _cache: Optional[Dict[str, Any]]
+
+    # Tree layout mutations. Thanks, 2009 Justin. :( :(
+    x = _meta_property("x", "The horizontal position from #TreeLayout")
+    y = _meta_property("y", "The vertical position from #TreeLayout")
+    offset = _meta_property("offset", "The offset from the parent in #TreeLayout")
+    level = _meta_property("level", "The depth used by #TreeLayout")
+    thread = _meta_property("thread", "The thread node used by #TreeLayout")
 
     #  Allow specifying children in the constructor
     def __init__(
@@ -56,29 +125,171 @@ class BinaryTreeNode(Generic[NodeType]):
         left: Optional[NodeType] = None,
         right: Optional[NodeType] = None,
         parent: Optional[NodeType] = None,
-        id: Optional[str] = None,
+        id: Optional[NodeId] = None,
     ):
-        if id is None:
-            BinaryTreeNode._idCounter = BinaryTreeNode._idCounter + 1
-            id = f"mn-{BinaryTreeNode._idCounter}"
-        self.id = id
+        self._id = next(_node_ids) if id is None else _parse_id(id)
+        self._meta = None
+        self._cache = None
+        self.parent = parent
         self.left = None
         self.right = None
         self.set_left(left)
         self.set_right(right)
-        self.parent = parent
+
+    @property
+    def id(self) -> str:
+        """The unique id of this node, e.g. "mn-12". Generated ids are stored as
+        numbers, and only formatted when read."""
+        node_id = self._id
+        return f"{_ID_PREFIX}{node_id}" if isinstance(node_id, int) else node_id
+
+    @id.setter
+    def id(self, value: NodeId) -> None:
+        self._id = _parse_id(value)
+
+    def _get_meta(self, name: str, default: Any = None) -> Any:
+        """Read a value from the side table, or return `default` if it is unset"""
+        if self._meta is None:
+            return default
+        return self._meta.get(name, default)
+
+    def _set_meta(self, name: str, value: Any) -> None:
+        """Write a value to the side table, creating it if needed"""
+        if self._meta is None:
+            self._meta = {}
+        self._meta[name] = value
+
+    def _del_meta(self, name: str) -> None:
+        """Remove a value from the side table, and drop the table when empty"""
+        if self._meta is None or name not in self._meta:
+            return
+        del self._meta[name]
+        if not self._meta:
+            self._meta = None
+
+    def _get_cache(self, name: str, default: Any = None) -> Any:
+        """Read a value cached on this node, or return `default` if there is none"""
+        if self._cache is None:
+            return default
+        return self._cache.get(name, default)
+
+    def _set_cache(self, name: str, value: Any) -> None:
+        """Cache a value on this node until its subtree changes"""
+        if self._cache is None or self._cache is _EMPTY_CACHE:
+            # The nodes with caches form whole subtrees, so that `invalidate` can
+            # stop at the first ancestor without one. Mark the descendants first.
+            stack: List[BinaryTreeNode] = [self]
+            while stack:
+                node = stack.pop()
+                for child in (node.left, node.right):
+                    if child is not None and child._cache is None:
+                        child._cache = _EMPTY_CACHE
+                        stack.append(child)
+            self._cache = {}
+        self._cache[name] = value
+
+    def _uncached_nodes(self: NodeType, name: str) -> List[NodeType]:
+        """Return the nodes of this subtree that do not have `name` cached, with
+        every node after its children, for computing it bottom-up. The subtrees
+        that already have it cached at their root are skipped."""
+        order: List[NodeType] = []
+        stack: List[NodeType] = [self]
+        while stack:
+            node = stack.pop()
+            cache = node._cache
+            if cache is not None and name in cache:
+                continue
+            order.append(node)
+            if node.left is not None:
+                stack.append(node.left)
+            if node.right is not None:
+                stack.append(node.right)
+        order.reverse()
+        return order
+
+    def _set_cache_above(self, name: str, value: Any) -> None:
+        """Like `_set_cache`, for a node whose children already have caches, which
+        is the case when caching a value bottom-up."""
+        cache = self._cache
+        if cache is None or cache is _EMPTY_CACHE:
+            self._cache = {name: value}
+        else:
+            cache[name] = value
+
+    def invalidate(self) -> None:
+        """Drop the cached data of this node and of all its ancestors, whose
+        subtrees include this one. Call this after changing the structure of the
+        tree without using `set_left`, `set_right`, or `rotate`."""
+        node: Optional[BinaryTreeNode] = self
+        # A node without a cache has no ancestors with one
+        while node is not None and node._cache is not None:
+            node._cache = None
+            node = node.parent
+
+    def _copy_node(self: NodeType) -> NodeType:
+        """Return a copy of this node without its children or parent.
+
+        The copy is made without calling `__init__`. Subclasses that add
+        attributes in `__slots__` should extend this to copy them. Attributes in
+        an instance `__dict__` are copied shallowly."""
+        result = object.__new__(type(self))
+        result.left = result.right = result.parent = None
+        result._id = self._id
+        result._meta = None
+        result._cache = None
+        if hasattr(self, "__dict__"):
+            result.__dict__.update(self.__dict__)
+        return result
 
     def clone(self: NodeType) -> NodeType:
         """Create a clone of this tree"""
-        result = self.__class__()  # type:ignore
-        result.id = self.id
-        if self.left:
-            result.set_left(self.left.clone())  # type:ignore
-
-        if self.right:
-            result.set_right(self.right.clone())  # type:ignore
+        return self._clone_tree(None)
+
+    def clone_with_mapping(self: NodeType) -> Tuple[NodeType, Dict[Any, NodeType]]:
+        """Create a clone of this tree, and return it with a dict that maps each
+        node of this tree to its copy."""
+        mapping: Dict[Any, NodeType] = {}
+        return self._clone_tree(mapping), mapping
+
+    def _clone_tree(self: NodeType, mapping: Optional[Dict[Any, NodeType]]) -> NodeType:
+        """Copy the tree in one pass with an explicit stack, without running the
+        constructor of every node."""
+        result = self._copy_node()
+        stack: List[Tuple[NodeType, NodeType]] = [(self, result)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            original, copy = pop()
+            if mapping is not None:
+                mapping[original] = copy
+            child = original.left
+            if child is not None:
+                child_copy = child._copy_child(push, mapping)
+                copy.left = child_copy
+                child_copy.parent = copy
+            child = original.right
+            if child is not None:
+                child_copy = child._copy_child(push, mapping)
+                copy.right = child_copy
+                child_copy.parent = copy
         return result
 
+    def _copy_child(
+        self: NodeType,
+        push: Callable[[Tuple[NodeType, NodeType]], None],
+        mapping: Optional[Dict[Any, NodeType]],
+    ) -> NodeType:
+        """Copy a child node for `_clone_tree`, and queue its children to be
+        copied. A subtree whose class overrides `clone` is copied by calling it."""
+        if type(self).clone is BinaryTreeNode.clone:
+            copy = self._copy_node()
+            push((self, copy))
+            return copy
+        copy = self.clone()
+        if mapping is not None:
+            mapping.update(zip(self.iter_preorder(), copy.iter_preorder()))
+        return copy
+
     def is_leaf(self) -> bool:
         """Is this node a leaf?  A node is a leaf if it has no children."""
         return not self.left and not self.right
@@ -104,15 +315,86 @@ class BinaryTreeNode(Generic[NodeType]):
             parent.parent = node
 
         node.parent = grand_parent
-        if not grand_parent:
-            return self
-
-        if parent == grand_parent.left:
-            grand_parent.left = node
-        else:
-            grand_parent.right = node
+        if grand_parent:
+            if parent == grand_parent.left:
+                grand_parent.left = node
+            else:
+                grand_parent.right = node
+        node.invalidate()
         return self
 
+    def iter_preorder(self: NodeType) -> Iterator[NodeType]:
+        """Iterate over the tree preorder, yielding the current node, then the nodes
+        of its left child, and then those of its right child.
+
+        *Visit -> Left -> Right*
+
+        The tree is walked with an explicit stack, so deep trees do not hit the
+        recursion limit. Stop iterating early by breaking out of the loop.
+        """
+        stack: List[NodeType] = [self]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+            yield node
+            right = node.right
+            if right is not None:
+                push(right)
+            left = node.left
+            if left is not None:
+                push(left)
+
+    def iter_inorder(self: NodeType) -> Iterator[NodeType]:
+        """Iterate over the tree inorder, yielding the nodes of the left child, then
+        the current node, and then the nodes of its right child.
+
+        *Left -> Visit -> Right*
+
+        The tree is walked with an explicit stack, so deep trees do not hit the
+        recursion limit. Stop iterating early by breaking out of the loop.
+        """
+        stack: List[NodeType] = []
+        pop = stack.pop
+        push = stack.append
+        node: Optional[NodeType] = self
+        while True:
+            while node is not None:
+                push(node)
+                node = node.left
+            if not stack:
+                return
+            node = pop()
+            yield node
+            node = node.right
+
+    def iter_postorder(self: NodeType) -> Iterator[NodeType]:
+        """Iterate over the tree postorder, yielding the nodes of the left child, then
+        those of the right child, and finally the current node.
+
+        *Left -> Right -> Visit*
+
+        The tree is walked with an explicit stack, so deep trees do not hit the
+        recursion limit. Stop iterating early by breaking out of the loop.
+        """
+        # Each node is pushed twice: first to expand its children, and then, with
+        # `expanded` set, to be yielded after them.
+        stack: List[Tuple[NodeType, bool]] = [(self, False)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node, expanded = pop()
+            if expanded:
+                yield node
+                continue
+            push((node, True))
+            right = node.right
+            if right is not None:
+                push((right, False))
+            left = node.left
+            if left is not None:
+                push((left, False))
+
     def visit_preorder(
         self,
         visit_fn: VisitFunction[Any, Any],
@@ -132,14 +414,21 @@ class BinaryTreeNode(Generic[NodeType]):
 
             Traversals may be canceled by returning `STOP` from any visit function.
         """
-        if visit_fn and visit_fn(self, depth, data) == STOP:  # type:ignore
-            return STOP
-
-        if self.left and self.left.visit_preorder(visit_fn, depth + 1, data) == STOP:
-            return STOP
-
-        if self.right and self.right.visit_preorder(visit_fn, depth + 1, data) == STOP:
-            return STOP
+        if visit_fn is None:
+            return None
+        stack: List[Tuple[BinaryTreeNode, int]] = [(self, depth)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node, node_depth = pop()
+            if visit_fn(node, node_depth, data) == STOP:  # type:ignore
+                return STOP
+            right = node.right
+            if right is not None:
+                push((right, node_depth + 1))
+            left = node.left
+            if left is not None:
+                push((left, node_depth + 1))
         return None
 
     def visit_inorder(
@@ -161,15 +450,24 @@ class BinaryTreeNode(Generic[NodeType]):
 
             Traversals may be canceled by returning `STOP` from any visit function.
         """
-        if self.left and self.left.visit_inorder(visit_fn, depth + 1, data) == STOP:
-            return STOP
-
-        if visit_fn and visit_fn(self, depth, data) == STOP:  # type:ignore
-            return STOP
-
-        if self.right and self.right.visit_inorder(visit_fn, depth + 1, data) == STOP:
-            return STOP
-        return None
+        if visit_fn is None:
+            return None
+        stack: List[Tuple[BinaryTreeNode, int]] = []
+        pop = stack.pop
+        push = stack.append
+        node: Optional[BinaryTreeNode] = self
+        while True:
+            while node is not None:
+                push((node, depth))
+                node = node.left
+                depth += 1
+            if not stack:
+                return None
+            node, depth = pop()
+            if visit_fn(node, depth, data) == STOP:  # type:ignore
+                return STOP
+            node = node.right
+            depth += 1
 
     def visit_postorder(
         self,
@@ -190,14 +488,25 @@ class BinaryTreeNode(Generic[NodeType]):
 
             Traversals may be canceled by returning `STOP` from any visit function.
         """
-        if self.left and self.left.visit_postorder(visit_fn, depth + 1, data) == STOP:
-            return STOP
-
-        if self.right and self.right.visit_postorder(visit_fn, depth + 1, data) == STOP:
-            return STOP
-
-        if visit_fn and visit_fn(self, depth, data) == STOP:  # type:ignore
-            return STOP
+        if visit_fn is None:
+            return None
+        # Each node is pushed twice, as in `iter_postorder`
+        stack: List[Tuple[BinaryTreeNode, int, bool]] = [(self, depth, False)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node, node_depth, expanded = pop()
+            if expanded:
+                if visit_fn(node, node_depth, data) == STOP:  # type:ignore
+                    return STOP
+                continue
+            push((node, node_depth, True))
+            right = node.right
+            if right is not None:
+                push((right, node_depth + 1, False))
+            left = node.left
+            if left is not None:
+                push((left, node_depth + 1, False))
         return None
 
     def get_root(self: NodeType) -> NodeType:
@@ -236,7 +545,7 @@ class BinaryTreeNode(Generic[NodeType]):
         self.left = child
         if self.left:
             self.left.parent = self
-
+        self.invalidate()
         return self
 
     def set_right(
@@ -252,7 +561,7 @@ class BinaryTreeNode(Generic[NodeType]):
         self.right = child
         if self.right:
             self.right.parent = self
-
+        self.invalidate()
         return self
 
     def get_side(self, child: Optional[NodeType]) -> Literal["left", "right"]:
@@ -309,5 +618,6 @@ __all__ = (
     "VisitStop",
     "VisitDataType",
     "VisitFunction",
+    "NodeId",
     "BinaryTreeNode",
 )
@@ -1,6 +1,17 @@
 import math
 import random
-from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple, Union, cast
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
 import numpy as np
 from wasabi import TracebackPrinter  # type: ignore
@@ -16,9 +27,10 @@ from .expressions import (
     PowerExpression,
     SubtractExpression,
     VariableExpression,
+    exact_numbers_enabled,
 )
 from .parser import ExpressionParser
-from .tree import LEFT, VisitStop
+from .tree import LEFT
 from .types import Literal, NumberType
 
 
@@ -54,62 +66,174 @@ def raise_with_history(
     raise ValueError(error)
 
 
-def compare_expression_values(
+def _sample_values(count: int) -> np.ndarray:
+    """Return `count` whole numbers from 1 to 100 as floats, drawn from the `random`
+    module so that seeding it repeats them"""
+    if count == 0:
+        return np.empty(0, dtype=np.float64)
+    data = random.getrandbits(16 * count).to_bytes(2 * count, "little")
+    # The remainders of 16 bit numbers are close enough to uniform
+    values = np.frombuffer(data, dtype="<u2") % 100 + 1
+    return values.astype(np.float64)
+
+
+class EquivalenceResult(NamedTuple):
+    equivalent: bool
+    reason: Optional[str]
+    from_variables: FrozenSet[str]
+    to_variables: FrozenSet[str]
+    point: Optional[Dict[str, NumberType]]
+    from_value: Optional[NumberType]
+    to_value: Optional[NumberType]
+
+
+# fmt: off
+EquivalenceResult.equivalent.__doc__ = "True if the expressions had the same value at every point" # noqa
+EquivalenceResult.reason.__doc__ = "Why the expressions are not equivalent, or None if they are" # noqa
+EquivalenceResult.from_variables.__doc__ = "The variables in the first expression" # noqa
+EquivalenceResult.to_variables.__doc__ = "The variables in the second expression" # noqa
+EquivalenceResult.point.__doc__ = "The variable values of the first point where the values differed" # noqa
+EquivalenceResult.from_value.__doc__ = "The value of the first expression at that point" # noqa
+EquivalenceResult.to_value.__doc__ = "The value of the second expression at that point" # noqa
+# fmt: on
+
+
+def check_expression_equivalence(
     from_expression: MathExpression,
     to_expression: MathExpression,
-    history: Optional[List[Any]] = None,
-) -> None:
-    """Compare and evaluate two expressions to verify they have the same value"""
-    vars_from: Set[str] = set(
-        v.identifier
-        for v in from_expression.find_type(VariableExpression)
-        if v.identifier
-    )
-    vars_to: Set[str] = set(
-        v.identifier
-        for v in to_expression.find_type(VariableExpression)
-        if v.identifier
-    )
+    points: int = 32,
+    exact_numbers: Optional[bool] = None,
+) -> EquivalenceResult:
+    """Check that two expressions have the same variables, and the same value at
+    a number of random points, where each variable is a whole number from 1 to 100.
+
+    Both expressions are evaluated at all the points at once with
+    `evaluate_batch`, which compiles trees that are checked more than once. The
+    points are drawn from the `random` module, so seeding it makes them repeat.
+    Values are equal if they are within a relative tolerance of 1e-9, or are both
+    NaN, e.g. because of a division by zero.
+
+    With `exact_numbers`, or when it is None, inside `use_exact_numbers`, the
+    variables are ints, and each point is evaluated with the expressions compiled
+    for exact numbers instead, so that whole numbers and fractions are compared
+    exactly. Only values that are still floats, e.g. fractional powers, use the
+    tolerance.
+
+    # Arguments
+    from_expression (MathExpression): The expression before a change
+    to_expression (MathExpression): The expression after a change
+    points (int): The number of points to compare the values at
+    exact_numbers (Optional[bool]): Whether to compare exact values
+
+    # Returns
+    (EquivalenceResult): Whether the expressions are equivalent, and if not why,
+        and the point where they differed
+    """
+    vars_from = frozenset(v for v in from_expression.variables if v)
+    vars_to = frozenset(v for v in to_expression.variables if v)
     # If there are not the same unique vars in the two expressions, something
     # bad happened, and the two expressions can only coincidentally be equal
     # in value.
-    if len(vars_from) != len(vars_to):
-        raise_with_history(
-            "Number of variables changed",
-            f"{list(vars_from)} != {list(vars_to)}",
-            history,
+    if vars_from != vars_to:
+        if len(vars_from) != len(vars_to):
+            reason = "Number of variables changed"
+        else:
+            reason = "Unique variables changed"
+        return EquivalenceResult(False, reason, vars_from, vars_to, None, None, None)
+    names = sorted(vars_from)
+    samples = _sample_values(len(names) * points).reshape(len(names), points)
+    if exact_numbers is None:
+        exact_numbers = exact_numbers_enabled()
+    if exact_numbers:
+        return _check_exact_equivalence(
+            from_expression, to_expression, names, samples.astype(int).T.tolist()
         )
+    bindings = dict(zip(names, samples))
+    values_from = np.broadcast_to(from_expression.evaluate_batch(bindings), points)
+    values_to = np.broadcast_to(to_expression.evaluate_batch(bindings), points)
+    with np.errstate(invalid="ignore"):
+        tolerance = 1e-9 * np.maximum(np.abs(values_from), np.abs(values_to))
+        same = (
+            (values_from == values_to)
+            | (np.abs(values_from - values_to) <= tolerance)
+            | (np.isnan(values_from) & np.isnan(values_to))
+        )
+    if same.all():
+        return EquivalenceResult(True, None, vars_from, vars_to, None, None, None)
+    i = int(np.argmin(same))
+    return EquivalenceResult(
+        False,
+        "Expression value changed",
+        vars_from,
+        vars_to,
+        {name: float(values[i]) for name, values in bindings.items()},
+        float(values_from[i]),
+        float(values_to[i]),
+    )
 
-    sorted_from = list(vars_from)
-    sorted_from.sort()
-    sorted_to = list(vars_from)
-    sorted_to.sort()
 
-    if sorted_from != sorted_to:
-        raise_with_history(
-            "Unique variables changed",
-            f"{sorted_from} != {sorted_to}",
-            history,
-        )
+def _exact_values_match(one: NumberType, two: NumberType) -> bool:
+    if one == two:
+        return True
+    if not isinstance(one, float) and not isinstance(two, float):
+        return False
+    if math.isnan(one) or math.isnan(two):
+        return math.isnan(one) and math.isnan(two)
+    return abs(one - two) <= 1e-9 * max(abs(one), abs(two))
 
-    # Generate random values for each variable, and then evaluate the expressions
-    eval_context: Dict[str, NumberType] = {}
-    for var in vars_from:
-        eval_context[var] = float(random.randint(1, 100))
 
-    value_from = from_expression.evaluate(eval_context)
-    value_to = to_expression.evaluate(eval_context)
+def _check_exact_equivalence(
+    from_expression: MathExpression,
+    to_expression: MathExpression,
+    names: List[str],
+    points: List[List[int]],
+) -> EquivalenceResult:
+    vars_from = frozenset(names)
+    evaluate_from = from_expression.compile(exact_numbers=True)
+    evaluate_to = to_expression.compile(exact_numbers=True)
+    for values in points:
+        point: Dict[str, NumberType] = dict(zip(names, values))
+        value_from = evaluate_from(point)
+        value_to = evaluate_to(point)
+        if not _exact_values_match(value_from, value_to):
+            return EquivalenceResult(
+                False,
+                "Expression value changed",
+                vars_from,
+                vars_from,
+                point,
+                value_from,
+                value_to,
+            )
+    return EquivalenceResult(True, None, vars_from, vars_from, None, None, None)
 
+
+def compare_expression_values(
+    from_expression: MathExpression,
+    to_expression: MathExpression,
+    history: Optional[List[Any]] = None,
+) -> None:
+    """Compare and evaluate two expressions to verify they have the same value.
+
+    Raises ValueError with the steps in `history` if they do not. See
+    `check_expression_equivalence` for how they are compared."""
+    result = check_expression_equivalence(from_expression, to_expression)
+    if result.equivalent:
+        return
+    assert result.reason is not None
+    if result.point is None:
+        vars_from, vars_to = sorted(result.from_variables), sorted(result.to_variables)
+        raise_with_history(result.reason, f"{vars_from} != {vars_to}", history)
+    value_from, value_to = result.from_value, result.to_value
     # Print out the problem steps leading up to error result.
-    if not math.isclose(value_from, value_to, rel_tol=1e-9, abs_tol=0.0):
-        changed = f"""
+    changed = f"""
         {from_expression} = {value_from}
 
         {to_expression} = {value_to}
 
-        {value_from} != {value_to}
+        {value_from} != {value_to} at {result.point}
         """
-        raise_with_history("Expression value changed", changed, history)
+    raise_with_history(result.reason, changed, history)
 
 
 def compare_equation_values(
@@ -158,13 +282,10 @@ def factor(value: NumberType) -> Dict[NumberType, NumberType]:
     """
     if value == 0 or math.isnan(value):
         return {}
-    np.seterr(invalid="ignore")  # type:ignore
-    sqrt: float = np.sqrt(value)  # type:ignore
-    np.seterr(invalid="warn")  # type:ignore
-    if math.isnan(sqrt):
+    if value < 0:
         return {1: value}
 
-    sqrt = int(sqrt + 1)
+    sqrt = int(math.sqrt(value) + 1)
     factors: Dict[NumberType, NumberType] = {1: value}
     factors[value] = 1
 
@@ -474,24 +595,21 @@ def get_term(node: MathExpression) -> Union[TermResult, Literal[False]]:
 
     # TODO: Comment resolution on whether +- is OKAY, and if not, why it breaks down.
     if not is_add_or_sub(node):
-        if (
-            len(node.find_type(AddExpression)) > 0
-            or len(node.find_type(SubtractExpression)) > 0
-        ):
+        if node.contains(AddExpression) or node.contains(SubtractExpression):
             return False
 
     # If another add is found on the left side of this node, and the right node
     # is _NOT_ a leaf, we cannot extract a term.  If it is a leaf, the term should be
     # just the right node.
-    if node.left and len(node.left.find_type(AddExpression)) > 0:
+    if node.left and node.left.contains(AddExpression):
         if node.right and not node.right.is_leaf():
             return False
 
-    if node.right and len(node.right.find_type(AddExpression)) > 0:
+    if node.right and node.right.contains(AddExpression):
         return False
 
-    exponents = node.find_type(PowerExpression)
-    if len(exponents) > 0:
+    if node.contains(PowerExpression):
+        exponents = node.find_type(PowerExpression)
         # Supports only single exponents in terms
         if len(exponents) != 1:
             return False
@@ -718,18 +836,13 @@ def get_terms(expression: MathExpression) -> List[MathExpression]:
     root = expression.get_root()
     if isinstance(root, MultiplyExpression):
         results.append(root)
-
-    def visit_fn(node: MathExpression, depth: int, data: Any) -> Optional[VisitStop]:
-        nonlocal results
+    for node in root.iter_inorder():
         if not is_add_or_sub(node):
-            return None
+            continue
         if node.left and not is_add_or_sub(node.left):
             results.append(node.left)
         if node.right and not is_add_or_sub(node.right):
             results.append(node.right)
-        return None
-
-    root.visit_inorder(visit_fn)
     return [expression] if len(results) == 0 else results
 
 
@@ -822,6 +935,8 @@ __all__ = (
     "compare_expression_string_values",
     "raise_with_history",
     "compare_expression_values",
+    "check_expression_equivalence",
+    "EquivalenceResult",
     "compare_equation_values",
     "unlink",
     "factor",
@@ -1,8 +1,36 @@
 from typing import Any, Optional
 
+from mathy_core.expressions import AbsExpression, FunctionExpression
+from mathy_core.parser import ExpressionParser
+from mathy_core.tokenizer import Tokenizer
 from mathy_core.tree import BinaryTreeNode
 
 
+class DoubleExpression(FunctionExpression):
+    """A custom function that doubles its argument, for testing user functions"""
+
+    @property
+    def name(self) -> str:
+        return "double"
+
+    def operate(self, value: float) -> float:
+        return value * 2
+
+
+def add_test_functions(tokenizer: Tokenizer) -> Tokenizer:
+    """Register the abs and double functions with a tokenizer, and return it"""
+    tokenizer.functions["abs"] = AbsExpression
+    tokenizer.functions["double"] = DoubleExpression
+    return tokenizer
+
+
+def make_parser(**kwargs: Any) -> ExpressionParser:
+    """Return a parser that knows the abs and double functions"""
+    parser = ExpressionParser(**kwargs)
+    add_test_functions(parser.tokenizer)
+    return parser
+
+
 class BinarySearchTree(BinaryTreeNode):
     left: Optional["BinarySearchTree"]
     right: Optional["BinarySearchTree"]
@@ -0,0 +1,120 @@
+import math
+
+import numpy as np
+import pytest
+
+from mathy_core.arrays import ExpressionArray
+from mathy_core.expressions import (
+    AddExpression,
+    FactorialExpression,
+    VariableExpression,
+)
+from mathy_core.parser import ExpressionParser
+from mathy_core.problems import gen_simplify_multiple_terms
+from mathy_core.util import get_terms
+
+from .conftest import DoubleExpression, make_parser
+
+_EXAMPLES = [
+    "4x + 2y^3 * 7!",
+    "-(x - 2.5) / sgn(y) + 12",
+    "(8x^2 * 9b) * 7 - -3",
+    "(x + 2) * y",
+    "abs(-x)",
+    "7",
+    "2x = 4 + 2x - 4",
+]
+
+
+@pytest.mark.parametrize("text", _EXAMPLES)
+def test_arrays_round_trip(text: str) -> None:
+    parser = make_parser()
+    expression = parser.parse(text)
+    array = ExpressionArray.from_expression(expression)
+    assert len(array) == len(expression.to_list())
+    assert array.num_trees == 1
+    restored = array.to_expression()
+    assert str(restored) == str(expression)
+    assert [type(n) for n in restored.to_list()] == [
+        type(n) for n in expression.to_list()
+    ]
+
+
+def test_arrays_structure() -> None:
+    expression = ExpressionParser().parse("4x + 2")
+    array = ExpressionArray.from_expression(expression)
+    # inorder: 4, *, x, +, 2
+    assert array.roots.tolist() == [3]
+    assert array.left.tolist() == [-1, 0, -1, 1, -1]
+    assert array.right.tolist() == [-1, 2, -1, 4, -1]
+    assert array.parent.tolist() == [1, 3, 1, -1, 3]
+    assert array.type_ids.tolist() == [10, 5, 50, 3, 10]
+    assert array.values[[0, 4]].tolist() == [4, 2]
+    assert np.isnan(array.values[[1, 2, 3]]).all()
+    assert array.variable_names == ("x",)
+    assert array.variables.tolist() == [-1, -1, 0, -1, -1]
+    assert array.depths().tolist() == [2, 1, 2, 0, 1]
+
+
+def test_arrays_many_trees() -> None:
+    parser = ExpressionParser()
+    expressions = [parser.parse(text) for text in ["4x + 2", "y", "x * 3y"]]
+    array = ExpressionArray.from_expressions(expressions)
+    assert array.num_trees == 3
+    assert array.tree_ids.tolist() == [0, 0, 0, 0, 0, 1, 2, 2, 2, 2, 2]
+    assert array.variable_names == ("x", "y")
+    restored = array.to_expressions()
+    assert [str(e) for e in restored] == [str(e) for e in expressions]
+
+
+def test_arrays_evaluate() -> None:
+    parser = make_parser()
+    texts = [t for t in _EXAMPLES if "=" not in t] + ["x / 0", "2x = x + 2"]
+    expressions = [parser.parse(text) for text in texts]
+    context = {"x": 2, "y": -1.5, "b": 3}
+    values = ExpressionArray.from_expressions(expressions).evaluate(context)
+    for expression, value in zip(expressions, values.tolist()):
+        expected = expression.evaluate(context)
+        if math.isnan(expected):
+            assert math.isnan(value)
+        else:
+            assert value == pytest.approx(expected)
+
+
+def test_arrays_evaluate_matches_batch() -> None:
+    rest = ExpressionParser().parse("2^x / (x - 1)")
+    expression = AddExpression(FactorialExpression(VariableExpression("x")), rest)
+    xs = [-2.0, 0.0, 1.0, 3.5, 200.0]
+    array = ExpressionArray.from_expression(expression)
+    values = [array.evaluate({"x": x})[0] for x in xs]
+    batch = expression.evaluate_batch({"x": xs})
+    np.testing.assert_array_equal(values, batch)
+    assert math.isnan(values[0])
+
+
+def test_arrays_evaluate_errors() -> None:
+    parser = ExpressionParser()
+    array = ExpressionArray.from_expression(parser.parse("4x + y"))
+    with pytest.raises(ValueError, match="None variable: y"):
+        array.evaluate({"x": 2})
+    array = ExpressionArray.from_expression(parser.parse("4x = 7"))
+    with pytest.raises(ValueError, match="did not hold"):
+        array.evaluate({"x": 2})
+
+
+def test_arrays_evaluate_custom_function() -> None:
+    parser = make_parser()
+    array = ExpressionArray.from_expression(parser.parse("double(x) + 1"))
+    assert array.type_ids.tolist() == [-1, 50, 3, 10]
+    assert array.evaluate({"x": 4}).tolist() == [9]
+    assert isinstance(array.to_expression().left, DoubleExpression)
+
+
+def test_arrays_get_terms() -> None:
+    parser = ExpressionParser()
+    texts = _EXAMPLES + [gen_simplify_multiple_terms(6)[0] for _ in range(20)]
+    expressions = [parser.parse(text) for text in texts]
+    array = ExpressionArray.from_expressions(expressions)
+    nodes = [node for e in expressions for node in e.to_list("inorder")]
+    expected = [id(term) for e in expressions for term in get_terms(e)]
+    assert [id(nodes[i]) for i in array.get_terms().tolist()] == expected
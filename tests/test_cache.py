@@ -0,0 +1,52 @@
+from mathy_core.cache import CacheStats, LRUCache
+
+
+def test_cache_lru_eviction_order() -> None:
+    cache: LRUCache[str, int] = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # Reading "a" makes "b" the least recently used value
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache.stats == CacheStats(
+        hits=1, misses=0, evictions=1, entries=2, weight=2
+    )
+    # Peeking does not count or mark "a" as used, so it is evicted next
+    assert cache.peek("a") == 1 and cache.peek("b") is None
+    cache.put("d", 4)
+    assert "a" not in cache
+    assert cache.stats.hits == 1 and cache.stats.misses == 0
+
+
+def test_cache_max_weight() -> None:
+    cache: LRUCache[str, str] = LRUCache(max_weight=10)
+    cache.put("one", "one", weight=4)
+    cache.put("two", "two", weight=4)
+    cache.put("three", "three", weight=4)
+    assert "one" not in cache
+    assert cache.stats.weight == 8
+    # Values heavier than the whole cache are not stored
+    cache.put("huge", "huge", weight=11)
+    assert "huge" not in cache
+    assert cache.get("huge") is None
+    assert cache.stats.misses == 1
+
+
+def test_cache_disabled_and_clear() -> None:
+    disabled: LRUCache[str, int] = LRUCache(max_entries=0)
+    assert not disabled.enabled
+    disabled.put("a", 1)
+    assert len(disabled) == 0
+
+    cache: LRUCache[str, int] = LRUCache()
+    cache.put("a", 1)
+    cache.put("a", 2, weight=3)
+    assert cache.get("a") == 2
+    assert cache.stats.weight == 3
+    cache.clear()
+    assert len(cache) == 0 and cache.stats.weight == 0
+    assert cache.stats.hits == 1
+    cache.reset_stats()
+    assert cache.stats.hits == 0
@@ -0,0 +1,77 @@
+import pytest
+
+from mathy_core.canonical import canonical_key, canonicalize
+from mathy_core.expressions import AddExpression, ConstantExpression, VariableExpression
+from mathy_core.parser import ExpressionParser
+
+from .conftest import make_parser
+
+
+@pytest.mark.parametrize(
+    "one,two",
+    [
+        ("2x + 3y", "3y + 2x"),
+        ("(a + b) + c", "a + (c + b)"),
+        ("x * y * 4", "4 * (y * x)"),
+        ("2x = 4 + x", "x + 4 = x * 2"),
+        ("(x + 2)^2 - y", "(2 + x)^2 - y"),
+        ("sgn(b * a) + 1", "1 + sgn(a * b)"),
+        ("x + 2", "x + 2.0"),
+    ],
+)
+def test_canonical_key_equivalent(one: str, two: str) -> None:
+    parser = ExpressionParser()
+    assert canonical_key(parser.parse(one)) == canonical_key(parser.parse(two))
+
+
+@pytest.mark.parametrize(
+    "one,two",
+    [
+        ("x - y", "y - x"),
+        ("x / 2", "2 / x"),
+        ("x^2", "2^x"),
+        ("2x + y", "2y + x"),
+        ("(x + y) * z", "x + y * z"),
+        ("x + 2", "x + 2.5"),
+        ("xy", "x + y"),
+    ],
+)
+def test_canonical_key_different(one: str, two: str) -> None:
+    parser = ExpressionParser()
+    assert canonical_key(parser.parse(one)) != canonical_key(parser.parse(two))
+
+
+def test_canonical_key_subtree_and_custom_types() -> None:
+    parser = make_parser()
+    # Only the chain under the given node is used, not the one above it
+    tree = parser.parse("4 + (y + x) + 2")
+    assert canonical_key(tree.left.right) == canonical_key(parser.parse("x + y"))
+    one = parser.parse("double(x + 2)")
+    two = parser.parse("double(2 + x)")
+    assert canonical_key(one) == canonical_key(two)
+    assert canonical_key(one) != canonical_key(parser.parse("sgn(x + 2)"))
+
+
+def test_canonical_key_wide_sums() -> None:
+    terms = [VariableExpression("x"), ConstantExpression(3)] * 1000
+    forward = terms[0]
+    for term in terms[1:]:
+        forward = AddExpression(forward, term.clone())
+    backward = terms[-1]
+    for term in reversed(terms[:-1]):
+        backward = AddExpression(term.clone(), backward)
+    assert canonical_key(forward) == canonical_key(backward)
+
+
+def test_canonicalize() -> None:
+    parser = ExpressionParser(max_cache_entries=0)
+    one = parser.parse("(b + 2a) + (4 * y * x)")
+    two = parser.parse("x * 4y + (a * 2 + b)")
+    canonical = canonicalize(one)
+    assert str(canonical) == str(canonicalize(two))
+    assert canonical_key(canonical) == canonical_key(one)
+    assert canonical.evaluate({"a": 2, "b": 3, "x": 5, "y": 7}) == one.evaluate(
+        {"a": 2, "b": 3, "x": 5, "y": 7}
+    )
+    # The input is left as it was
+    assert str(one) == "b + 2a + 4y * x"
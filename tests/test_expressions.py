@@ -1,3 +1,9 @@
+import math
+import re
+import threading
+from fractions import Fraction
+
+import numpy as np
 import pytest
 
 from mathy_core import (
@@ -8,6 +14,7 @@ from mathy_core import (
     DivideExpression,
     EqualExpression,
     ExpressionParser,
+    FactorialExpression,
     FunctionExpression,
     MathExpression,
     MultiplyExpression,
@@ -17,7 +24,12 @@ from mathy_core import (
     SubtractExpression,
     UnaryExpression,
     VariableExpression,
+    use_exact_numbers,
 )
+from mathy_core.canonical import canonical_key
+from mathy_core.rules import ConstantsSimplifyRule
+
+from .conftest import DoubleExpression, make_parser
 
 
 def test_expressions_get_children():
@@ -56,6 +68,32 @@ def test_expressions_terminal_text():
     assert expr.raw == "x"
 
 
+@pytest.mark.parametrize(
+    "text", ["4x + 2y^3 - 7 = sgn(z)", "-(x * 2) / 3!", "abs(-2)"]
+)
+def test_expressions_use_slots(text: str):
+    parser = make_parser()
+    for node in parser.parse(text).to_list():
+        assert not hasattr(node, "__dict__")
+        assert node._meta is None
+
+
+def test_expressions_side_table():
+    expr = AddExpression(VariableExpression("x"), ConstantExpression(2))
+    with pytest.raises(AttributeError):
+        expr.x
+    assert getattr(expr, "thread", None) is None
+    expr.x = 2.5
+    assert expr.x == 2.5 and expr._meta == {"x": 2.5}
+    del expr.x
+    assert expr._meta is None
+    with pytest.raises(AttributeError):
+        del expr.x
+    assert "x + 2" in expr.terminal_text
+    assert expr.left is not None and expr.left._meta is None
+    assert expr.classes == [expr.id]
+
+
 def test_expressions_add_class():
     expr = VariableExpression("x")
     expr.add_class("as_string")
@@ -156,10 +194,83 @@ def test_expressions_to_math_ml(text: str):
     assert "</math>" in ml_string
 
 
+def test_expressions_find_type_index():
+    expr: MathExpression = ExpressionParser().parse("4x + 2y * (7x^2 + 3) - 12z")
+
+    def walk(node: MathExpression, instanceType: type) -> list:
+        return [n for n in node.iter_inorder() if isinstance(n, instanceType)]
+
+    types = [VariableExpression, ConstantExpression, AddExpression, BinaryExpression]
+    for _ in range(2):
+        for node in expr.iter_inorder():
+            for instanceType in types:
+                assert node.find_type(instanceType) == walk(node, instanceType)
+    assert expr._get_cache("type_index") is not None
+    # Changing the tree drops the index
+    node = expr.find_type(ConstantExpression)[-1]
+    assert node.parent is not None
+    node.parent.set_right(VariableExpression("b"))
+    assert expr._get_cache("type_index") is None
+    assert expr.find_type(VariableExpression) == walk(expr, VariableExpression)
+    assert expr.find_type(VariableExpression) == walk(expr, VariableExpression)
+    # Replaced nodes keep their parent, but are not in the index of its tree
+    parser = ExpressionParser(max_cache_entries=0)
+    tree = parser.parse("4x + 2y")
+    old = tree.left
+    assert old is not None
+    for _ in range(2):
+        tree.find_type(ConstantExpression)
+    tree.set_left(parser.parse("3z"))
+    for _ in range(2):
+        assert [n.value for n in tree.find_type(ConstantExpression)] == [3, 2]
+    assert [n.value for n in old.find_type(ConstantExpression)] == [4]
+
+
+def test_expressions_subtree_metrics():
+    expr: MathExpression = ExpressionParser().parse("4x + 2y * (7x^2 + 3)")
+    assert expr.size == len(expr.to_list())
+    assert expr.height == 5
+    assert expr.variables == {"x", "y"}
+    assert expr.contains(PowerExpression) and expr.contains(BinaryExpression)
+    assert not expr.contains(DivideExpression)
+    # Only the queried node keeps its metrics, so the nodes stay small
+    assert all(node._get_cache("metrics") is None for node in expr.to_list()[1:])
+    assert expr.left is not None and expr.left.contains(ConstantExpression)
+    assert expr.left._get_cache("metrics") is None
+    for node in expr.iter_inorder():
+        assert node.size == len(node.to_list())
+        assert node.variables == {
+            n.identifier for n in node.find_type(VariableExpression)
+        }
+        for node_type in [AddExpression, ConstantExpression, PowerExpression]:
+            assert node.contains(node_type) == (len(node.find_type(node_type)) > 0)
+    leaf = expr.find_type(ConstantExpression)[0]
+    assert leaf.size == 1 and leaf.height == 0
+    # Changing a subtree updates the metrics of the nodes above it
+    power = expr.find_type(PowerExpression)[0]
+    assert power.parent is not None
+    divide = DivideExpression(VariableExpression("z"), leaf.clone())
+    power.parent.set_side(divide, power.parent.get_side(power))
+    assert expr.variables == {"x", "y", "z"}
+    assert expr.contains(DivideExpression) and not expr.contains(PowerExpression)
+    assert expr.size == len(expr.to_list())
+
+
 def test_expressions_find_id():
     expr: MathExpression = ExpressionParser().parse("4 / x")
     node: MathExpression = expr.find_type(VariableExpression)[0]
     assert expr.find_id(node.id) == node
+    assert expr.find_id(node._id) == node
+    assert expr.find_id("mn-0") is None
+
+
+def test_expressions_classes_are_lazy():
+    expr = VariableExpression("x")
+    assert expr.classes == [expr.id]
+    assert expr._meta is None
+    expr.add_class("foo")
+    assert sorted(expr.classes) == sorted([expr.id, "foo"])
+    assert expr._meta is not None
 
 
 @pytest.mark.parametrize("visit_order", ["preorder", "inorder", "postorder"])
@@ -192,6 +303,296 @@ def test_expressions_clone_root():
     assert b.parent is not None
     assert b.clone().parent is None
     assert b.clone_from_root().parent is not None
+    # Siblings with the same path of types each get their own clone
+    assert a.clone_from_root().value == 1100
+    assert b.clone_from_root().value == 100
+
+
+def test_expressions_clone_with_mapping():
+    parser = make_parser()
+    expr = parser.parse("4x^2 + abs(-y) * 7 = 12")
+    copy, mapping = expr.clone_with_mapping()
+    assert str(copy) == str(expr)
+    assert set(mapping) == set(expr.to_list())
+    for original, node in mapping.items():
+        assert original is not node
+        assert type(node) is type(original)
+        assert node.id == original.id and node.span == original.span
+        assert node._cache is None and node._meta is None
+        if node.parent is not None:
+            assert mapping[original.parent] is node.parent
+    abs_copy = copy.find_type(AbsExpression)[0]
+    assert abs_copy.child_on_left is False and abs_copy.child is abs_copy.right
+
+
+def test_expressions_clone_deep():
+    expr = ExpressionParser().parse(" + ".join(["x"] * 5000))
+    copy = expr.clone()
+    assert copy.size == expr.size
+    deepest = expr.find_type(VariableExpression)[0]
+    assert deepest.clone_from_root().get_root() is not expr
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "4x + 2y^3 * 7!",
+        "-(x - 2.5) / sgn(y) + 12",
+        "abs(-x) * sgn(-y) * sgn(0y)",
+        "x / (y - y)",
+        "2x = x + x",
+        "x = 2y",
+        "z + 1",
+        "7",
+    ],
+)
+def test_expressions_compile(text: str):
+    parser = make_parser()
+    expr = parser.parse(text)
+    compiled = expr.compile()
+    for context in [{"x": 2, "y": -1.5}, {"x": 3.0, "y": 1}, {}, None]:
+        try:
+            expected = expr.evaluate(context)
+        except ValueError as error:
+            with pytest.raises(ValueError, match=re.escape(str(error))):
+                compiled(context)
+            continue
+        value = compiled(context)
+        assert type(value) is type(expected)
+        assert str(value) == str(expected)
+
+
+def test_expressions_compile_custom_and_cached():
+    parser = make_parser(max_cache_entries=0)
+    expr = parser.parse("double(x) + 4")
+    compiled = expr.compile()
+    assert compiled({"x": 3}) == 10
+    assert expr.compile() is compiled
+    # Changing the tree drops the compiled function
+    constant = expr.find_type(ConstantExpression)[0]
+    constant.value = 5
+    assert expr.compile() is not compiled
+    assert expr.compile()({"x": 3}) == 11
+    expr.set_right(VariableExpression("y"))
+    assert expr.compile()({"x": 3, "y": 1}) == 7
+    # Nodes that cannot be evaluated raise the same errors when they are called
+    broken = AddExpression(VariableExpression("x")).compile()
+    with pytest.raises(ValueError, match="left/right children must both be valid"):
+        broken({"x": 1})
+
+
+def test_expressions_compile_deep():
+    expr = ExpressionParser().parse(" - ".join(["x"] * 5000))
+    assert expr.compile()({"x": 2}) == -9996
+
+
+def test_expressions_evaluate_native_numbers():
+    parser = make_parser()
+    for text, context, expected in [
+        ("2^70", {}, 2 ** 70),
+        ("x^-1", {"x": 2}, 0.5),
+        ("abs(x) * 3", {"x": -4}, 12),
+        ("x^0.5", {"x": 6.25}, 2.5),
+    ]:
+        expr = parser.parse(text)
+        for value in [expr.evaluate(context), expr.compile()(context)]:
+            assert type(value) is type(expected) and value == expected
+    power = PowerExpression(VariableExpression("x"), VariableExpression("y"))
+    assert math.isnan(power.evaluate({"x": -8.0, "y": 1 / 3}))
+    assert power.evaluate({"x": 10.0, "y": 400}) == math.inf
+    assert power.evaluate({"x": -10.0, "y": 401}) == -math.inf
+    assert power.evaluate({"x": 0, "y": -2}) == math.inf
+    assert power.evaluate({"x": 3, "y": 10 ** 9}) == math.inf
+    assert power.evaluate({"x": -(10 ** 400), "y": 3}) == -math.inf
+    # Int powers too large for a float are inf, so later float math works
+    for text, context in [("3^700 * 0.5", {}), ("x^700 / 7", {"x": 3})]:
+        expr = parser.parse(text)
+        assert expr.evaluate(context) == expr.compile()(context) == math.inf
+    assert power.evaluate({"x": -3, "y": 701}) == -math.inf
+    assert parser.parse("2^1000").evaluate() == 2 ** 1000
+
+
+def test_expressions_exact_numbers():
+    parser = ExpressionParser(exact_numbers=True)
+    for text, context, expected in [
+        ("1/3 + 1/6", {}, Fraction(1, 2)),
+        ("0.1 + 0.2", {}, Fraction(3, 10)),
+        ("x / 4 * 8", {"x": 3}, 6),
+        ("2^-3 - x", {"x": 1}, Fraction(-7, 8)),
+        ("0.5^-3", {}, 8),
+        ("10^400 / 10^399", {}, 10),
+        ("(3^40 + 1) / 3^40", {}, Fraction(3 ** 40 + 1, 3 ** 40)),
+        ("x / 0", {"x": 1}, math.nan),
+        ("x^0.5", {"x": 6.25}, 2.5),
+    ]:
+        expr = parser.parse(text)
+        compiled = expr.compile(exact_numbers=True)
+        for value in [expr.evaluate(context, exact_numbers=True), compiled(context)]:
+            if isinstance(expected, float) and math.isnan(expected):
+                assert math.isnan(value)
+            else:
+                assert value == expected
+                assert isinstance(value, float) == isinstance(expected, float)
+    # Whole quotients and powers are ints, so later math stays on ints
+    for text in ["12 / 4", "0.5^-3", "1.5^2 * 4 / 9"]:
+        assert type(parser.parse(text).evaluate(exact_numbers=True)) is int
+    assert parser.parse("10^400").evaluate(exact_numbers=True) == 10 ** 400
+    # Exact powers are not rounded to inf, and ones too large to compute raise
+    with pytest.raises(OverflowError):
+        parser.parse("3^100000000").evaluate(exact_numbers=True)
+    assert parser.parse("10^400").evaluate() == math.inf
+    # Constants fold and print exactly, and the text parses back the same
+    tree = parser.parse("x + (1/3 + 1/6)", use_cache=False)
+    rule = ConstantsSimplifyRule()
+    with use_exact_numbers():
+        node = rule.find_node(tree)
+        while node is not None:
+            tree = rule.apply_to(node).result.get_root()
+            node = rule.find_node(tree)
+    assert str(tree) == "x + 0.5"
+    for value, text in [
+        (Fraction(3, 8), "0.375"),
+        (Fraction(-1, 40), "-0.025"),
+        (Fraction(1, 3), "(1/3)"),
+        (Fraction(-22, 7), "(-22/7)"),
+        (Fraction(4, 2), "2"),
+    ]:
+        constant = ConstantExpression(value)
+        assert str(constant) == text
+        assert parser.parse(text).evaluate(exact_numbers=True) == value
+    assert canonical_key(ConstantExpression(Fraction(4, 2))) == canonical_key(
+        ConstantExpression(2)
+    )
+    # Other parsers and calls, and other threads, still use floats
+    tree = parser.parse("1 / 2")
+    assert type(ExpressionParser().parse("0.5").evaluate()) is float
+    assert type(tree.evaluate()) is float
+    assert type(tree.compile()(None)) is float
+    results = []
+    with use_exact_numbers():
+        assert type(tree.evaluate()) is Fraction
+        assert type(tree.evaluate(exact_numbers=False)) is float
+        thread = threading.Thread(target=lambda: results.append(tree.evaluate()))
+        thread.start()
+        thread.join()
+    assert type(results[0]) is float
+
+
+def test_expressions_evaluate_cached(monkeypatch):
+    # Cache the values of the small trees below
+    monkeypatch.setattr("mathy_core.expressions._MIN_CACHED_EVALUATE_NODES", 1)
+    parser = make_parser(max_cache_entries=0)
+    tree = parser.parse("(4x + 2y^3) * 7 - abs(x / y) + 12")
+    context = {"x": 3, "y": 2}
+    assert tree.evaluate_cached(context) == tree.evaluate(context)
+    inner = tree.left.left.left
+    assert isinstance(inner, AddExpression)
+    assert inner._get_cache("value")[1] == 28
+    # A local change drops the values on the path to the root, and nothing else
+    constant = inner.left.left
+    assert isinstance(constant, ConstantExpression)
+    constant.value = 5
+    assert inner._get_cache("value") is None and tree._get_cache("value") is None
+    assert tree.right._get_cache("value") is None  # constants are not cached
+    sibling = tree.left.right
+    assert sibling._get_cache("value") is not None
+    assert tree.evaluate_cached(context) == tree.evaluate(context)
+    inner.set_right(parser.parse("y^2"))
+    assert tree.evaluate_cached(context) == tree.evaluate(context) == 143.5
+    # Values are cached for the most recent variable values and their types
+    assert tree.evaluate_cached({"x": 1, "y": 1}) == tree.evaluate({"x": 1, "y": 1})
+    value = tree.evaluate_cached({"x": 3.0, "y": 2})
+    assert value == 143.5 and type(value) is float
+    # Rules restore the parent of the changed node, which invalidates the path
+    tree = parser.parse("x + (2 + 3) * y")
+    assert tree.evaluate_cached(context) == 13
+    rule = ConstantsSimplifyRule()
+    change = rule.apply_to(rule.find_node(tree))
+    assert str(change.result.get_root()) == "x + 5y"
+    assert tree._get_cache("value") is None
+    assert tree.evaluate_cached(context) == 13
+    with pytest.raises(ValueError):
+        tree.evaluate_cached({"x": 3})
+    # Values computed with and without exact numbers are kept apart
+    tree = parser.parse("x / 2 + 1")
+    assert tree.evaluate_cached({"x": 1}) == 1.5
+    value = tree.evaluate_cached({"x": 1}, exact_numbers=True)
+    assert value == Fraction(3, 2) and type(value) is Fraction
+    assert type(tree.evaluate_cached({"x": 1})) is float
+
+
+def test_expressions_evaluate_cached_small_trees(monkeypatch):
+    parser = ExpressionParser(max_cache_entries=0)
+    context = {"x": 3, "y": 2}
+    tree = parser.parse("(4x + 2y^3) * 7 - x / y + 12")
+    assert tree.evaluate_cached(context) == tree.evaluate(context)
+    assert all(node._get_cache("value") is None for node in tree.to_list())
+    assert tree._get_cache("small_tree") is True and tree._meta is None
+    # Trees are counted again after a change, so ones that grow start caching
+    monkeypatch.setattr("mathy_core.expressions._MIN_CACHED_EVALUATE_NODES", 20)
+    assert tree.evaluate_cached(context) == tree.evaluate(context)
+    assert tree._get_cache("value") is None
+    tree.set_right(parser.parse("x^2 + y^2 + 3x + 4y"))
+    assert tree._get_cache("small_tree") is None
+    assert tree.evaluate_cached(context) == tree.evaluate(context)
+    assert tree._get_cache("value") is not None
+    tree = parser.parse(" + ".join(["x * y"] * 40))
+    assert tree.evaluate_cached(context) == 240
+    assert tree._get_cache("value") is not None
+
+
+def test_expressions_evaluate_batch():
+    parser = make_parser()
+    xs = [-3, -1.5, 0, 1, 2.5, 4]
+    ys = [2, 0, -1, 3, 1.5, -2]
+    for text in [
+        "4x + 2y^3 * 7!",
+        "-(x - 2.5) / sgn(y) + 12",
+        "abs(-x) * sgn(y) - x / y",
+        "2x = x + x",
+        "7",
+    ]:
+        expr = parser.parse(text)
+        expected = [expr.evaluate({"x": x, "y": y}) for x, y in zip(xs, ys)]
+        # The first calls walk the tree, and the later ones compile it
+        for _ in range(10):
+            values = expr.evaluate_batch({"x": np.array(xs), "y": ys})
+            assert values.shape == (len(xs),)
+            assert np.allclose(values, expected, equal_nan=True)
+        assert expr._get_cache("compiled_batch") is not None
+    # Bindings are broadcast together
+    values = parser.parse("x * y").evaluate_batch({"x": [[1], [2]], "y": [1, 2, 3]})
+    assert values.tolist() == [[1, 2, 3], [2, 4, 6]]
+
+
+def test_expressions_evaluate_batch_semantics():
+    x = VariableExpression("x")
+    factorial = FactorialExpression(x).evaluate_batch({"x": [-1, 3.7, 5, 171]})
+    assert np.isnan(factorial[0]) and factorial[1:].tolist() == [6, 120, np.inf]
+    power = PowerExpression(x.clone(), ConstantExpression(0.5))
+    assert np.isnan(power.evaluate_batch({"x": [-4, 4]})).tolist() == [True, False]
+    divide = DivideExpression(ConstantExpression(1), x.clone())
+    assert np.isnan(divide.evaluate_batch({"x": [0, 2]})).tolist() == [True, False]
+    with pytest.raises(ValueError, match="None variable: x"):
+        divide.evaluate_batch({"y": [1]})
+    equal = EqualExpression(x.clone(), VariableExpression("y"))
+    with pytest.raises(ValueError, match=re.escape("left(2.0) != right(5.0)")):
+        equal.evaluate_batch({"x": [1, 2], "y": [1, 5]})
+
+
+def test_expressions_evaluate_batch_custom():
+    class SquareExpression(UnaryExpression):
+        @property
+        def name(self) -> str:
+            return "square"
+
+        def evaluate(self, context=None):
+            return self.get_child().evaluate(context) ** 2
+
+    x = VariableExpression("x")
+    expr = AddExpression(DoubleExpression(x), SquareExpression(x.clone()))
+    for _ in range(10):
+        assert expr.evaluate_batch({"x": [1, 2, 3]}).tolist() == [3, 8, 15]
 
 
 def test_expressions_function_exceptions():
@@ -0,0 +1,91 @@
+from mathy_core.expressions import (
+    AddExpression,
+    ConstantExpression,
+    MultiplyExpression,
+    NegateExpression,
+    SubtractExpression,
+    VariableExpression,
+)
+from mathy_core.hashing import ExpressionInterner
+from mathy_core.parser import ExpressionParser
+
+
+def test_hashing_structural_hash():
+    parser = ExpressionParser()
+    one = parser.parse("4x + 2y^3 * 7")
+    two = parser.parse("4x + 2y^3 * 7", use_cache=False)
+    assert one is not two
+    assert one.structural_hash() == two.structural_hash()
+    assert one.structurally_equal(two)
+    assert one.clone().structural_hash() == one.structural_hash()
+    other = parser.parse("4x + 2y^3 * 8")
+    assert other.structural_hash() != one.structural_hash()
+    assert not one.structurally_equal(other)
+    assert not one.structurally_equal(parser.parse("2y^3 * 7 + 4x"))
+
+
+def test_hashing_structural_hash_invalidated():
+    expr = ExpressionParser().parse("4x + 2y")
+    before = expr.structural_hash()
+    constant = expr.find_type(ConstantExpression)[0]
+    constant.value = 5
+    changed = expr.structural_hash()
+    assert changed != before
+    assert changed == ExpressionParser().parse("5x + 2y").structural_hash()
+    variable = expr.find_type(VariableExpression)[-1]
+    variable.identifier = "z"
+    assert expr.structurally_equal(ExpressionParser().parse("5x + 2z"))
+    expr.set_right(ConstantExpression(2))
+    assert expr.structurally_equal(ExpressionParser().parse("5x + 2"))
+
+
+def test_hashing_interner_shares_subtrees():
+    parser = ExpressionParser()
+    interner = ExpressionInterner()
+    one = interner.intern(parser.parse("4x + 4x"))
+    assert one.left is one.right
+    assert one.left is not None and one.left.parent is None
+    two = interner.intern(parser.parse("(4x + 4x)"))
+    assert one is two
+    assert interner.intern(parser.parse("4x + 4.0x")) is not one
+    # 4, x, 4x, 4x + 4x, 4.0, 4.0x, and 4x + 4.0x
+    assert len(interner) == 7
+    assert str(one) == "4x + 4x"
+    assert one.evaluate({"x": 2}) == 16
+
+
+def test_hashing_interner_factory():
+    parser = ExpressionParser()
+    interner = ExpressionInterner()
+    term = interner.binary(
+        MultiplyExpression, interner.constant(4), interner.variable("x")
+    )
+    expr = interner.binary(AddExpression, term, interner.unary(NegateExpression, term))
+    assert expr is interner.intern(parser.parse("4x + -(4x)"))
+    assert expr.evaluate({"x": 3}) == 0
+    interner.clear()
+    assert len(interner) == 0
+
+
+def test_hashing_interner_renders_parentheses():
+    parser = ExpressionParser()
+    interner = ExpressionInterner()
+    for text in [
+        "(x + y) * z",
+        "x - (y + z)",
+        "(x + 1)^2",
+        "4x^2 * (a - b) / (c + d)",
+        "-(x + y) * 2",
+    ]:
+        expr = parser.parse(text)
+        interned = interner.intern(expr)
+        assert str(interned) == str(expr) == text
+        assert parser.parse(str(interned), use_cache=False).structurally_equal(expr)
+    # The same shared subtree needs parentheses in one tree but not the other
+    inner = interner.intern(parser.parse("x + y"))
+    left = interner.binary(SubtractExpression, inner, interner.variable("z"))
+    right = interner.binary(SubtractExpression, interner.variable("z"), inner)
+    assert str(left) == "x + y - z"
+    assert str(right) == "z - (x + y)"
+    assert "<mo>(</mo>" not in left.to_math_ml()
+    assert "<mo>(</mo>" in right.to_math_ml()
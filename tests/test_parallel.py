@@ -0,0 +1,78 @@
+from fractions import Fraction
+
+import pytest
+
+from mathy_core.expressions import AbsExpression, MathExpression
+from mathy_core.parallel import (
+    ParallelExpressionParser,
+    pack_expression,
+    unpack_expression,
+)
+from mathy_core.parser import ExpressionParser, InvalidSyntax
+from mathy_core.tokenizer import Tokenizer
+
+from .conftest import DoubleExpression, add_test_functions, make_parser
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "4x + 2y^3 * 7!",
+        "-(x - 2.5) / sgn(y) = 12",
+        "(8x^2 * 9b) * 7 - -3",
+        "abs(-x)",
+    ],
+)
+def test_parallel_pack_unpack(text: str) -> None:
+    parser = make_parser()
+    expression = parser.parse(text)
+    packed = pack_expression(expression)
+    assert isinstance(packed[0], bytes)
+    restored = unpack_expression(packed)
+    assert str(restored) == str(expression)
+    assert restored.structural_hash() == expression.structural_hash()
+    nodes, restored_nodes = expression.to_list(), restored.to_list()
+
+    def describe(node: MathExpression) -> tuple:
+        value = getattr(node, "value", None)
+        return type(node), value, getattr(node, "identifier", None)
+
+    assert [describe(n) for n in restored_nodes] == [describe(n) for n in nodes]
+    # The restored tree is a copy that shares no nodes with the original
+    assert not {id(n) for n in nodes} & {id(n) for n in restored_nodes}
+    context = {"x": -9.5, "y": 1, "b": 2}
+    assert restored.evaluate(context) == expression.evaluate(context)
+
+
+def test_parallel_pack_custom_function() -> None:
+    expression = DoubleExpression(AbsExpression(ExpressionParser().parse("x + 1")))
+    restored = unpack_expression(pack_expression(expression))
+    assert isinstance(restored, DoubleExpression)
+    assert restored.evaluate({"x": -3}) == 4
+
+
+def test_parallel_parse_many() -> None:
+    inputs = [f"{i}x + {i}y^2" for i in range(50)] + ["4*/"]
+    with ParallelExpressionParser(workers=2, chunk_size=7) as parser:
+        results = list(parser.parse_many(inputs, collect_errors=True))
+        assert [str(r) for r in results[:-1]] == inputs[:-1]
+        assert isinstance(results[-1], InvalidSyntax)
+        with pytest.raises(InvalidSyntax):
+            list(parser.parse_many(inputs))
+        packed = list(parser.parse_many(inputs[:-1], unpack=False))
+        assert [str(unpack_expression(p)) for p in packed] == inputs[:-1]
+
+
+def test_parallel_exact_numbers() -> None:
+    with ParallelExpressionParser(workers=1, exact_numbers=True) as parser:
+        (result,) = list(parser.parse_many(["0.1 + x"]))
+        assert result.left.value == Fraction(1, 10)
+
+
+def test_parallel_custom_tokenizer() -> None:
+    tokenizer = add_test_functions(Tokenizer(backend="regex"))
+    with ParallelExpressionParser(workers=1, tokenizer=tokenizer) as parser:
+        (result,) = list(parser.parse_many(["abs(-4) + x"]))
+        assert isinstance(result.left, AbsExpression)
+    with pytest.raises(ValueError):
+        ParallelExpressionParser(chunk_size=0)
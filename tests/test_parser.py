@@ -1,10 +1,12 @@
-from typing import Any
+from typing import Any, List, Tuple
 import pytest
 
+from mathy_core.expressions import MathExpression
 from mathy_core.parser import (
     ExpressionParser,
     InvalidExpression,
     InvalidSyntax,
+    TextEdit,
     TrailingTokens,
     UnexpectedBehavior,
 )
@@ -88,3 +90,220 @@ def test_parser_exceptions(expectation: list[Any]) -> None:
     with pytest.raises(out_err):
         parser.parse(in_str)
     assert meta != "", "add note about which parser fn throws for this case"
+
+
+def test_parser_shares_cached_tokens() -> None:
+    """Cached tokens are returned without copying, and parsing does not consume
+    them, so they can be parsed again."""
+    parser = ExpressionParser()
+    tokens = parser.tokenize("4x + 2y^3")
+    assert parser.tokenize("4x + 2y^3") is tokens
+    first = parser._parse(tokens)
+    second = parser._parse(tokens)
+    assert first is not second
+    assert str(first) == str(second) == "4x + 2y^3"
+
+
+def test_parser_long_inputs() -> None:
+    text = " + ".join(f"{i}x" for i in range(1, 500))
+    expression = ExpressionParser().parse(text)
+    assert expression.evaluate({"x": 1}) == sum(range(1, 500))
+
+
+def test_parser_cache_bounds_and_stats() -> None:
+    parser = ExpressionParser(max_cache_entries=2)
+    first = parser.parse("4x")
+    assert parser.parse("4x") is first
+    parser.parse("2y")
+    parser.parse("7z")
+    stats = parser.cache_stats()["parse"]
+    assert stats.hits == 1
+    assert stats.misses == 3
+    assert stats.evictions == 1
+    assert stats.entries == 2
+    # "4x" was evicted, so it parses into a new tree
+    assert parser.parse("4x") is not first
+
+
+def test_parser_cache_max_tokens() -> None:
+    parser = ExpressionParser(max_cache_entries=None, max_cache_tokens=10)
+    parser.parse("4x + 2y")  # 6 tokens including EOF
+    parser.parse("7z + 1")  # 5 tokens including EOF
+    stats = parser.cache_stats()["parse"]
+    assert stats.entries == 1
+    assert stats.weight == 5
+
+
+def test_parser_cache_disabled() -> None:
+    parser = ExpressionParser()
+    first = parser.parse("4x", use_cache=False)
+    assert parser.parse("4x", use_cache=False) is not first
+    assert parser.cache_stats()["parse"].entries == 0
+    assert parser.cache_stats()["tokens"].entries == 0
+
+    parser = ExpressionParser(max_cache_entries=0)
+    assert parser.parse("4x") is not parser.parse("4x")
+
+
+def test_parser_copy_on_read() -> None:
+    """With copy_on_read, modifying a parsed tree does not change what later
+    parses of the same text return."""
+    parser = ExpressionParser(copy_on_read=True)
+    first = parser.parse("4x + 2y")
+    assert first.left is not None
+    first.set_left(None)
+    second = parser.parse("4x + 2y")
+    assert second is not first
+    assert str(second) == "4x + 2y"
+    assert parser.cache_stats()["parse"].hits == 1
+
+
+def test_parser_parse_many() -> None:
+    parser = ExpressionParser()
+    inputs = ["4x + 2", "4x + 2", "y^2"]
+    results = list(parser.parse_many(inputs))
+    assert [str(r) for r in results] == ["4x + 2", "4x + 2", "y^2"]
+    assert results[0] is results[1]
+    assert parser.cache_stats()["parse"].hits == 1
+
+    uncached = list(parser.parse_many(inputs, use_cache=False))
+    assert [str(r) for r in uncached] == ["4x + 2", "4x + 2", "y^2"]
+    assert uncached[0] is not uncached[1]
+    assert parser.cache_stats()["parse"].hits == 1
+
+
+def test_parser_parse_many_errors() -> None:
+    parser = ExpressionParser()
+    inputs = ["4x + 2", "4*/", "4x \\ 2", "", "y^2"]
+    with pytest.raises(InvalidSyntax):
+        list(parser.parse_many(inputs))
+
+    results = list(parser.parse_many(inputs, collect_errors=True))
+    assert str(results[0]) == "4x + 2"
+    assert isinstance(results[1], InvalidSyntax)
+    assert isinstance(results[2], ValueError)
+    assert isinstance(results[3], InvalidExpression)
+    assert str(results[4]) == "y^2"
+
+
+def test_parser_parse_file(tmp_path: Any) -> None:
+    parser = ExpressionParser()
+    text_file = tmp_path / "problems.txt"
+    text_file.write_text("4x + 2\n\n  \n4x + -\ny^2\n")
+    results = list(parser.parse_file(text_file))
+    assert [line_no for line_no, _ in results] == [1, 4, 5]
+    assert str(results[0][1]) == "4x + 2"
+    assert isinstance(results[1][1], InvalidSyntax)
+    assert "Full input" not in results[1][1].message
+    assert str(results[2][1]) == "y^2"
+    assert parser.detailed_errors is True
+
+    results = list(parser.parse_file(str(text_file), detailed_errors=True))
+    error = results[1][1]
+    assert isinstance(error, InvalidSyntax)
+    assert "Full input: 4x+-" in error.message
+
+    jsonl_file = tmp_path / "problems.jsonl"
+    jsonl_file.write_text('{"text": "2x"}\n{"other": "2x"}\n{"text": 2}\nnot json\n')
+    results = list(parser.parse_file(jsonl_file, json_key="text"))
+    assert str(results[0][1]) == "2x"
+    assert all(isinstance(error, ValueError) for _, error in results[1:])
+
+
+def test_parser_error_spans() -> None:
+    parser = ExpressionParser()
+    with pytest.raises(InvalidSyntax) as error_info:
+        parser.parse("4x + 2y * / 7")
+    error = error_info.value
+    assert error.input_text == "4x+2y*/7"
+    assert (error.start, error.end) == (8, 11)
+    assert error.message.startswith("Expected an expression after * or / operator")
+    assert error.message.endswith("Full input: 4x+2y*/7\n                 ^^")
+    assert str(error) == error.message
+
+    with pytest.raises(TrailingTokens) as error_info:
+        parser.parse("(4x + 2) 7 +")
+    # Only the syntax errors that always included the input text still do
+    assert error_info.value.message == "Trailing characters: 7+"
+    assert (error_info.value.start, error_info.value.end) == (9, 12)
+
+    parser.detailed_errors = False
+    with pytest.raises(InvalidSyntax) as error_info:
+        parser.parse("4x + -", use_cache=False)
+    assert "Full input" not in error_info.value.message
+    assert error_info.value.start == 6
+
+
+def test_parser_error_message_is_lazy() -> None:
+    error = InvalidSyntax("Missing: {}", 12)
+    assert error._message is None
+    assert error.message == "Missing: 12"
+    assert error._message == "Missing: 12"
+    assert InvalidSyntax("100% {literal}").message == "100% {literal}"
+
+
+def _spans(expression: MathExpression) -> List[Tuple[str, Tuple[int, int]]]:
+    spans: List[Tuple[str, Tuple[int, int]]] = []
+
+    def visit_fn(node: MathExpression, depth: int, data: Any) -> None:
+        spans.append((node.raw, node.span))
+
+    expression.visit_preorder(visit_fn)
+    return spans
+
+
+def test_parser_node_spans() -> None:
+    text = "-4x^2 + sgn(y) * (x - 7!) = 2"
+    expression = ExpressionParser().parse(text)
+    parser = ExpressionParser()
+    for raw, (start, end) in _spans(expression):
+        assert parser.parse(text[start:end]).raw == parser.parse(raw).raw
+    assert expression.span == (0, len(text))
+    assert expression.clone().span == expression.span
+
+
+@pytest.mark.parametrize(
+    "text,edit,in_place",
+    [
+        ("4x + 2y^2 - 7z = 12", TextEdit(5, 6, "3"), True),
+        ("4x + 2y^2 - 7z = 12", TextEdit(12, 14, "8x * (y + 1)"), True),
+        ("4x + 2y^2 - 7z = 12", TextEdit(17, 19, "x + 2"), True),
+        ("4x + (2y - 7) * z", TextEdit(6, 8, " 14y "), True),
+        ("4x + 2y^2 - 7z", TextEdit(3, 4, "*"), True),
+        # Edits that are not within a single term are parsed in full
+        ("4x + 2y^2 - 7z", TextEdit(5, 6, "2 + 3"), False),
+        ("4x + 2y^2 - 7z", TextEdit(10, 11, "="), False),
+        ("4x + 2y^2 - 7z", TextEdit(0, 14, "12"), False),
+        ("4x = 2y = 7z", TextEdit(5, 7, "y = 2"), False),
+    ],
+)
+def test_parser_reparse(text: str, edit: TextEdit, in_place: bool) -> None:
+    parser = ExpressionParser()
+    tree = parser.parse(text, use_cache=False)
+    new_text = text[: edit.start] + edit.text + text[edit.end :]  # noqa
+    expected = parser.parse(new_text, use_cache=False)
+    result = parser.reparse(tree, text, edit)
+    assert (result is tree) == in_place
+    assert str(result) == str(expected)
+    assert _spans(result) == _spans(expected)
+
+
+def test_parser_reparse_cached_tree() -> None:
+    parser = ExpressionParser()
+    text = "4x + 2y^2 - 7z"
+    tree = parser.parse(text)
+    spans = _spans(tree)
+    result = parser.reparse(tree, text, TextEdit(5, 6, "3"))
+    assert str(result) == "4x + 3y^2 - 7z" and result is not tree
+    # The cached tree is copied, so later parses of the old text are unchanged
+    assert parser.parse(text) is tree
+    assert str(tree) == text and _spans(tree) == spans
+
+
+def test_parser_reparse_errors() -> None:
+    parser = ExpressionParser()
+    tree = parser.parse("4x + 2y", use_cache=False)
+    with pytest.raises(InvalidSyntax):
+        parser.reparse(tree, "4x + 2y", TextEdit(6, 7, "y*"))
+    with pytest.raises(ValueError):
+        parser.reparse(tree, "4x + 2y", TextEdit(6, 12, ""))
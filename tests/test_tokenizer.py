@@ -2,7 +2,7 @@ from typing import List
 
 import pytest
 
-from mathy_core import TOKEN_TYPES, Token, Tokenizer
+from mathy_core import TOKEN_TYPES, Token, TokenContext, Tokenizer, TokenizerBackend
 
 
 def test_tokenizer_tokenize() -> None:
@@ -24,6 +24,20 @@ def test_tokenizer_errors() -> None:
         tokenizer.tokenize(text)
 
 
+def test_tokenizer_context_chunk() -> None:
+    # The chunk can still be given and assigned, as before it was derived from
+    # the buffer and index
+    context = TokenContext(chunk="12x")
+    assert context.buffer == "12x" and context.index == 0
+    tokenizer = Tokenizer()
+    assert tokenizer.identify_constants(context) == 2
+    assert context.chunk == "x"
+    context.chunk = context.buffer[3:]
+    assert context.index == 3 and context.chunk == ""
+    context = TokenContext(buffer="4 + y", index=0, chunk="y")
+    assert context.index == 4 and context.chunk == "y"
+
+
 def test_tokenizer_manual_verification() -> None:
     """Simplest conceptual example verifying the tokenizer maps to
     expectations."""
@@ -58,3 +72,60 @@ def test_tokenizer_ignore_padding() -> None:
     # When including padding, spaces are preserved
     padding: List[Token] = Tokenizer(exclude_padding=False).tokenize(text)
     assert len(padding) == len(no_padding) + 4
+
+
+def test_tokenizer_long_input() -> None:
+    """Long inputs are scanned in a single pass and produce the full token stream"""
+    text = " + ".join(f"{i}x^2" for i in range(2000))
+    tokens: List[Token] = Tokenizer().tokenize(text)
+    # 4 tokens per term, 1999 plus signs, and the EOF token
+    assert len(tokens) == 2000 * 4 + 1999 + 1
+    assert "".join(t.value for t in tokens) == text.replace(" ", "")
+    assert tokens[-1].type == TOKEN_TYPES.EOF
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "4x + 2x^3 * 7!",
+        "sgn(-3) + sgnx",
+        "[4 – 2.5] / (x = y)",
+        "-2.257893300159429e+16h^2 * v",
+        "  4x\t+\r\n2y  ",
+        "",
+    ],
+)
+@pytest.mark.parametrize("exclude_padding", [True, False])
+def test_tokenizer_backends_match(text: str, exclude_padding: bool) -> None:
+    """The "regex" backend produces the same tokens as the "scan" backend"""
+    scan = Tokenizer(exclude_padding=exclude_padding, backend="scan")
+    regex = Tokenizer(exclude_padding=exclude_padding, backend="regex")
+    expected = [(t.value, t.type, t.start, t.end) for t in scan.tokenize(text)]
+    actual = [(t.value, t.type, t.start, t.end) for t in regex.tokenize(text)]
+    assert actual == expected
+
+
+@pytest.mark.parametrize("backend", ["scan", "regex"])
+def test_tokenizer_token_offsets(backend: TokenizerBackend) -> None:
+    text = " 4.5xy +  sgn(x)^2 – [y] "
+    tokens = Tokenizer(backend=backend).tokenize(text)
+    for token in tokens[:-1]:
+        source = text[token.start : token.end]  # noqa
+        assert source == token.value or (source, token.value) in [
+            ("–", "-"),
+            ("[", "("),
+            ("]", ")"),
+        ]
+    assert [t.start for t in tokens[:4]] == [1, 4, 5, 7]
+    assert (tokens[-1].start, tokens[-1].end) == (len(text), len(text))
+
+
+def test_tokenizer_backends_errors() -> None:
+    text = "4x + 2x^3 * 7\\"
+    with pytest.raises(ValueError) as scan_error:
+        Tokenizer(backend="scan").tokenize(text)
+    with pytest.raises(ValueError) as regex_error:
+        Tokenizer(backend="regex").tokenize(text)
+    assert str(scan_error.value) == str(regex_error.value)
+    with pytest.raises(ValueError):
+        Tokenizer(backend="invalid")  # type:ignore
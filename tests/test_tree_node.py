@@ -26,6 +26,43 @@ def test_tree_node_constructor():
     assert tree.right.parent == tree
 
 
+def test_tree_node_ids():
+    one = BinaryTreeNode()
+    two = BinaryTreeNode()
+    assert isinstance(one._id, int) and two._id == one._id + 1
+    assert one.id == f"mn-{one._id}"
+    assert one.clone().id == one.id
+    custom = BinaryTreeNode(id="custom")
+    assert custom.id == "custom"
+    # "mn-N" strings are stored as the number N
+    custom.id = "mn-7"
+    assert custom._id == 7 and custom.id == "mn-7"
+    custom.id = "mn-07"
+    assert custom.id == "mn-07"
+
+
+def test_tree_node_cache_invalidate():
+    tree = BinarySearchTree(0)
+    for i in [5, -3, 8, -7, 2]:
+        tree.insert(i)
+    five = tree.find(5)
+    assert five is not None and five.right is not None
+    five._set_cache("key", 1)
+    tree._set_cache("key", 2)
+    assert five._get_cache("key") == 1 and tree._get_cache("key") == 2
+    # Changing a subtree drops the caches of the nodes above it, but not others
+    minus_three = tree.find(-3)
+    assert minus_three is not None
+    minus_three.set_right(BinarySearchTree(-2))
+    assert tree._get_cache("key") is None and five._get_cache("key") == 1
+    five.right.set_right(BinarySearchTree(9))
+    assert five._get_cache("key") is None
+    # The cache marks descendants, so invalidating a deep node reaches the root
+    tree._set_cache("key", 3)
+    five.right.right.invalidate()
+    assert tree._get_cache("key") is None
+
+
 def test_tree_node_clone():
     """check to be sure that when we clone off a known node of the tree
     that its children, and only its children, are still searchable
@@ -168,6 +205,49 @@ def test_tree_node_visit_postorder():
     tree.visit_postorder(node_visit)
 
 
+@pytest.mark.parametrize("order", ["preorder", "inorder", "postorder"])
+def test_tree_node_iter_matches_visit(order: str):
+    tree = BinarySearchTree(0)
+    for i in [5, -3, 8, -7, 2, 1, 9, -1, 6, 3]:
+        tree.insert(i)
+    visited: List[BinaryTreeNode] = []
+    depths: List[int] = []
+
+    def node_visit(node, depth, data):
+        visited.append(node)
+        depths.append(depth)
+
+    getattr(tree, f"visit_{order}")(node_visit, depth=2)
+    assert list(getattr(tree, f"iter_{order}")()) == visited
+    expected_depths = []
+    for node in visited:
+        depth = 2
+        while node.parent is not None:
+            node = node.parent
+            depth += 1
+        expected_depths.append(depth)
+    assert depths == expected_depths
+
+
+@pytest.mark.parametrize("order", ["preorder", "inorder", "postorder"])
+def test_tree_node_deep_traversal(order: str):
+    """Traversals do not recurse, so deep trees do not hit the recursion limit"""
+    tree = node = BinaryTreeNode()
+    for _ in range(20000):
+        node.set_right(BinaryTreeNode())
+        node.set_left(BinaryTreeNode())
+        node = node.right
+    assert len(list(getattr(tree, f"iter_{order}")())) == 40001
+    count = 0
+
+    def node_visit(node, depth, data):
+        nonlocal count
+        count += 1
+
+    getattr(tree, f"visit_{order}")(node_visit)
+    assert count == 40001
+
+
 def test_tree_node_get_root():
     tree = BinarySearchTree(0)
     values = list(range(-5, 6))
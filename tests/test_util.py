@@ -1,6 +1,14 @@
+import random
+from fractions import Fraction
+
+import pytest
+
+from mathy_core.expressions import use_exact_numbers
 from mathy_core.parser import ExpressionParser
 from mathy_core.util import (
     TermEx,
+    check_expression_equivalence,
+    compare_expression_values,
     get_sub_terms,
     get_term_ex,
     get_terms,
@@ -109,3 +117,63 @@ def test_util_terms_are_like():
     expr = parser.parse("4z")
     terms = get_terms(expr)
     assert len(terms) == 1
+
+
+def test_util_check_expression_equivalence():
+    random.seed(1337)
+    parser = ExpressionParser()
+    for one, two in [
+        ("4x + 2x", "6x"),
+        ("(x + 2)^2", "x^2 + 4x + 4"),
+        ("x / (x - x) + 2", "2 + x / 0"),
+        ("12", "4 * 3"),
+    ]:
+        result = check_expression_equivalence(parser.parse(one), parser.parse(two))
+        assert result.equivalent and result.reason is None
+    # Equal at x = 2 only, which a single random point can hit
+    result = check_expression_equivalence(parser.parse("x^2"), parser.parse("2x"))
+    assert not result.equivalent and result.reason == "Expression value changed"
+    assert result.point is not None and result.point["x"] != 2
+    assert result.from_value == result.point["x"] ** 2
+    assert result.to_value == result.point["x"] * 2
+    result = check_expression_equivalence(parser.parse("x + y"), parser.parse("x"))
+    assert result.reason == "Number of variables changed"
+    assert result.from_variables == {"x", "y"} and result.to_variables == {"x"}
+    result = check_expression_equivalence(parser.parse("2x"), parser.parse("2y"))
+    assert result.reason == "Unique variables changed" and result.point is None
+
+
+def test_util_check_expression_equivalence_exact():
+    random.seed(1337)
+    parser = ExpressionParser(max_cache_entries=0)
+    # The sides only differ past the precision of a float
+    one, two = "x^10 + 1 - x^10 + x / 3", "1 + x / 3"
+    result = check_expression_equivalence(parser.parse(one), parser.parse(two))
+    assert not result.equivalent
+    parser = ExpressionParser(max_cache_entries=0, exact_numbers=True)
+    for one, two in [
+        ("x^10 + 1 - x^10 + x / 3", "1 + x / 3"),
+        ("x / 3 + x / 6", "x / 2"),
+        ("x^0.5 * x^0.5", "x"),
+        ("x / (x - x) + 2", "2 + x / 0"),
+    ]:
+        result = check_expression_equivalence(
+            parser.parse(one), parser.parse(two), exact_numbers=True
+        )
+        assert result.equivalent, (one, two)
+    with use_exact_numbers():
+        result = check_expression_equivalence(
+            parser.parse("x / 3"), parser.parse("x / 3.0001")
+        )
+    assert not result.equivalent and result.point is not None
+    assert result.from_value == Fraction(result.point["x"], 3)
+
+
+def test_util_compare_expression_values():
+    random.seed(1337)
+    parser = ExpressionParser()
+    compare_expression_values(parser.parse("4x + 2x"), parser.parse("6x"))
+    with pytest.raises(ValueError, match="Expression value changed"):
+        compare_expression_values(parser.parse("x^2"), parser.parse("2x"))
+    with pytest.raises(ValueError, match="Unique variables changed"):
+        compare_expression_values(parser.parse("2x"), parser.parse("2y"))
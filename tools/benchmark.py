@@ -0,0 +1,923 @@
+"""Micro-benchmarks for the hot paths in mathy_core.
+
+Run these from the repository root, e.g. `python tools/benchmark.py tokenize`
+"""
+import math
+import os
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import warnings
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import typer
+
+from mathy_core.arrays import ExpressionArray
+from mathy_core.canonical import canonical_key, canonicalize
+from mathy_core.expressions import (
+    AbsExpression,
+    AddExpression,
+    ConstantExpression,
+    MathExpression,
+    PowerExpression,
+    VariableExpression,
+    use_exact_numbers,
+)
+from mathy_core.hashing import ExpressionInterner
+from mathy_core.parallel import ParallelExpressionParser
+from mathy_core.parser import ExpressionParser, ParserException, TextEdit
+from mathy_core.problems import (
+    gen_binomial_times_binomial,
+    gen_combine_terms_in_place,
+    gen_commute_haystack,
+    gen_simplify_multiple_terms,
+)
+from mathy_core.rules import ConstantsSimplifyRule
+from mathy_core.tokenizer import Token, TokenContext, Tokenizer
+from mathy_core.tree import STOP, VisitFunction, VisitStop
+from mathy_core.types import NumberType
+from mathy_core.util import (
+    check_expression_equivalence,
+    get_term,
+    get_terms,
+    has_like_terms,
+)
+
+app = typer.Typer()
+
+
+@app.callback()
+def main() -> None:
+    """Micro-benchmarks for mathy_core. Pick a benchmark to run."""
+
+
+def make_text(length: int, seed: int = 1337) -> str:
+    """Build a polynomial-looking input of exactly `length` characters by joining
+    generated problems. The cut may land mid-term, which the tokenizer (but not
+    the parser) is fine with."""
+    random.seed(seed)
+    pieces: List[str] = []
+    total = 0
+    while total < length:
+        problem, _ = gen_combine_terms_in_place(8, 16)
+        pieces.append(problem)
+        total += len(problem) + 3
+    return " + ".join(pieces)[:length]
+
+
+def make_problems(count: int, seed: int = 1337) -> List[str]:
+    """Generate a mix of problem strings from the problems.py generators"""
+    random.seed(seed)
+    generators: List[Callable[[], str]] = [
+        lambda: gen_combine_terms_in_place(8, 16)[0],
+        lambda: gen_commute_haystack()[0],
+        lambda: gen_simplify_multiple_terms(6)[0],
+        lambda: gen_binomial_times_binomial()[0],
+    ]
+    return [generators[i % len(generators)]() for i in range(count)]
+
+
+def make_expression(num_problems: int, seed: int = 1337) -> str:
+    """Join generated problems into one long expression that can be parsed"""
+    return " + ".join(f"({p})" for p in make_problems(num_problems, seed))
+
+
+def best_time(fn: Callable[[], object], number: int, repeat: int = 5) -> float:
+    """Return the best mean time per call in seconds"""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+class SlicingTokenizer(Tokenizer):
+    """The tokenizer as it was before the single-pass rewrite. It re-slices the
+    remaining input after every token and copies characters one at a time, which
+    makes tokenizing quadratic in the input length. Kept here as a baseline."""
+
+    def eat_token(self, context: TokenContext, typeFn: Callable[[str], bool]) -> str:
+        res = ""
+        for ch in list(context.buffer[context.index :]):  # noqa
+            if not typeFn(ch):
+                return res
+            res = res + str(ch)
+        return res
+
+    def tokenize(self, buffer: str) -> List[Token]:
+        context = TokenContext(buffer=buffer)
+        chunk = buffer
+        while chunk and (
+            self.identify_constants(context)
+            or self.identify_alphas(context)
+            or self.identify_operators(context)
+        ):
+            chunk = context.buffer[context.index :]  # noqa
+        context.tokens.append(Token("", 1 << 13))
+        return context.tokens
+
+
+def recursive_inorder(
+    node: MathExpression, visit_fn: VisitFunction, depth: int = 0, data: Any = None
+) -> Optional[VisitStop]:
+    """`visit_inorder` as it was before traversals used an explicit stack. Kept
+    here as a baseline."""
+    if node.left and recursive_inorder(node.left, visit_fn, depth + 1, data) == STOP:
+        return STOP
+    if visit_fn(node, depth, data) == STOP:
+        return STOP
+    if node.right and recursive_inorder(node.right, visit_fn, depth + 1, data) == STOP:
+        return STOP
+    return None
+
+
+def single_point_compare(one: MathExpression, two: MathExpression) -> bool:
+    """`compare_expression_values` as it was before it checked many points at
+    once, returning False instead of raising. Kept here as a baseline."""
+    vars_one = {v.identifier for v in one.find_type(VariableExpression) if v.identifier}
+    vars_two = {v.identifier for v in two.find_type(VariableExpression) if v.identifier}
+    if vars_one != vars_two:
+        return False
+    context = {var: float(random.randint(1, 100)) for var in vars_one}
+    return math.isclose(one.evaluate(context), two.evaluate(context), rel_tol=1e-9)
+
+
+def numpy_power(self: PowerExpression, one: NumberType, two: NumberType) -> Any:
+    """`PowerExpression.operate` as it was before it used Python numbers. Kept here
+    as a baseline."""
+    return np.power(one, two)
+
+
+def numpy_absolute(self: AbsExpression, value: NumberType) -> Any:
+    """`AbsExpression.operate` as it was before it used Python numbers. Kept here
+    as a baseline."""
+    return np.absolute(value)
+
+
+@app.command()
+def tokenize(number: int = typer.Option(20, help="Calls per timing sample")) -> None:
+    """Compare the single-pass tokenizer against the old slicing tokenizer."""
+    current = Tokenizer()
+    baseline = SlicingTokenizer()
+    typer.echo(f"{'chars':>8} {'slicing (ms)':>14} {'single-pass (ms)':>18} {'x':>7}")
+    for length in [10, 100, 1000, 5000, 10000]:
+        text = make_text(length)
+        expected = [(t.value, t.type) for t in baseline.tokenize(text)]
+        actual = [(t.value, t.type) for t in current.tokenize(text)]
+        assert expected == actual, "token streams differ"
+        before = best_time(lambda: baseline.tokenize(text), number)
+        after = best_time(lambda: current.tokenize(text), number)
+        typer.echo(
+            f"{length:>8} {before * 1000:>14.3f} {after * 1000:>18.3f} "
+            f"{before / after:>7.1f}"
+        )
+
+
+@app.command()
+def lexer(number: int = typer.Option(20, help="Calls per timing sample")) -> None:
+    """Compare the per-token cost of the "scan" and "regex" tokenizer backends."""
+    scan = Tokenizer(backend="scan")
+    regex = Tokenizer(backend="regex")
+    typer.echo(
+        f"{'chars':>8} {'tokens':>8} {'scan (us/tok)':>14} {'regex (us/tok)':>15}"
+    )
+    for length in [100, 1000, 10000]:
+        text = make_text(length)
+        tokens = scan.tokenize(text)
+        expected = [(t.value, t.type) for t in tokens]
+        assert expected == [(t.value, t.type) for t in regex.tokenize(text)]
+        scan_time = best_time(lambda: scan.tokenize(text), number) / len(tokens)
+        regex_time = best_time(lambda: regex.tokenize(text), number) / len(tokens)
+        typer.echo(
+            f"{length:>8} {len(tokens):>8} {scan_time * 1e6:>14.3f} "
+            f"{regex_time * 1e6:>15.3f} ({scan_time / regex_time:.1f}x)"
+        )
+
+
+@app.command()
+def parse(number: int = typer.Option(10, help="Calls per timing sample")) -> None:
+    """Measure parser throughput as inputs grow, to check that it scales linearly.
+
+    Inputs are pre-tokenized, so this only times the parser."""
+    parser = ExpressionParser()
+    typer.echo(f"{'tokens':>8} {'total (ms)':>12} {'us/token':>10}")
+    for num_problems in [1, 10, 100, 1000]:
+        tokens = parser.tokenize(make_expression(num_problems))
+        elapsed = best_time(lambda: parser._parse(tokens), number)
+        typer.echo(
+            f"{len(tokens):>8} {elapsed * 1000:>12.3f} "
+            f"{elapsed * 1e6 / len(tokens):>10.3f}"
+        )
+
+
+@app.command()
+def batch(
+    lines: int = typer.Option(20000, help="Number of problem strings to parse"),
+    repeat: int = typer.Option(3, help="Timing samples to take the best of"),
+) -> None:
+    """Measure parse throughput in lines per second for a batch of unique problems,
+    comparing a loop over `parse` with `parse_many`."""
+    problems = make_problems(lines)
+
+    def run(label: str, fn: Callable[[ExpressionParser], object]) -> None:
+        elapsed = min(
+            timeit.repeat(lambda: fn(ExpressionParser()), number=1, repeat=repeat)
+        )
+        typer.echo(f"{label:<36} {lines / elapsed:>12,.0f} lines/s")
+
+    run("parse() loop", lambda p: [p.parse(t) for t in problems])
+    run("parse_many()", lambda p: list(p.parse_many(problems)))
+    run("parse_many(use_cache=False)", lambda p: list(p.parse_many(problems, False)))
+
+    def regex(p: ExpressionParser) -> object:
+        p.tokenizer = Tokenizer(backend="regex")
+        return list(p.parse_many(problems, use_cache=False))
+
+    run("parse_many(use_cache=False) + regex", regex)
+
+
+@app.command()
+def parallel(
+    lines: int = typer.Option(50000, help="Number of problem strings to parse"),
+    chunk_size: int = typer.Option(256, help="Inputs per worker task"),
+    max_workers: int = typer.Option(0, help="Most workers to try (0 = CPU count)"),
+) -> None:
+    """Measure the speedup of ParallelExpressionParser over a single process, with
+    and without rebuilding the trees in this process."""
+    problems = make_problems(lines)
+    start = timeit.default_timer()
+    list(ExpressionParser().parse_many(problems, use_cache=False))
+    single = timeit.default_timer() - start
+    typer.echo(f"{'workers':>8} {'unpack':>7} {'lines/s':>12} {'speedup':>8}")
+    typer.echo(f"{'-':>8} {'-':>7} {lines / single:>12,.0f} {1.0:>8.2f}")
+    workers = 1
+    most = max_workers or os.cpu_count() or 1
+    while workers <= most:
+        with ParallelExpressionParser(workers, chunk_size) as parser:
+            # Start the pool before timing
+            list(parser.parse_many(problems[: workers * chunk_size]))
+            for unpack in [True, False]:
+                start = timeit.default_timer()
+                list(parser.parse_many(problems, unpack=unpack))
+                elapsed = timeit.default_timer() - start
+                typer.echo(
+                    f"{workers:>8} {str(unpack):>7} {lines / elapsed:>12,.0f} "
+                    f"{single / elapsed:>8.2f}"
+                )
+        workers *= 2
+
+
+@app.command()
+def errors(number: int = typer.Option(200, help="Calls per timing sample")) -> None:
+    """Measure the cost of an input that fails early, as the rest of it grows.
+
+    Only the error message depends on the length of the input."""
+    parser = ExpressionParser()
+    typer.echo(f"{'tokens':>8} {'us/error':>10}")
+    for num_problems in [1, 10, 100, 1000]:
+        tokens = parser.tokenize(f"4x * / {make_expression(num_problems)}")
+
+        def fail() -> None:
+            try:
+                parser._parse(tokens)
+            except ParserException:
+                pass
+
+        elapsed = best_time(fail, number)
+        typer.echo(f"{len(tokens):>8} {elapsed * 1e6:>10.1f}")
+
+
+@app.command()
+def reparse(number: int = typer.Option(20, help="Calls per timing sample")) -> None:
+    """Compare a full parse against `reparse` for an edit of one term in the middle
+    of a growing expression."""
+    parser = ExpressionParser()
+    typer.echo(f"{'tokens':>8} {'parse (ms)':>12} {'reparse (ms)':>14} {'x':>7}")
+    for num_problems in [1, 10, 100, 200]:
+        text = make_expression(num_problems)
+        tree = parser.parse(text, use_cache=False)
+        # Replace the variable closest to the middle of the text with "z"
+        variables = tree.find_type(VariableExpression)
+        target = min(variables, key=lambda v: abs(v.span[0] - len(text) // 2))
+        start, end = target.span
+        edits = [TextEdit(start, end, "z"), TextEdit(start, start + 1, text[start])]
+        texts = [text, f"{text[:start]}z{text[end:]}"]
+        step = [0]
+
+        def edit() -> None:
+            i = step[0] % 2
+            step[0] += 1
+            parser.reparse(tree, texts[i], edits[i])
+
+        full = best_time(lambda: parser.parse(texts[1], use_cache=False), number)
+        partial = best_time(edit, number * 2)
+        assert str(tree) == str(parser.parse(texts[step[0] % 2], use_cache=False))
+        typer.echo(
+            f"{len(parser.tokenize(text)):>8} {full * 1000:>12.3f} "
+            f"{partial * 1000:>14.3f} {full / partial:>7.1f}"
+        )
+
+
+@app.command()
+def memory(
+    lines: int = typer.Option(5000, help="Number of problem strings to keep parsed"),
+) -> None:
+    """Measure the memory that parsed expression trees hold on to per node."""
+    problems = make_problems(lines)
+    parser = ExpressionParser(max_cache_entries=0)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    trees = [parser.parse(text) for text in problems]
+    after, _ = tracemalloc.get_traced_memory()
+    nodes = sum(len(tree.to_list()) for tree in trees)
+    # The term queries that rules make on every node should not grow the nodes
+    for tree in trees:
+        for node in tree.to_list():
+            get_term(node)
+            node.contains(AddExpression)
+        has_like_terms(tree)
+        tree.size
+    queried, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    typer.echo(f"{nodes:,} nodes in {lines:,} trees")
+    typer.echo(f"{(after - before) / nodes:.1f} bytes/node (traced)")
+    typer.echo(f"{(queried - before) / nodes:.1f} bytes/node after term queries")
+    node = trees[0]
+    size = sys.getsizeof(node)
+    if hasattr(node, "__dict__"):
+        size += sys.getsizeof(node.__dict__)
+    typer.echo(f"{size} bytes for the root node object (and its __dict__, if any)")
+
+
+@app.command()
+def stream(
+    lines: int = typer.Option(50000, help="Number of lines in the generated file"),
+) -> None:
+    """Measure the throughput and peak memory of `parse_file` on a generated file
+    where one line in ten is invalid."""
+    problems = make_problems(lines)
+    for i in range(0, lines, 10):
+        problems[i] = f"{problems[i]} * -"
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "problems.txt")
+        with open(path, "w") as file:
+            file.write("\n".join(problems))
+        size = os.path.getsize(path)
+        for detailed in [False, True]:
+            parser = ExpressionParser()
+            start = timeit.default_timer()
+            errors = 0
+            for _, result in parser.parse_file(path, detailed_errors=detailed):
+                errors += not isinstance(result, MathExpression)
+            elapsed = timeit.default_timer() - start
+            typer.echo(
+                f"detailed_errors={str(detailed):<5} {lines / elapsed:>10,.0f} lines/s"
+                f" ({errors} errors)"
+            )
+        tracemalloc.start()
+        for _ in ExpressionParser().parse_file(path):
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        typer.echo(f"peak memory {peak / 1024:,.0f}KB for a {size / 1024:,.0f}KB file")
+
+
+@app.command()
+def arrays(
+    count: int = typer.Option(10000, help="Number of problem trees"),
+    number: int = typer.Option(3, help="Calls per timing sample"),
+) -> None:
+    """Compare evaluating and finding the terms of many trees one at a time with
+    doing the same over an `ExpressionArray` that holds all of them."""
+    parser = ExpressionParser(max_cache_entries=0)
+    trees = [parser.parse(text) for text in make_problems(count)]
+    letters = range(ord("a"), ord("z") + 1)
+    context: Dict[str, NumberType] = {chr(c): (c % 7) + 1 for c in letters}
+    convert = best_time(lambda: ExpressionArray.from_expressions(trees), number)
+    array = ExpressionArray.from_expressions(trees)
+    typer.echo(f"{len(array):,} nodes in {count:,} trees")
+    typer.echo(f"from_expressions {convert * 1000:>9.1f}ms")
+    restore = best_time(array.to_expressions, number)
+    typer.echo(f"to_expressions   {restore * 1000:>9.1f}ms")
+    array.levels()
+    typer.echo(f"{'':<9} {'objects (ms)':>13} {'array (ms)':>11} {'speedup':>8}")
+    for name, loop, vectorized in [
+        (
+            "evaluate",
+            lambda: [tree.evaluate(context) for tree in trees],
+            lambda: array.evaluate(context),
+        ),
+        (
+            "get_terms",
+            lambda: [get_terms(tree) for tree in trees],
+            array.get_terms,
+        ),
+    ]:
+        objects = best_time(loop, number)
+        arrays = best_time(vectorized, number)
+        typer.echo(
+            f"{name:<9} {objects * 1000:>13.1f} {arrays * 1000:>11.1f} "
+            f"{objects / arrays:>7.1f}x"
+        )
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    array = ExpressionArray.from_expressions(trees)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    typer.echo(f"{(after - before) / len(array):.1f} bytes/node in the array")
+
+
+@app.command()
+def traverse(
+    nodes: int = typer.Option(10000, help="Approximate nodes per tree"),
+    number: int = typer.Option(20, help="Calls per timing sample"),
+) -> None:
+    """Compare the explicit-stack traversals against the old recursive visit."""
+    text = make_expression(max(1, nodes // 26))
+    tree = ExpressionParser(max_cache_entries=0).parse(text)
+    count = len(tree.to_list())
+    typer.echo(f"{count:,} nodes")
+
+    def collect_recursive() -> List[MathExpression]:
+        results: List[MathExpression] = []
+
+        def visit_fn(node: MathExpression, depth: int, data: Any) -> None:
+            results.append(node)
+
+        recursive_inorder(tree, visit_fn)
+        return results
+
+    def collect_visit() -> List[MathExpression]:
+        results: List[MathExpression] = []
+
+        def visit_fn(node: MathExpression, depth: int, data: Any) -> None:
+            results.append(node)
+
+        tree.visit_inorder(visit_fn)
+        return results
+
+    assert collect_recursive() == collect_visit() == list(tree.iter_inorder())
+    baseline = best_time(collect_recursive, number)
+    typer.echo(f"{'':<24} {'ms':>8} {'x':>6}")
+    typer.echo(f"{'recursive visit_inorder':<24} {baseline * 1000:>8.3f} {1:>6.1f}")
+    for name, fn in [
+        ("visit_inorder", collect_visit),
+        ("iter_inorder", lambda: list(tree.iter_inorder())),
+        ("iter_preorder", lambda: list(tree.iter_preorder())),
+        ("iter_postorder", lambda: list(tree.iter_postorder())),
+        ("find_type", lambda: tree.find_type(VariableExpression)),
+    ]:
+        elapsed = best_time(fn, number)
+        typer.echo(f"{name:<24} {elapsed * 1000:>8.3f} {baseline / elapsed:>6.1f}")
+
+
+@app.command()
+def types(
+    problems: int = typer.Option(40, help="Number of problems joined into a tree"),
+    number: int = typer.Option(5, help="Calls per timing sample"),
+) -> None:
+    """Compare type queries on every subtree of a tree, as `get_term` does, with
+    and without the type index that `find_type` keeps on the root."""
+    tree = ExpressionParser(max_cache_entries=0).parse(make_expression(problems))
+    nodes = list(tree.iter_inorder())
+    query_types = [VariableExpression, ConstantExpression, PowerExpression]
+    typer.echo(f"{len(nodes):,} nodes")
+
+    def walk() -> None:
+        for node in nodes:
+            for query_type in query_types:
+                [n for n in node.iter_inorder() if isinstance(n, query_type)]
+
+    def indexed() -> None:
+        tree.invalidate()
+        for node in nodes:
+            for query_type in query_types:
+                node.find_type(query_type)
+
+    before = best_time(walk, number)
+    after = best_time(indexed, number)
+    typer.echo(
+        f"walk {before * 1000:.1f}ms, indexed {after * 1000:.1f}ms "
+        f"({before / after:.1f}x)"
+    )
+
+
+@app.command()
+def terms(
+    problems: int = typer.Option(40, help="Number of problems joined into a tree"),
+    number: int = typer.Option(5, help="Calls per timing sample"),
+) -> None:
+    """Time `get_term` on every node of a tree, and `has_like_terms`, with the
+    cached subtree metrics dropped first (cold) or kept (warm)."""
+    tree = ExpressionParser(max_cache_entries=0).parse(make_expression(problems))
+    nodes = list(tree.iter_inorder())
+    typer.echo(f"{len(nodes):,} nodes")
+    for name, fn in [
+        ("get_term", lambda: [get_term(node) for node in nodes]),
+        ("has_like_terms", lambda: has_like_terms(tree)),
+    ]:
+
+        def cold() -> None:
+            tree.invalidate()
+            fn()
+
+        typer.echo(
+            f"{name:<15} cold {best_time(cold, number) * 1000:>8.2f}ms"
+            f"  warm {best_time(fn, number) * 1000:>8.2f}ms"
+        )
+
+
+@app.command()
+def clone(number: int = typer.Option(20, help="Calls per timing sample")) -> None:
+    """Time `clone` and `clone_from_root` on trees of increasing size."""
+    parser = ExpressionParser(max_cache_entries=0)
+    typer.echo(f"{'nodes':>8} {'clone (ms)':>11} {'clone_from_root (ms)':>21}")
+    for problems in [1, 10, 30]:
+        tree = parser.parse(make_expression(problems))
+        nodes = tree.to_list()
+        target = nodes[len(nodes) // 2]
+        elapsed = best_time(tree.clone, number)
+        from_root = best_time(target.clone_from_root, number)
+        typer.echo(f"{len(nodes):>8} {elapsed * 1000:>11.3f} {from_root * 1000:>21.3f}")
+
+
+@app.command()
+def dedupe(
+    count: int = typer.Option(5000, help="Number of trees, half of them repeats"),
+    number: int = typer.Option(3, help="Calls per timing sample"),
+) -> None:
+    """Compare deduplicating trees by their strings, by their structural hashes,
+    and by interning them."""
+    parser = ExpressionParser(max_cache_entries=0)
+    problems = make_problems(count // 2)
+    trees = [parser.parse(text) for text in problems + problems]
+
+    def by_string() -> int:
+        return len({str(tree) for tree in trees})
+
+    nodes = [node for tree in trees for node in tree.iter_preorder()]
+
+    def by_hash() -> int:
+        # Drop the hashes cached on every node, to time computing them
+        for node in nodes:
+            node._cache = None
+        return len({tree.structural_hash() for tree in trees})
+
+    def by_interning() -> int:
+        interner = ExpressionInterner()
+        return len({id(interner.intern(tree)) for tree in trees})
+
+    assert by_string() == by_hash() == by_interning()
+    typer.echo(f"{by_string():,} distinct trees of {len(trees):,}")
+    for name, fn in [
+        ("str(tree)", by_string),
+        ("structural_hash", by_hash),
+        ("interning", by_interning),
+    ]:
+        typer.echo(f"{name:<16} {best_time(fn, number) * 1000:>8.1f}ms")
+    cached = best_time(lambda: {tree.structural_hash() for tree in trees}, number)
+    typer.echo(f"{'cached hashes':<16} {cached * 1000:>8.1f}ms")
+
+
+@app.command()
+def canonical(number: int = typer.Option(5, help="Calls per timing sample")) -> None:
+    """Time `canonical_key` and `canonicalize` on sums of shuffled terms, next to
+    a cold `structural_hash`, and check that shuffles get the same key."""
+    parser = ExpressionParser(max_cache_entries=0)
+    random.seed(1337)
+    typer.echo(
+        f"{'terms':>8} {'nodes':>8} {'hash (ms)':>10} {'key (ms)':>9} "
+        f"{'canonicalize (ms)':>18}"
+    )
+    for count in [100, 1000, 4000]:
+        terms = [f"{random.randint(2, 9)}{random.choice('xyz')}" for _ in range(count)]
+        tree = parser.parse(" + ".join(terms))
+        random.shuffle(terms)
+        shuffled = parser.parse(" + ".join(terms))
+        assert canonical_key(tree) == canonical_key(shuffled)
+        nodes = tree.to_list()
+
+        def cold_hash() -> int:
+            for node in nodes:
+                node._cache = None
+            return tree.structural_hash()
+
+        hashed = best_time(cold_hash, number)
+        key = best_time(lambda: canonical_key(tree), number)
+        form = best_time(lambda: canonicalize(tree), number)
+        typer.echo(
+            f"{count:>8} {len(nodes):>8} {hashed * 1000:>10.2f} "
+            f"{key * 1000:>9.2f} {form * 1000:>18.2f}"
+        )
+
+
+@app.command()
+def compiled(
+    bindings: int = typer.Option(200, help="Variable bindings to evaluate with"),
+) -> None:
+    """Compare `evaluate` with calling the function from `compile` on trees of
+    increasing size, over many variable bindings."""
+    parser = ExpressionParser(max_cache_entries=0)
+    random.seed(1337)
+    contexts: List[Dict[str, NumberType]] = [
+        {name: random.uniform(1, 2) for name in "abcdefghijklmnopqrstuvwxyz"}
+        for _ in range(bindings)
+    ]
+    typer.echo(
+        f"{'nodes':>8} {'evaluate (ms)':>14} {'compiled (ms)':>14} "
+        f"{'compile (ms)':>13} {'speedup':>8}"
+    )
+    for problems in [1, 10, 30]:
+        tree = parser.parse(make_expression(problems))
+        fn = tree.compile()
+        assert [fn(c) for c in contexts] == [tree.evaluate(c) for c in contexts]
+
+        def cold() -> None:
+            tree.invalidate()
+            tree.compile()
+
+        evaluated = best_time(lambda: [tree.evaluate(c) for c in contexts], 1)
+        called = best_time(lambda: [fn(c) for c in contexts], 1)
+        compiling = best_time(cold, 3)
+        typer.echo(
+            f"{tree.size:>8} {evaluated * 1000:>14.2f} {called * 1000:>14.2f} "
+            f"{compiling * 1000:>13.2f} {evaluated / called:>7.1f}x"
+        )
+
+
+@app.command()
+def points(
+    count: int = typer.Option(1000, help="Variable bindings to evaluate with"),
+) -> None:
+    """Compare evaluating a tree at many points with `evaluate_batch` against
+    calling `evaluate` and the function from `compile` for each point."""
+    parser = ExpressionParser(max_cache_entries=0)
+    names = "abcdefghijklmnopqrstuvwxyz"
+    rng = np.random.default_rng(1337)
+    bindings = {name: rng.uniform(1, 2, count) for name in names}
+    contexts: List[Dict[str, NumberType]] = [
+        {name: float(values[i]) for name, values in bindings.items()}
+        for i in range(count)
+    ]
+    typer.echo(
+        f"{'nodes':>8} {'evaluate (ms)':>14} {'compiled (ms)':>14} "
+        f"{'batch (ms)':>11} {'walked batch (ms)':>18}"
+    )
+    for problems in [1, 10, 30]:
+        tree = parser.parse(make_expression(problems))
+        fn = tree.compile()
+        expected = [tree.evaluate(c) for c in contexts]
+        assert np.allclose(tree.evaluate_batch(bindings), expected)
+
+        def walked() -> None:
+            # The first calls on a tree walk it, and the later ones compile it
+            tree.invalidate()
+            tree.evaluate_batch(bindings)
+
+        evaluated = best_time(lambda: [tree.evaluate(c) for c in contexts], 1, 3)
+        called = best_time(lambda: [fn(c) for c in contexts], 1, 3)
+        batch = best_time(lambda: tree.evaluate_batch(bindings), 3)
+        walking = best_time(walked, 3)
+        typer.echo(
+            f"{tree.size:>8} {evaluated * 1000:>14.2f} {called * 1000:>14.2f} "
+            f"{batch * 1000:>11.2f} {walking * 1000:>18.2f}"
+        )
+
+
+@app.command()
+def equivalence(
+    count: int = typer.Option(500, help="Number of expression pairs to check"),
+    trials: int = typer.Option(2000, help="Checks of each inequivalent pair"),
+) -> None:
+    """Compare the single-point value check with `check_expression_equivalence`,
+    for speed on fresh trees, and for how often they pass inequivalent pairs."""
+    parser = ExpressionParser(max_cache_entries=0)
+    pairs = [(parser.parse(t), parser.parse(t)) for t in make_problems(count)]
+
+    def fresh(check: Callable[[MathExpression, MathExpression], Any]) -> float:
+        # Check copies without cached state, like the new trees from each rule
+        times = []
+        for _ in range(3):
+            copies = [(one.clone(), two.clone()) for one, two in pairs]
+            start = timeit.default_timer()
+            for one, two in copies:
+                check(one, two)
+            times.append(timeit.default_timer() - start)
+        return min(times)
+
+    def check_many(one: MathExpression, two: MathExpression) -> bool:
+        return check_expression_equivalence(one, two).equivalent
+
+    single = fresh(single_point_compare)
+    many = fresh(check_many)
+    typer.echo(f"{'check':<28} {'us/pair':>8}")
+    typer.echo(f"{'single point':<28} {single * 1e6 / count:>8.1f}")
+    typer.echo(f"{'check_expression_equivalence':<28} {many * 1e6 / count:>8.1f}")
+    typer.echo(f"\n{'inequivalent pair':<28} {'single point':>13} {'32 points':>10}")
+    random.seed(1337)
+    for one, two in [("x^2", "2x"), ("(x - 5)(x - 7)", "0x"), ("x / 10", "x - 9")]:
+        before, after = parser.parse(one), parser.parse(two)
+        passed = sum(single_point_compare(before, after) for _ in range(trials))
+        passed_many = sum(check_many(before, after) for _ in range(trials))
+        typer.echo(
+            f"{one + ' vs ' + two:<28} {passed / trials:>12.2%} "
+            f"{passed_many / trials:>10.2%}"
+        )
+
+
+@app.command()
+def polynomials(
+    count: int = typer.Option(2000, help="Number of generated problems"),
+    number: int = typer.Option(3, help="Calls per timing sample"),
+) -> None:
+    """Time `evaluate` on generated polynomials using Python numbers, against the
+    NumPy scalar operations that powers and absolute values used before."""
+    # The NumPy baseline warns when its int64 values overflow
+    warnings.simplefilter("ignore", RuntimeWarning)
+    parser = ExpressionParser(max_cache_entries=0)
+    random.seed(1337)
+    trees = [
+        parser.parse(gen_simplify_multiple_terms(8, powers_probability=0.8)[0])
+        for _ in range(count)
+    ]
+    names = "abcdefghijklmnopqrstuvwxyz"
+    cases: List[Tuple[str, Dict[str, NumberType]]] = [
+        ("ints", {name: i % 7 + 2 for i, name in enumerate(names)}),
+        ("floats", {name: i % 7 + 1.5 for i, name in enumerate(names)}),
+    ]
+    typer.echo(f"{'values':<8} {'numpy (ms)':>11} {'native (ms)':>12} {'speedup':>8}")
+    for label, context in cases:
+
+        def run() -> List[NumberType]:
+            return [tree.evaluate(context) for tree in trees]
+
+        native_values = run()
+        native = best_time(run, number)
+        power, absolute = PowerExpression.operate, AbsExpression.operate
+        setattr(PowerExpression, "operate", numpy_power)
+        setattr(AbsExpression, "operate", numpy_absolute)
+        try:
+            numpy_values = run()
+            numpy_time = best_time(run, number)
+        finally:
+            setattr(PowerExpression, "operate", power)
+            setattr(AbsExpression, "operate", absolute)
+        # NumPy int64 math wraps around when it overflows, so its values can be wrong
+        wrong = sum(not math.isclose(a, b) for a, b in zip(native_values, numpy_values))
+        typer.echo(
+            f"{label:<8} {numpy_time * 1000:>11.2f} {native * 1000:>12.2f} "
+            f"{numpy_time / native:>7.1f}x ({wrong} numpy values differ)"
+        )
+
+
+def make_coefficient_chain(terms: int) -> str:
+    """Build a polynomial with fractional coefficients and large powers, with a
+    term that cancels out, e.g. `x^30 + 3x^11 / 7 - 5x^9 / 11 - x^30`"""
+    parts: List[str] = []
+    for _ in range(terms):
+        sign = random.choice(["+", "-"])
+        top, bottom = random.randint(1, 99), random.randint(2, 99)
+        parts.append(f"{sign} {top}x^{random.randint(1, 12)} / {bottom}")
+    text = " ".join(parts)[2:]
+    # A much larger term that cancels out, like the ones left behind by rule steps
+    return f"x^30 + {text} - x^30"
+
+
+def make_constant_chain(terms: int) -> str:
+    """Build a sum of products of fractions, e.g. `(3/7 * 2/5) + (1/9 * 8/3)`"""
+    parts = [
+        f"({random.randint(1, 99)}/{random.randint(2, 99)} * "
+        f"{random.randint(1, 99)}/{random.randint(2, 99)})"
+        for _ in range(terms)
+    ]
+    return " + ".join(parts)
+
+
+@app.command()
+def exact(
+    count: int = typer.Option(200, help="Number of trees per workload"),
+    number: int = typer.Option(1, help="Calls per timing sample"),
+) -> None:
+    """Compare float and exact numbers (`use_exact_numbers`) on generated
+    workloads, for speed and for how many float results are wrong or checks
+    spuriously fail."""
+    random.seed(1337)
+    polynomials = [
+        gen_simplify_multiple_terms(8, powers_probability=0.8)[0] for _ in range(count)
+    ]
+    chains = [make_coefficient_chain(16) for _ in range(count)]
+    constants = [make_constant_chain(8) for _ in range(count)]
+    names = "abcdefghijklmnopqrstuvwxyz"
+    ints: Dict[str, NumberType] = {name: i % 7 + 2 for i, name in enumerate(names)}
+    rule = ConstantsSimplifyRule()
+
+    def fold(tree: MathExpression) -> MathExpression:
+        node = rule.find_node(tree)
+        while node is not None:
+            result = rule.apply_to(node).result
+            assert result is not None
+            tree = result.get_root()
+            node = rule.find_node(tree)
+        return tree
+
+    def check_pair(one: MathExpression, two: MathExpression) -> bool:
+        return check_expression_equivalence(one, two).equivalent
+
+    def run(exact_numbers: bool) -> Dict[str, Tuple[float, List[Any]]]:
+        parser = ExpressionParser(max_cache_entries=0, exact_numbers=exact_numbers)
+        results: Dict[str, Tuple[float, List[Any]]] = {}
+        trees = [parser.parse(t) for t in polynomials]
+        chain_trees = [parser.parse(t) for t in chains]
+        # Evaluate without compiling, and fold or check fresh copies of the trees
+        workloads: List[Tuple[str, Callable[[], List[Any]]]] = [
+            ("int polynomials", lambda: [t.evaluate(ints) for t in trees]),
+            ("coefficient chains", lambda: [t.evaluate({"x": 7}) for t in chain_trees]),
+            ("fold constants", lambda: [fold(parser.parse(t)) for t in constants]),
+            (
+                "check chains",
+                lambda: [
+                    check_pair(parser.parse(t), canonicalize(parser.parse(t)))
+                    for t in chains
+                ],
+            ),
+        ]
+        # The rules and checks evaluate with the setting of the block
+        with use_exact_numbers(exact_numbers):
+            for label, workload in workloads:
+                values = workload()
+                results[label] = (best_time(workload, number), values)
+        return results
+
+    floats, exacts = run(False), run(True)
+    typer.echo(
+        f"{'workload':<20} {'float (ms)':>11} {'exact (ms)':>11} {'slowdown':>9} "
+        f"{'float wrong':>12}"
+    )
+    for label, (float_time, float_values) in floats.items():
+        exact_time, exact_values = exacts[label]
+        if label == "fold constants":
+            float_values = [tree.evaluate() for tree in float_values]
+            exact_values = [tree.evaluate() for tree in exact_values]
+        wrong = sum(
+            not math.isclose(float(b), a, rel_tol=1e-9) if type(a) is float else a != b
+            for a, b in zip(float_values, exact_values)
+        )
+        typer.echo(
+            f"{label:<20} {float_time * 1000:>11.2f} {exact_time * 1000:>11.2f} "
+            f"{exact_time / float_time:>8.2f}x {wrong:>12}"
+        )
+
+
+@app.command()
+def memoized(
+    steps: int = typer.Option(200, help="Local changes per timing sample"),
+) -> None:
+    """Compare `evaluate` with `evaluate_cached` for re-evaluating a tree after
+    each of many local changes, like the steps of a search, on trees of
+    increasing size. The cold column is the first `evaluate_cached` of a tree,
+    which computes and caches the value of every node."""
+    parser = ExpressionParser(max_cache_entries=0)
+    random.seed(1337)
+    names = "abcdefghijklmnopqrstuvwxyz"
+    context: Dict[str, NumberType] = {name: i % 7 + 2 for i, name in enumerate(names)}
+    typer.echo(
+        f"{'nodes':>8} {'depth':>6} {'evaluate (us)':>14} {'cached (us)':>12} "
+        f"{'speedup':>8} {'cold (us)':>10}"
+    )
+    for problems in [1, 10, 30]:
+        tree = parser.parse(make_expression(problems))
+        constants = tree.find_type(ConstantExpression)
+        changes = [random.choice(constants) for _ in range(steps)]
+
+        def run(evaluate: Callable[[], Any]) -> List[Any]:
+            values = []
+            for constant in changes:
+                assert constant.value is not None
+                # The setter drops the cached values from the constant up
+                constant.value = constant.value + 1
+                values.append(evaluate())
+            return values
+
+        checked = run(lambda: (tree.evaluate(context), tree.evaluate_cached(context)))
+        assert all(one == two for one, two in checked)
+
+        def cold() -> float:
+            # Evaluate copies without cached values, like the trees from a parse
+            times = []
+            for copy in [tree.clone() for _ in range(10)]:
+                start = timeit.default_timer()
+                copy.evaluate_cached(context)
+                times.append(timeit.default_timer() - start)
+            return min(times)
+
+        evaluated = best_time(lambda: run(lambda: tree.evaluate(context)), 1)
+        cached = best_time(lambda: run(lambda: tree.evaluate_cached(context)), 1)
+        uncached = cold()
+        typer.echo(
+            f"{tree.size:>8} {tree.height:>6} {evaluated * 1e6 / steps:>14.1f} "
+            f"{cached * 1e6 / steps:>12.1f} {evaluated / cached:>7.1f}x "
+            f"{uncached * 1e6:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    app()